@@ -7,17 +7,23 @@
 
 import argparse
 import configparser
+import contextlib
 import errno
 import hashlib
 import json
 import os
 import shutil
-from pathlib import Path
+import stat
+import subprocess
+import sys
 
-from ansible.constants import DEFAULT_VAULT_ID_MATCH
-from ansible.parsing.vault import VaultLib, VaultSecret
+from pilfer import diff, events, gitfilter, governor, manifest, password, pipeline
 
-temp_vault_file_list_path = "vaultedFileList.json"
+# subcommands whose git calls fail outside a repository or on bad revisions
+GIT_ACTIONS = ("diff", "log-grep", "check-staged")
+
+temp_vault_file_list_path = "vaultedFileList.jsonl"
+legacy_vault_file_list_path = "vaultedFileList.json"
 list_of_vault_encrypted_files = []
 temp_hidden_encrypted_copies_directory_path = ".vault"
 
@@ -57,102 +63,215 @@ def get_vault_password_file():
 
 # find all files that have the ansible vault header and write it to disk
 def write_vaulted_file_list():
-    walk_dir = os.path.abspath(os.getcwd())
+    list_of_vault_encrypted_files[:] = discover_vault_files()
 
-    for dirpath, dirnames, filenames in os.walk(walk_dir):
+    if os.path.exists(temp_vault_file_list_path):
+        os.remove(temp_vault_file_list_path)
+    with manifest.ManifestWriter(temp_vault_file_list_path) as manifest_writer:
+        for filePath in list_of_vault_encrypted_files:
+            manifest_writer.write({"path": filePath, "state": manifest.PENDING})
 
-        for name in filenames:
-            # print name
 
-            # disable filename filter since we might have encrypted everything
-            # yamlExtensions = ('yml','yaml')
-            # if name.endswith(yamlExtensions):
-            #     print name
+def discover_vault_files():
+    """Walk the current directory, yielding vaulted files as they are found"""
+    return pipeline.iter_vaulted_files(
+        os.getcwd(), exclude_dirs=[temp_hidden_encrypted_copies_directory_path]
+    )
 
-            # full path
-            filePath = os.path.join(dirpath, name)
-            # print filePath
 
-            # find all files with the ansible vault header
-            try:
-                with open(filePath, "rb") as open_file:
-                    first_line = open_file.readline()
+def opened_vault_file_list_path():
+    """Path of the current session's vault file list, or None if nothing is open"""
+    for path in (temp_vault_file_list_path, legacy_vault_file_list_path):
+        if os.path.isfile(path):
+            return path
+    return None
 
-                    if first_line.startswith(b"$ANSIBLE_VAULT;"):
-                        # print filePath
-                        list_of_vault_encrypted_files.append(filePath)
-            except (IOError, OSError, PermissionError):
-                # Skip files we can't read
-                continue
 
-    # print vaultedFileList
-    with open(temp_vault_file_list_path, "w") as open_file:
-        json.dump(list_of_vault_encrypted_files, open_file, indent=2)
+def vault_password_source(vault_password_file_path=None, vault_id=None):
+    """Return (password file or script, vault id) to read the password from"""
+    if vault_password_file_path:
+        return vault_password_file_path, None
+    if vault_id:
+        label, source = password.parse_vault_id(vault_id)
+        return source, label
+    return get_vault_password_file(), None
 
 
-def decrypt_vault_files(vault_password_file_path=None):
-    # load the list of encrypted files
-    with open(temp_vault_file_list_path, "r") as vaultListFile:
-        vaultedFileList = json.load(vaultListFile)
+def read_vault_password(vault_password_file_path=None, vault_id=None):
+    """Return the vault password as bytes
 
-        # list the detected encrypted files
-        # print json.dumps(vaultedFileList, indent=2)
+    Executable password files and vault id client scripts are run at most
+    once per session, see pilfer.password.
+    """
+    return password.resolve_vault_password(
+        *vault_password_source(vault_password_file_path, vault_id)
+    )
 
-    # determine vault password file
-    if vault_password_file_path:
-        vault_file = vault_password_file_path
-    else:
-        vault_file = get_vault_password_file()
 
-    # load vault password into memory
-    with open(vault_file, "r") as vault_password_file:
-        vaultPassword = vault_password_file.read().strip()
+def stash_path(vaultedFilePath, name):
+    return temp_hidden_encrypted_copies_directory_path + vaultedFilePath + "/" + name
 
-    # create VaultLib instance using Ansible's official implementation
-    vault = VaultLib(
-        [(DEFAULT_VAULT_ID_MATCH, VaultSecret(vaultPassword.encode("utf-8")))]
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    governor.current.throttle_io(len(data))
+    return data
+
+
+def _stash_original(vaultedFilePath):
+    """Keep the encrypted file itself (inode, mode and mtime) in the stash"""
+    stashed = stash_path(vaultedFilePath, "encrypted")
+    if os.path.lexists(stashed):
+        # left behind by an open that was interrupted before this file
+        os.remove(stashed)
+    try:
+        os.link(vaultedFilePath, stashed)
+    except OSError:
+        # no hard links here (other device, filesystem without links)
+        governor.current.throttle_io(2 * os.path.getsize(vaultedFilePath))
+        shutil.copy2(vaultedFilePath, stashed)
+
+
+def _replace_with(vaultedFilePath, data, mode):
+    """Atomically put a new file with data and mode at vaultedFilePath"""
+    temp_path = os.path.join(
+        os.path.dirname(vaultedFilePath),
+        "." + os.path.basename(vaultedFilePath) + ".pilfer-tmp",
     )
+    governor.current.throttle_io(len(data))
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            os.fchmod(f.fileno(), mode)
+        os.replace(temp_path, vaultedFilePath)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _restore_original(vaultedFilePath):
+    """Move the stashed encrypted file back into place, metadata and all"""
+    stashed = stash_path(vaultedFilePath, "encrypted")
+    try:
+        os.replace(stashed, vaultedFilePath)
+    except OSError as exc:
+        if exc.errno != errno.EXDEV:
+            raise
+        governor.current.throttle_io(2 * os.path.getsize(stashed))
+        shutil.copy2(stashed, vaultedFilePath)
+        os.remove(stashed)
 
-    # iterate over the list of vaulted files
-    for vaultedFilePath in vaultedFileList:
-        try:
-            # recursively build a mirror directory structure for this file
-            mkdir_p(
-                os.path.join(
-                    temp_hidden_encrypted_copies_directory_path + vaultedFilePath
-                )
-            )
 
-            # make a copy of the encrypted file
-            shutil.copy2(
+def _stash_and_write_decrypted(
+    vaultedFilePath, encrypted_data, decrypted_bytes, manifest_writer=None
+):
+    if os.path.islink(vaultedFilePath):
+        # the stash would be the link itself, pointing nowhere from .vault
+        raise ValueError("symlinked vault files are not opened, open the target")
+    # the hash of the decrypted content (bytes) goes into the manifest
+    file_hash = hashlib.sha256(decrypted_bytes).hexdigest()
+    if manifest_writer is not None:
+        # recorded before anything is moved, so however open is interrupted
+        # close knows about every file that may now be plaintext
+        manifest_writer.write(
+            manifest.pending_record(
                 vaultedFilePath,
-                temp_hidden_encrypted_copies_directory_path
-                + vaultedFilePath
-                + "/encrypted",
+                encrypted_data,
+                file_hash,
+                stash_path(vaultedFilePath, "encrypted"),
             )
+        )
 
-            # decrypt the file using Ansible's official vault implementation
-            # Read encrypted data as bytes to preserve exact formatting
-            with open(vaultedFilePath, "rb") as f:
-                encrypted_data = f.read()
-                # VaultLib.decrypt() returns bytes, preserving binary data and line endings
-                decrypted_bytes = vault.decrypt(encrypted_data)
-
-            # write a hash of the decrypted content (bytes) to disk in the temporary directory
-            file_hash = hashlib.sha256(decrypted_bytes).hexdigest()
-            with open(
-                temp_hidden_encrypted_copies_directory_path + vaultedFilePath + "/hash",
-                "w",
-            ) as decryptedVaultFileHash:
-                decryptedVaultFileHash.write(file_hash)
-
-            # write the decrypted data to disk as bytes to preserve exact formatting
-            with open(vaultedFilePath, "wb") as decryptedVaultFile:
-                decryptedVaultFile.write(decrypted_bytes)
-
-        except Exception as e:
-            print(f"Failed to decrypt {vaultedFilePath}: {e}")
-            continue
+    # recursively build a mirror directory structure for this file
+    mkdir_p(os.path.join(temp_hidden_encrypted_copies_directory_path + vaultedFilePath))
+
+    # keep the encrypted file untouched in the stash, so close can move it
+    # back with its original mtime and git's stat cache stays valid
+    _stash_original(vaultedFilePath)
+
+    # write the decrypted data to disk as bytes to preserve exact formatting;
+    # it is a new file, so the stashed original is not modified
+    _replace_with(
+        vaultedFilePath,
+        decrypted_bytes,
+        stat.S_IMODE(os.stat(stash_path(vaultedFilePath, "encrypted")).st_mode),
+    )
+    return manifest.decrypted_record(vaultedFilePath, encrypted_data, file_hash)
+
+
+def decrypt_vault_files(
+    vault_password_file_path=None,
+    vaultedFileList=None,
+    jobs=None,
+    vault_id=None,
+    progress=None,
+):
+    """Decrypt vault files in place, stashing the encrypted originals
+
+    Files come from vaultedFileList (any iterable, e.g. discover_vault_files())
+    or, by default, from the pending entries of write_vaulted_file_list().
+    Reading, decryption and writing overlap: I/O runs on threads and
+    decryption on worker processes. Every file is recorded in the manifest as
+    pending before it is stashed and as decrypted once it has been written,
+    and reported to progress.
+    """
+    if progress is None:
+        progress = events.Progress("open")
+    if vaultedFileList is None:
+        vaultedFileList = (
+            record["path"]
+            for record in manifest.iter_records(
+                temp_vault_file_list_path, manifest.PENDING
+            )
+            # pending records of files being swapped are appended meanwhile
+            if "stash" not in record
+        )
+
+    vaultPassword = read_vault_password(vault_password_file_path, vault_id)
+
+    def report_failure(args, e):
+        print(f"Failed to decrypt {args[0]}: {e}")
+        progress.failed(args[0], e)
+
+    with pipeline.crypto_executor(
+        vaultPassword, jobs
+    ) as crypto_pool, pipeline.io_executor(jobs) as io_pool, manifest.ManifestWriter(
+        temp_vault_file_list_path
+    ) as manifest_writer:
+        reads = pipeline.stream_map(
+            _read_file,
+            (
+                (path,)
+                for path in progress.track(pipeline.threaded_iter(vaultedFileList))
+            ),
+            io_pool,
+        )
+        decrypts = pipeline.stream_map(
+            pipeline.decrypt_in_worker,
+            (
+                (path, encrypted_data)
+                for (path,), encrypted_data in pipeline.succeeded(reads, report_failure)
+            ),
+            crypto_pool,
+        )
+        writes = pipeline.stream_map(
+            _stash_and_write_decrypted,
+            (
+                (path, encrypted_data, decrypted_bytes, manifest_writer)
+                for (path, encrypted_data), decrypted_bytes in pipeline.succeeded(
+                    decrypts, report_failure
+                )
+            ),
+            io_pool,
+        )
+        for (path, encrypted_data, _, _), record in pipeline.succeeded(
+            writes, report_failure
+        ):
+            manifest_writer.write(record)
+            progress.done(path, len(encrypted_data))
 
 
 def mkdir_p(path):
@@ -165,97 +284,471 @@ def mkdir_p(path):
             raise
 
 
-def recrypt_vault_files(vault_password_file_path=None):
-    with open(temp_vault_file_list_path, "r") as vaultListFile:
-        vaultedFileList = json.load(vaultListFile)
+class NotOpen(Exception):
+    """A file in the manifest that is no longer open, so close only drops it"""
 
-    # determine vault password file
-    if vault_password_file_path:
-        vault_file = vault_password_file_path
+    def __init__(self, path, reason):
+        super().__init__(f"{path} {reason}")
+        self.reason = reason
+
+
+def _clean_stash(vaultedFilePath):
+    """Remove what is left of a file's stash, and its directories once empty"""
+    try:
+        for name in ("encrypted", "hash"):
+            if os.path.lexists(stash_path(vaultedFilePath, name)):
+                os.remove(stash_path(vaultedFilePath, name))
+        os.removedirs(temp_hidden_encrypted_copies_directory_path + vaultedFilePath)
+    except Exception as e:
+        print(f"Warning: Failed to clean temp files for {vaultedFilePath}: {e}")
+
+
+def _check_still_open(vaultedFilePath):
+    """Raise NotOpen for a file that was deleted, or closed by an earlier
+    close that was killed before it could drop the manifest"""
+    if not os.path.exists(vaultedFilePath):
+        _clean_stash(vaultedFilePath)
+        raise NotOpen(vaultedFilePath, "was deleted, its stash has been removed")
+    if os.path.islink(vaultedFilePath):
+        # open replaces files with plaintext, so this one never was
+        _clean_stash(vaultedFilePath)
+        raise NotOpen(vaultedFilePath, "is a symlink that was never opened")
+    if os.path.lexists(stash_path(vaultedFilePath, "encrypted")):
+        return
+    with open(vaultedFilePath, "rb") as f:
+        header = f.read(len(pipeline.VAULT_HEADER))
+    if header == pipeline.VAULT_HEADER:
+        _clean_stash(vaultedFilePath)
+        raise NotOpen(vaultedFilePath, "is encrypted already")
+
+
+def _load_for_recrypt(vaultedFilePath, old_hash):
+    """Return the new plaintext of a vault file, or None if it is unchanged
+
+    Raises NotOpen for files that no longer need closing.
+    """
+    _check_still_open(vaultedFilePath)
+    if old_hash is None:
+        # opened by an older pilfer, which kept the hash next to the stash
+        with open(stash_path(vaultedFilePath, "hash"), "r") as f:
+            old_hash = f.read().strip()
+
+    # Load (potentially) new data from original path as bytes
+    new_data_bytes = _read_file(vaultedFilePath)
+    new_hash = hashlib.sha256(new_data_bytes).hexdigest()
+
+    # Only modified files need re-encrypting
+    if old_hash == new_hash:
+        return None
+    if new_data_bytes.startswith(pipeline.VAULT_HEADER):
+        # never swapped by an interrupted open, written back by a close that
+        # was killed before it removed the stash, or re-encrypted by hand
+        _clean_stash(vaultedFilePath)
+        raise NotOpen(vaultedFilePath, "is encrypted already")
+    return new_data_bytes
+
+
+def _load_for_semantic_recrypt(vaultedFilePath, old_hash):
+    """Like _load_for_recrypt(), adding the stashed ciphertext of changed files"""
+    new_data_bytes = _load_for_recrypt(vaultedFilePath, old_hash)
+    if new_data_bytes is None:
+        return None, None
+    return new_data_bytes, _read_file(stash_path(vaultedFilePath, "encrypted"))
+
+
+def _write_recrypted(vaultedFilePath, new_encrypted_data):
+    """Write the vault file back and clean its stash
+
+    Returns (whether it was modified, bytes written).
+    """
+    modified = new_encrypted_data is not None
+    if modified:
+        # Update file with bytes to preserve exact formatting
+        governor.current.throttle_io(len(new_encrypted_data))
+        with open(vaultedFilePath, "wb") as f:
+            f.write(new_encrypted_data)
+        written = len(new_encrypted_data)
+        os.remove(stash_path(vaultedFilePath, "encrypted"))
     else:
-        vault_file = get_vault_password_file()
+        # File unchanged, move the original encrypted file back into place
+        written = os.path.getsize(stash_path(vaultedFilePath, "encrypted"))
+        _restore_original(vaultedFilePath)
 
-    # load vault password into memory
-    with open(vault_file, "r") as vault_password_file:
-        vaultPassword = vault_password_file.read().strip()
+    _clean_stash(vaultedFilePath)
+    return modified, written
 
-    # create VaultLib instance using Ansible's official implementation
-    vault = VaultLib(
-        [(DEFAULT_VAULT_ID_MATCH, VaultSecret(vaultPassword.encode("utf-8")))]
-    )
 
-    modified_count = 0
-    # iterate over the list of vaulted files
-    for vaultedFilePath in vaultedFileList:
-        try:
-            # Load stored encrypted data as bytes
-            with open(
-                temp_hidden_encrypted_copies_directory_path
-                + vaultedFilePath
-                + "/encrypted",
-                "rb",
-            ) as f:
-                old_encrypted_data = f.read()
-
-            with open(
-                temp_hidden_encrypted_copies_directory_path + vaultedFilePath + "/hash",
-                "r",
-            ) as f:
-                old_hash = f.read().strip()
-
-            # Load (potentially) new data from original path as bytes
-            with open(vaultedFilePath, "rb") as f:
-                new_data_bytes = f.read()
-                new_hash = hashlib.sha256(new_data_bytes).hexdigest()
-
-            # Determine whether to re-encrypt
-            if old_hash != new_hash:
-                # File was modified, re-encrypt it using Ansible's official vault implementation
-                # VaultLib.encrypt() expects and returns bytes
-                new_encrypted_data = vault.encrypt(new_data_bytes)
-                modified_count += 1
-            else:
-                # File unchanged, restore original encrypted version
-                new_encrypted_data = old_encrypted_data
+def recrypt_vault_files(
+    vault_password_file_path=None,
+    jobs=None,
+    vault_id=None,
+    progress=None,
+    session_salt=False,
+    semantic=False,
+):
+    """Re-encrypt the opened vault files, only changing ones that were modified
 
-            # Update file with bytes to preserve exact formatting
-            with open(vaultedFilePath, "wb") as f:
-                f.write(new_encrypted_data)
+    With session_salt, every modified file is encrypted with one random salt
+    generated for this close, so the key is derived once per worker rather
+    than once per file. The files then share an AES-CTR key and keystream;
+    see the README before using it.
 
-            # Clean vault
-            try:
-                os.remove(
-                    temp_hidden_encrypted_copies_directory_path
-                    + vaultedFilePath
-                    + "/encrypted"
-                )
-                os.remove(
-                    temp_hidden_encrypted_copies_directory_path
-                    + vaultedFilePath
-                    + "/hash"
-                )
-                os.removedirs(
-                    temp_hidden_encrypted_copies_directory_path + vaultedFilePath
+    With semantic, YAML/JSON files whose bytes changed but whose data did not
+    (see pilfer.semantic) keep their original ciphertext, like unchanged
+    files. Files whose plaintext hash still matches are never parsed.
+
+    Files that fail are reported to progress and stay open: the manifest
+    keeps their records, so close can be run again once they are fixed.
+    Files deleted during the session, and files an interrupted close already
+    restored, are reported and dropped with their stash.
+    """
+    manifest_path = opened_vault_file_list_path()
+    if manifest_path is None:
+        raise FileNotFoundError("No vault file list found. Run 'pilfer open' first.")
+    vaultPassword = read_vault_password(vault_password_file_path, vault_id)
+    if progress is None:
+        progress = events.Progress("close")
+    # files opened by an older pilfer have no recorded label, so they get
+    # the one selected with --vault-id
+    selected_label = password.parse_vault_id(vault_id)[0] if vault_id else None
+    # path -> vault id label of the files between loading and encrypting
+    labels = {}
+
+    failed_paths = set()
+
+    def opened_files():
+        for record in manifest.iter_opened(manifest_path):
+            labels[record["path"]] = record.get("vault_id", selected_label)
+            yield record["path"], record["hash"]
+
+    def report_failure(args, e):
+        labels.pop(args[0], None)
+        if isinstance(e, NotOpen):
+            print(f"Skipped {e}")
+            progress.done(args[0], 0, modified=False, skipped=e.reason)
+            return
+        print(f"Failed to process {args[0]}: {e}")
+        failed_paths.add(args[0])
+        progress.failed(args[0], e)
+
+    salt = None
+    if session_salt:
+        # imported here, like the rest of the crypto, to keep status fast
+        from pilfer import codec
+
+        salt = os.urandom(codec.SALT_LENGTH)
+
+    modified_count = 0
+    with pipeline.crypto_executor(
+        vaultPassword, jobs, session_salt=salt
+    ) as crypto_pool, pipeline.io_executor(jobs) as io_pool:
+        loads = pipeline.stream_map(
+            _load_for_semantic_recrypt if semantic else _load_for_recrypt,
+            progress.track(opened_files(), key=lambda item: item[0]),
+            io_pool,
+        )
+        # unchanged files pass through the crypto stage as None
+        if semantic:
+            encrypts = pipeline.stream_map(
+                pipeline.semantic_encrypt_in_worker,
+                (
+                    (path,) + loaded + (labels.pop(path),)
+                    for (path, _), loaded in pipeline.succeeded(loads, report_failure)
+                ),
+                crypto_pool,
+            )
+        else:
+            encrypts = pipeline.stream_map(
+                pipeline.encrypt_in_worker,
+                (
+                    (path, new_data_bytes, labels.pop(path))
+                    for (path, _), new_data_bytes in pipeline.succeeded(
+                        loads, report_failure
+                    )
+                ),
+                crypto_pool,
+            )
+        writes = pipeline.stream_map(
+            _write_recrypted,
+            (
+                (args[0], new_encrypted_data)
+                for args, new_encrypted_data in pipeline.succeeded(
+                    encrypts, report_failure
                 )
-            except Exception as e:
-                print(f"Warning: Failed to clean temp files for {vaultedFilePath}: {e}")
-        except Exception as e:
-            print(f"Failed to process {vaultedFilePath}: {e}")
-            continue
+            ),
+            io_pool,
+        )
+        for (path, _), (modified, size) in pipeline.succeeded(writes, report_failure):
+            progress.done(path, size, modified=modified)
+            if modified:
+                modified_count += 1
 
     try:
         os.removedirs(temp_hidden_encrypted_copies_directory_path)
     except Exception:
         pass
 
-    try:
-        os.remove(temp_vault_file_list_path)
-    except Exception:
-        pass
+    if failed_paths:
+        # the failed files are still open; keep them for the next close
+        manifest.retain(manifest_path, failed_paths, temp_vault_file_list_path)
+    else:
+        try:
+            os.remove(manifest_path)
+        except Exception:
+            pass
 
     return modified_count
 
 
+def verify_vault_files(
+    vault_password_file_path=None, jobs=None, vault_id=None, progress=None
+):
+    """Decrypt every vault file in memory, checking the password and HMAC
+
+    Nothing is written to disk. Returns one result dict per vault file with
+    its path (relative to the current directory), status and, for failures,
+    the error message.
+    """
+    vaultPassword = read_vault_password(vault_password_file_path, vault_id)
+    if progress is None:
+        progress = events.Progress("verify")
+    results = []
+
+    with pipeline.crypto_executor(
+        vaultPassword, jobs
+    ) as crypto_pool, pipeline.io_executor(jobs) as io_pool:
+
+        def report_failure(args, e):
+            results.append(
+                {"path": os.path.relpath(args[0]), "status": "failed", "error": str(e)}
+            )
+            progress.failed(args[0], e)
+
+        reads = pipeline.stream_map(
+            _read_file,
+            (
+                (path,)
+                for path in progress.track(
+                    pipeline.threaded_iter(
+                        pipeline.iter_vaulted_files(
+                            os.getcwd(),
+                            exclude_dirs=[temp_hidden_encrypted_copies_directory_path],
+                        )
+                    )
+                )
+            ),
+            io_pool,
+        )
+        verifies = pipeline.stream_map(
+            pipeline.verify_in_worker,
+            (
+                (path, encrypted_data)
+                for (path,), encrypted_data in pipeline.succeeded(reads, report_failure)
+            ),
+            crypto_pool,
+        )
+        for (path, encrypted_data), size in pipeline.succeeded(
+            verifies, report_failure
+        ):
+            results.append(
+                {"path": os.path.relpath(path), "status": "ok", "size": size}
+            )
+            progress.done(path, len(encrypted_data))
+
+    results.sort(key=lambda result: result["path"])
+    return results
+
+
+def print_verify_report(results, output_format="text"):
+    failed = [result for result in results if result["status"] != "ok"]
+
+    if output_format == "json":
+        json.dump(
+            {
+                "verified": len(results) - len(failed),
+                "failed": len(failed),
+                "files": results,
+            },
+            sys.stdout,
+            indent=2,
+        )
+        print()
+        return
+
+    for result in failed:
+        print(f"FAILED {result['path']}: {result['error']}")
+    if failed:
+        print(f"❌ {len(failed)} of {len(results)} vault files failed verification.")
+    else:
+        print(f"✅ All {len(results)} vault files verified.")
+
+
+STATUS_CODES = {
+    "modified": "M",
+    "missing": "D",
+    "new": "?",
+    "unchanged": " ",
+    "unknown": "!",
+}
+
+
+def print_status_report(statuses, output_format="text", show_unchanged=False):
+    """Print (status, path) pairs as they are produced, then a summary"""
+    counts = {}
+    for file_status, path in statuses:
+        counts[file_status] = counts.get(file_status, 0) + 1
+        if file_status == "unchanged" and not show_unchanged:
+            continue
+        if output_format == "jsonl":
+            print(json.dumps({"status": file_status, "path": os.path.relpath(path)}))
+        else:
+            print(f"{STATUS_CODES[file_status]} {os.path.relpath(path)}")
+
+    if output_format == "text":
+        print(
+            ", ".join(
+                f"{counts.get(name, 0)} {name}"
+                for name in ("modified", "unchanged", "missing", "new")
+            )
+        )
+
+
+def print_log_grep_results(results, output_format="text"):
+    """Print log-grep results as they come; returns how many blobs matched"""
+    count = 0
+    for result in results:
+        count += 1
+        if output_format == "jsonl":
+            print(json.dumps(result))
+            continue
+        print(f"{result['path']} blob {result['blob'][:12]}")
+        for commit in result["commits"]:
+            print(f"  {commit['commit'][:12]} {commit['date']} {commit['subject']}")
+        for number, line in result["matches"]:
+            print(f"  {number}:{line}")
+        sys.stdout.flush()
+    return count
+
+
+def add_common_arguments(parser, defaults=True):
+    """Options accepted both before and after the subcommand
+
+    Subcommand copies use SUPPRESS defaults so they don't overwrite values
+    given before the subcommand.
+    """
+    parser.add_argument(
+        "-p",
+        "--vault-password-file",
+        type=str,
+        default=None if defaults else argparse.SUPPRESS,
+        help="Path to vault password file, or an executable that prints the password",
+    )
+    parser.add_argument(
+        "--vault-id",
+        type=str,
+        default=None if defaults else argparse.SUPPRESS,
+        help="Vault id as [id@]source, e.g. prod@vault-keyring-client.py",
+    )
+    parser.add_argument(
+        "--secret-ttl",
+        type=int,
+        default=password.DEFAULT_SECRET_TTL if defaults else argparse.SUPPRESS,
+        help=(
+            "Seconds to keep a password from an executable in the kernel keyring "
+            f"(default: {password.DEFAULT_SECRET_TTL}, 0 disables)"
+        ),
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=governor.positive_int,
+        default=None if defaults else argparse.SUPPRESS,
+        help="Number of crypto worker processes (default: CPU count, 1 disables parallelism)",
+    )
+
+
+def add_progress_arguments(parser):
+    """Event stream and progress bar options of the file processing commands"""
+    parser.add_argument(
+        "--events",
+        choices=["jsonl"],
+        help="emit machine readable progress events in this format",
+    )
+    parser.add_argument(
+        "--events-fd",
+        type=int,
+        default=1,
+        metavar="FD",
+        help=(
+            "file descriptor to write events to (default: 1, stdout; "
+            "other output then goes to stderr)"
+        ),
+    )
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        help="show a progress bar on stderr when it is a terminal",
+    )
+
+
+def add_resource_arguments(parser):
+    """Limits for running next to other jobs on shared hosts, see pilfer.governor"""
+    group = parser.add_argument_group("resource limits")
+    group.add_argument(
+        "--max-workers",
+        type=governor.positive_int,
+        metavar="N",
+        help="cap on crypto worker processes and I/O threads",
+    )
+    group.add_argument(
+        "--max-in-flight",
+        type=governor.parse_size,
+        metavar="SIZE",
+        help="vault data each pipeline stage may hold in memory, e.g. 64M",
+    )
+    group.add_argument(
+        "--io-limit",
+        type=governor.parse_size,
+        metavar="RATE",
+        help="bytes per second to read and write, e.g. 20M",
+    )
+    group.add_argument(
+        "--nice", type=int, metavar="N", help="add N to the CPU niceness"
+    )
+    group.add_argument(
+        "--ionice",
+        choices=sorted(governor.IO_CLASSES),
+        help="I/O scheduling class (Linux)",
+    )
+
+
+def governor_from_args(args):
+    """Activate the resource limits given by add_resource_arguments() options"""
+    if not hasattr(args, "max_workers"):
+        return
+    governor.configure(
+        max_workers=args.max_workers,
+        max_in_flight_bytes=args.max_in_flight,
+        io_rate=args.io_limit,
+        nice=args.nice,
+        io_class=governor.IO_CLASSES.get(args.ionice),
+    )
+
+
+def progress_from_args(args, operation, stdout):
+    """Build the Progress for a command from its --events/--progress options"""
+    reporters = []
+    if args.events == "jsonl":
+        if args.events_fd == 1:
+            stream = stdout
+        else:
+            stream = open(args.events_fd, "w", closefd=False)
+        reporters.append(events.JsonLinesReporter(stream))
+    if args.progress and sys.stderr.isatty():
+        reporters.append(events.ProgressBar(sys.stderr))
+    return events.Progress(operation, reporters)
+
+
 def main():
     """Main CLI entry point for pilfer"""
     # Parse Args
@@ -266,34 +759,452 @@ def main():
             "for search/editing, then re-encrypt them when done"
         ),
     )
-    parser.add_argument(
-        "action",
-        choices=["open", "close"],
-        help="'open' to decrypt all vault files, 'close' to re-encrypt modified files",
+    add_common_arguments(parser)
+    subparsers = parser.add_subparsers(dest="action", metavar="ACTION")
+    subparsers.required = True
+
+    common = argparse.ArgumentParser(add_help=False)
+    add_common_arguments(common, defaults=False)
+
+    open_parser = subparsers.add_parser(
+        "open", parents=[common], help="decrypt all vault files in place"
     )
-    parser.add_argument(
-        "-p", "--vault-password-file", type=str, help="Path to vault password file"
+    add_progress_arguments(open_parser)
+    add_resource_arguments(open_parser)
+    open_parser.add_argument(
+        "--shadow",
+        metavar="DIR",
+        help=(
+            "write decrypted copies to a mirror tree in DIR (ideally on tmpfs) "
+            "and leave the project untouched; refreshes an existing one"
+        ),
+    )
+    close_parser = subparsers.add_parser(
+        "close", parents=[common], help="re-encrypt modified files, restore the rest"
+    )
+    add_progress_arguments(close_parser)
+    add_resource_arguments(close_parser)
+    close_parser.add_argument(
+        "--shadow", metavar="DIR", help="delete the shadow tree in DIR"
+    )
+    close_parser.add_argument(
+        "--semantic",
+        action="store_true",
+        help=(
+            "keep the original ciphertext of YAML/JSON files whose data is "
+            "unchanged, even if their bytes differ"
+        ),
+    )
+    close_parser.add_argument(
+        "--session-salt",
+        action="store_true",
+        help=(
+            "encrypt all modified files with one salt for this close: one key "
+            "derivation instead of one per file, but the files share a keystream"
+        ),
+    )
+    verify_parser = subparsers.add_parser(
+        "verify",
+        parents=[common],
+        help="check every vault decrypts and its HMAC is intact, writing nothing",
+    )
+    verify_parser.add_argument(
+        "--format",
+        choices=["text", "json"],
+        default="text",
+        help="report format (default: text)",
+    )
+    add_progress_arguments(verify_parser)
+    add_resource_arguments(verify_parser)
+    diff_parser = subparsers.add_parser(
+        "diff",
+        parents=[common],
+        help="show plaintext diffs of vault files between revisions",
+    )
+    diff_parser.add_argument(
+        "rev_range",
+        nargs="?",
+        help="revision range such as A..B, or one revision to compare with the working tree",
+    )
+    diff_parser.add_argument("paths", nargs="*", help="limit the diff to these paths")
+    diff_parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="don't read or update the encrypted decrypted-blob cache",
+    )
+    log_grep_parser = subparsers.add_parser(
+        "log-grep",
+        parents=[common],
+        help="search the plaintext of every vault blob in git history",
+    )
+    log_grep_parser.add_argument("pattern", help="regular expression to search for")
+    log_grep_parser.add_argument(
+        "rev_range",
+        nargs="?",
+        help="revisions to search, as for git rev-list (default: all refs)",
+    )
+    log_grep_parser.add_argument(
+        "-i", "--ignore-case", action="store_true", help="match case-insensitively"
+    )
+    log_grep_parser.add_argument(
+        "-F",
+        "--fixed-strings",
+        action="store_true",
+        help="treat the pattern as a literal string",
+    )
+    log_grep_parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="don't read or update the encrypted decrypted-blob cache",
+    )
+    log_grep_parser.add_argument(
+        "--format",
+        choices=["text", "jsonl"],
+        default="text",
+        help="output format (default: text)",
+    )
+    export_parser = subparsers.add_parser(
+        "export",
+        parents=[common],
+        help="write the plaintext of every vault file to one tar or JSON-lines stream",
+    )
+    export_parser.add_argument(
+        "--format",
+        choices=["tar", "jsonl"],
+        default="tar",
+        help="output format (default: tar)",
+    )
+    export_parser.add_argument(
+        "-o",
+        "--output",
+        default="-",
+        metavar="FILE",
+        help="file to write, outside the project (default: -, stdout)",
+    )
+    export_parser.add_argument(
+        "--encrypt",
+        action="store_true",
+        help="encrypt the whole export as one vault file with the vault password",
+    )
+    add_progress_arguments(export_parser)
+    add_resource_arguments(export_parser)
+    index_parser = subparsers.add_parser(
+        "index",
+        parents=[common],
+        help="build or refresh the encrypted index of vault variable names",
+    )
+    index_parser.add_argument(
+        "--values",
+        action="store_true",
+        help="also index HMACs of the values, for find-var --value",
+    )
+    add_progress_arguments(index_parser)
+    add_resource_arguments(index_parser)
+    find_var_parser = subparsers.add_parser(
+        "find-var",
+        parents=[common],
+        help="list the vault files defining a variable, using the index",
+    )
+    find_var_parser.add_argument(
+        "name",
+        help="variable name, dotted key path (db.password) or glob (db_*)",
+    )
+    find_var_parser.add_argument(
+        "--value", help="only where the variable has this value (needs --values)"
     )
+    find_var_parser.add_argument(
+        "--format",
+        choices=["text", "jsonl"],
+        default="text",
+        help="output format (default: text)",
+    )
+    status_parser = subparsers.add_parser(
+        "status",
+        parents=[common],
+        help="list modified, missing and new files of the open session using stat only",
+    )
+    status_parser.add_argument(
+        "--all", action="store_true", help="also list unchanged files"
+    )
+    status_parser.add_argument(
+        "--no-new",
+        action="store_true",
+        help="skip the directory walk that looks for new files",
+    )
+    status_parser.add_argument(
+        "--format",
+        choices=["text", "jsonl"],
+        default="text",
+        help="report format (default: text)",
+    )
+    subparsers.add_parser(
+        "check-staged",
+        parents=[common],
+        help="fail if a file decrypted by pilfer is staged as plaintext (pre-commit)",
+    )
+    subparsers.add_parser(
+        "git-filter",
+        parents=[common],
+        help="serve git's long-running filter.<driver>.process protocol",
+    )
+
     args = parser.parse_args()
+    password.secret_ttl = args.secret_ttl
+    # before any worker process or thread exists, so they all inherit it
+    governor_from_args(args)
 
+    events_on_stdout = getattr(args, "events", None) and args.events_fd == 1
+    export_on_stdout = args.action == "export" and args.output == "-"
+    if events_on_stdout and export_on_stdout:
+        parser.error("export to stdout needs --events-fd other than 1")
+
+    stdout = sys.stdout
+    with contextlib.ExitStack() as stack:
+        if events_on_stdout or export_on_stdout:
+            # stdout carries the event stream or export, keep everything else off it
+            stack.enter_context(contextlib.redirect_stdout(sys.stderr))
+        try:
+            return run_action(args, stdout)
+        except subprocess.CalledProcessError as e:
+            if args.action not in GIT_ACTIONS:
+                raise
+            # git has already explained what went wrong on stderr
+            print(
+                f"❌ pilfer {args.action}: git exited with status {e.returncode}",
+                file=sys.stderr,
+            )
+            return 2
+
+
+def run_action(args, stdout):
+    """Run the subcommand selected in args; stdout is where events may go"""
     # Open / Close Vault
-    if args.action == "open":
-        # check for an existing encrypted file list
-        # if one exists, decrypt the files
-        # if it doesn't, make one
-        if Path(temp_vault_file_list_path).is_file():
-            # print "path exists, skipping file creation"
-            decrypt_vault_files(args.vault_password_file)
-        else:
-            write_vaulted_file_list()
-            decrypt_vault_files(args.vault_password_file)
+    if args.action == "open" and args.shadow:
+        from pilfer import shadow as shadow_tree
+
+        try:
+            with progress_from_args(args, "open", stdout) as progress:
+                counts = shadow_tree.build(
+                    args.shadow,
+                    read_vault_password(args.vault_password_file, args.vault_id),
+                    exclude_dirs=[temp_hidden_encrypted_copies_directory_path],
+                    jobs=args.jobs,
+                    progress=progress,
+                )
+        except shadow_tree.UnsafeShadowDirectory as e:
+            print(f"❌ {e}", file=sys.stderr)
+            return 2
+        print(
+            f"✅ Shadow tree in {args.shadow}: {counts['decrypted']} decrypted, "
+            f"{counts['unchanged']} unchanged, {counts['removed']} removed."
+        )
+
+    elif args.action == "close" and args.shadow:
+        from pilfer import shadow as shadow_tree
+
+        try:
+            shadow_tree.remove(args.shadow)
+        except shadow_tree.NotAShadowTree as e:
+            print(f"❌ {e}", file=sys.stderr)
+            return 2
+        password.forget_vault_password(
+            *vault_password_source(args.vault_password_file, args.vault_id)
+        )
+        print(f"✅ Shadow tree {args.shadow} removed.")
+
+    elif args.action == "open":
+        # decrypt while the walk is still discovering files; files opened by
+        # an earlier, interrupted open are plaintext already and are skipped
+        with progress_from_args(args, "open", stdout) as progress:
+            decrypt_vault_files(
+                args.vault_password_file,
+                discover_vault_files(),
+                jobs=args.jobs,
+                vault_id=args.vault_id,
+                progress=progress,
+            )
 
     elif args.action == "close":
-        modified_count = recrypt_vault_files(args.vault_password_file)
+        if opened_vault_file_list_path() is None:
+            print("No vault file list found. Run 'pilfer open' first.")
+            return 1
+        with progress_from_args(args, "close", stdout) as progress:
+            modified_count = recrypt_vault_files(
+                args.vault_password_file,
+                jobs=args.jobs,
+                vault_id=args.vault_id,
+                progress=progress,
+                session_salt=args.session_salt,
+                semantic=args.semantic,
+            )
+        if progress.failed_files:
+            print(
+                f"❌ {progress.failed_files} vault files could not be re-encrypted "
+                "and are still open. Fix them and run 'pilfer close' again.",
+                file=sys.stderr,
+            )
+            return 1
+        # the open/close session is over, drop the cached secret
+        password.forget_vault_password(
+            *vault_password_source(args.vault_password_file, args.vault_id)
+        )
         print(
             f"✅ Vault files re-encrypted. {modified_count} modified files have been updated."
         )
 
+    elif args.action == "verify":
+        with progress_from_args(args, "verify", stdout) as progress:
+            results = verify_vault_files(
+                args.vault_password_file,
+                jobs=args.jobs,
+                vault_id=args.vault_id,
+                progress=progress,
+            )
+        print_verify_report(results, args.format)
+        if any(result["status"] != "ok" for result in results):
+            return 1
+
+    elif args.action == "diff":
+        sys.stdout.write(
+            diff.vault_diff(
+                read_vault_password(args.vault_password_file, args.vault_id),
+                args.rev_range,
+                args.paths,
+                jobs=args.jobs,
+                use_cache=not args.no_cache,
+            )
+        )
+
+    elif args.action == "log-grep":
+        from pilfer import loggrep
+
+        matched = print_log_grep_results(
+            loggrep.log_grep(
+                read_vault_password(args.vault_password_file, args.vault_id),
+                args.pattern,
+                args.rev_range,
+                jobs=args.jobs,
+                use_cache=not args.no_cache,
+                ignore_case=args.ignore_case,
+                fixed_strings=args.fixed_strings,
+            ),
+            args.format,
+        )
+        # like grep, exit 1 when nothing matched
+        if not matched:
+            return 1
+
+    elif args.action == "export":
+        from pilfer import export, shadow
+
+        if args.output != "-" and shadow.is_inside(args.output, os.getcwd()):
+            print("❌ The export must be written outside the project.", file=sys.stderr)
+            return 2
+        vault_password = read_vault_password(args.vault_password_file, args.vault_id)
+        with contextlib.ExitStack() as stack:
+            if args.output == "-":
+                output = stdout.buffer
+            else:
+                fd = os.open(args.output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                output = stack.enter_context(os.fdopen(fd, "wb"))
+            try:
+                with progress_from_args(args, "export", stdout) as progress:
+                    count = export.export(
+                        vault_password,
+                        output,
+                        args.format,
+                        exclude_dirs=[temp_hidden_encrypted_copies_directory_path],
+                        encrypt=args.encrypt,
+                        jobs=args.jobs,
+                        progress=progress,
+                    )
+            except BrokenPipeError:
+                # the reader (e.g. head) went away; stop quietly, and send
+                # anything still buffered for it nowhere
+                os.dup2(os.open(os.devnull, os.O_WRONLY), output.fileno())
+                return 1
+        print(f"✅ Exported {count} vault files.", file=sys.stderr)
+
+    elif args.action == "index":
+        if opened_vault_file_list_path() is not None:
+            print("Vault files are open. Run 'pilfer close' before indexing.")
+            return 1
+        from pilfer import varindex
+
+        with progress_from_args(args, "index", stdout) as progress:
+            _, counts = varindex.build(
+                read_vault_password(args.vault_password_file, args.vault_id),
+                exclude_dirs=[temp_hidden_encrypted_copies_directory_path],
+                values=args.values,
+                jobs=args.jobs,
+                progress=progress,
+            )
+        print(
+            f"✅ Indexed {counts['indexed']} vault files "
+            f"({counts['unchanged']} unchanged, {counts['removed']} removed)."
+        )
+
+    elif args.action == "find-var":
+        from pilfer import varindex
+
+        vault_password = read_vault_password(args.vault_password_file, args.vault_id)
+        try:
+            found = list(
+                varindex.load(vault_password).find(
+                    args.name, args.value, varindex.value_key(vault_password)
+                )
+            )
+        except (FileNotFoundError, ValueError) as e:
+            print(f"❌ {e}", file=sys.stderr)
+            return 2
+        for result in found:
+            if args.format == "jsonl":
+                print(json.dumps(result))
+            else:
+                print(f"{result['path']}: {result['key']}")
+        if not found:
+            return 1
+
+    elif args.action == "status":
+        if opened_vault_file_list_path() is None:
+            print("No vault file list found. Nothing is open.")
+            return 1
+        print_status_report(
+            manifest.status(
+                opened_vault_file_list_path(),
+                exclude_dirs=[temp_hidden_encrypted_copies_directory_path],
+                include_new=not args.no_new,
+            ),
+            args.format,
+            args.all,
+        )
+
+    elif args.action == "check-staged":
+        from pilfer import staged
+
+        # without an open session, vaults in HEAD are still checked
+        leaked = staged.plaintext_staged(opened_vault_file_list_path())
+        if leaked:
+            print("❌ Decrypted vault files are staged for commit:", file=sys.stderr)
+            for path in leaked:
+                print(f"  {path}", file=sys.stderr)
+            print(
+                "Run 'pilfer close' or 'git restore --staged <file>' first.",
+                file=sys.stderr,
+            )
+            return 1
+
+    elif args.action == "git-filter":
+        vault_filter = gitfilter.VaultFilter(
+            read_vault_password(args.vault_password_file, args.vault_id)
+        )
+        try:
+            gitfilter.serve(vault_filter, sys.stdin.buffer, sys.stdout.buffer)
+        finally:
+            vault_filter.close()
+
+    return 0
+
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
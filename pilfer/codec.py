@@ -0,0 +1,193 @@
+"""
+A codec for the `$ANSIBLE_VAULT` 1.1/1.2 AES256 format.
+
+VaultLib routes every call through Ansible's generic machinery: secret
+matching, envelope parsing with tagged copies of the data, and new PBKDF2,
+cipher and HMAC objects per call. VaultCodec is bound to one password and
+handles only the AES256 format that every current vault uses:
+
+    $ANSIBLE_VAULT;1.1;AES256            (1.2 adds ";<vault id>")
+    hex( hex(salt) \\n hex(hmac) \\n hex(ciphertext) ), wrapped at 80 columns
+
+    key1 | key2 | iv = PBKDF2-HMAC-SHA256(password, salt, 10000 iterations, 80 bytes)
+    ciphertext = AES-256-CTR(key1, iv, PKCS7-padded plaintext)
+    hmac = HMAC-SHA256(key2, ciphertext)
+
+The KDF runs through cryptography's OpenSSL binding (about twice as fast as
+hashlib.pbkdf2_hmac on OpenSSL 3 builds) and derived keys are cached per
+salt. Vaults in any other format raise UnsupportedVaultFormat, or are handed
+to the fallback (normally a VaultLib) when the codec was given one.
+"""
+
+import binascii
+import hashlib
+import hmac
+import os
+from collections import OrderedDict
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+HEADER = b"$ANSIBLE_VAULT"
+CIPHER_NAME = b"AES256"
+SUPPORTED_VERSIONS = (b"1.1", b"1.2")
+
+KDF_ITERATIONS = 10000
+KEY_LENGTH = 32
+IV_LENGTH = 16
+SALT_LENGTH = 32
+BLOCK_SIZE = 16
+LINE_WIDTH = 80
+
+# derived keys kept per codec; decrypting a tree normally sees each salt once,
+# so this only needs to cover files that share a salt
+KEY_CACHE_SIZE = 1024
+
+_backend = default_backend()
+
+
+class UnsupportedVaultFormat(ValueError):
+    """The data is not a vault this codec handles (VaultLib may still)"""
+
+
+class VaultIntegrityError(ValueError):
+    """The HMAC did not match: wrong password, or the vault was modified"""
+
+
+def parse_envelope(data):
+    """Split vault data into (version, vault id, hexlified payload)"""
+    header, _, body = bytes(data).partition(b"\n")
+    fields = header.strip().split(b";")
+    if len(fields) < 3 or fields[0] != HEADER:
+        raise UnsupportedVaultFormat("not vault encrypted data")
+    version, cipher_name = fields[1].strip(), fields[2].strip()
+    if version not in SUPPORTED_VERSIONS or cipher_name != CIPHER_NAME:
+        raise UnsupportedVaultFormat(
+            "unsupported vault format %s;%s"
+            % (
+                version.decode("ascii", "replace"),
+                cipher_name.decode("ascii", "replace"),
+            )
+        )
+    vault_id = fields[3].strip().decode("utf-8") if len(fields) > 3 else None
+    # the payload is hex, so dropping all whitespace also handles CRLF files
+    return version.decode("ascii"), vault_id, b"".join(body.split())
+
+
+def format_envelope(payload, vault_id=None):
+    """Add the header to a hexlified payload and wrap it at 80 columns"""
+    if vault_id and vault_id != "default":
+        header = b";".join([HEADER, b"1.2", CIPHER_NAME, vault_id.encode("utf-8")])
+    else:
+        header = b";".join([HEADER, b"1.1", CIPHER_NAME])
+    lines = [header]
+    lines += [payload[i : i + LINE_WIDTH] for i in range(0, len(payload), LINE_WIDTH)]
+    lines.append(b"")
+    return b"\n".join(lines)
+
+
+class VaultCodec:
+    """Encrypts and decrypts AES256 vaults with one password"""
+
+    def __init__(self, vault_password, fallback=None, key_cache_size=KEY_CACHE_SIZE):
+        if isinstance(vault_password, str):
+            vault_password = vault_password.encode("utf-8")
+        self.password = vault_password
+        self.key_cache_size = key_cache_size
+        self._keys = OrderedDict()
+        # called with the password to build a decrypter for other formats
+        self._fallback_factory = fallback
+        self._fallback = None
+
+    def derive_keys(self, salt):
+        """Return (cipher key, HMAC key, counter IV) for salt"""
+        keys = self._keys.get(salt)
+        if keys is not None:
+            self._keys.move_to_end(salt)
+            return keys
+
+        derived = PBKDF2HMAC(
+            algorithm=hashes.SHA256(),
+            length=2 * KEY_LENGTH + IV_LENGTH,
+            salt=salt,
+            iterations=KDF_ITERATIONS,
+            backend=_backend,
+        ).derive(self.password)
+        keys = (
+            derived[:KEY_LENGTH],
+            derived[KEY_LENGTH : 2 * KEY_LENGTH],
+            derived[2 * KEY_LENGTH :],
+        )
+        self._keys[salt] = keys
+        if len(self._keys) > self.key_cache_size:
+            self._keys.popitem(last=False)
+        return keys
+
+    def decrypt(self, data):
+        """Decrypt vault data, returning the plaintext bytes"""
+        try:
+            _, _, payload = parse_envelope(data)
+        except UnsupportedVaultFormat:
+            if self._fallback_factory is None:
+                raise
+            if self._fallback is None:
+                self._fallback = self._fallback_factory(self.password)
+            return self._fallback.decrypt(data)
+        try:
+            inner = binascii.unhexlify(payload)
+            first = inner.index(b"\n")
+            second = inner.index(b"\n", first + 1)
+            salt = binascii.unhexlify(inner[:first])
+            expected_hmac = binascii.unhexlify(inner[first + 1 : second])
+            ciphertext = binascii.unhexlify(inner[second + 1 :])
+        except (binascii.Error, ValueError) as e:
+            raise ValueError("Vault format error: %s" % e) from e
+
+        key1, key2, iv = self.derive_keys(salt)
+        if not hmac.compare_digest(
+            hmac.new(key2, ciphertext, hashlib.sha256).digest(), expected_hmac
+        ):
+            raise VaultIntegrityError(
+                "HMAC verification failed: wrong vault password or modified vault"
+            )
+
+        decryptor = Cipher(algorithms.AES(key1), modes.CTR(iv), _backend).decryptor()
+        padded = decryptor.update(ciphertext) + decryptor.finalize()
+        return _unpad(padded)
+
+    def encrypt(self, plaintext, vault_id=None, salt=None):
+        """Encrypt plaintext (bytes or str) with a fresh salt, unless one is given"""
+        if isinstance(plaintext, str):
+            plaintext = plaintext.encode("utf-8")
+        if salt is None:
+            salt = os.urandom(SALT_LENGTH)
+        key1, key2, iv = self.derive_keys(salt)
+
+        encryptor = Cipher(algorithms.AES(key1), modes.CTR(iv), _backend).encryptor()
+        ciphertext = encryptor.update(_pad(plaintext)) + encryptor.finalize()
+        digest = hmac.new(key2, ciphertext, hashlib.sha256).digest()
+
+        payload = binascii.hexlify(
+            b"\n".join(
+                [
+                    binascii.hexlify(salt),
+                    binascii.hexlify(digest),
+                    binascii.hexlify(ciphertext),
+                ]
+            )
+        )
+        return format_envelope(payload, vault_id)
+
+
+def _pad(data):
+    padding = BLOCK_SIZE - len(data) % BLOCK_SIZE
+    return data + bytes([padding]) * padding
+
+
+def _unpad(data):
+    padding = data[-1] if data else 0
+    if not 1 <= padding <= BLOCK_SIZE or data[-padding:] != bytes([padding]) * padding:
+        raise ValueError("Vault format error: invalid padding")
+    return data[:-padding]
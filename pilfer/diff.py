@@ -0,0 +1,166 @@
+"""
+Plaintext diffs of vault files between git revisions.
+
+All blobs are fetched through one `git cat-file --batch` process, vault blobs
+are decrypted on the crypto worker pool and the plaintexts are cached by blob
+SHA, so repeated diffs over the same history barely touch the KDF.
+"""
+
+import difflib
+import os
+import sys
+
+from pilfer import git, pipeline
+
+
+def parse_raw_diff(output):
+    """Parse `git diff --raw -z` output into (old_sha, new_sha, status, path)"""
+    fields = output.split(b"\0")
+    entries = []
+    index = 0
+    while index + 1 < len(fields):
+        header = fields[index].decode("ascii")
+        path = os.fsdecode(fields[index + 1])
+        index += 2
+
+        _, _, old_sha, new_sha, status = header.lstrip(":").split(" ")
+        entries.append((old_sha, new_sha, status[0], path))
+    return entries
+
+
+def unified_diff(path, old_plaintext, new_plaintext):
+    """Render a git-style unified diff between two plaintexts"""
+    fromfile = "a/" + path if old_plaintext is not None else "/dev/null"
+    tofile = "b/" + path if new_plaintext is not None else "/dev/null"
+    lines = difflib.unified_diff(
+        _text_lines(old_plaintext),
+        _text_lines(new_plaintext),
+        fromfile=fromfile,
+        tofile=tofile,
+    )
+
+    rendered = []
+    for line in lines:
+        if not line.endswith("\n"):
+            line += "\n\\ No newline at end of file\n"
+        rendered.append(line)
+    if not rendered:
+        return ""
+    return f"diff --git a/{path} b/{path}\n" + "".join(rendered)
+
+
+def _text_lines(plaintext):
+    if plaintext is None:
+        return []
+    return plaintext.decode("utf-8", errors="replace").splitlines(keepends=True)
+
+
+def vault_diff(vault_password, rev_range=None, paths=(), jobs=None, use_cache=True):
+    """Return the plaintext diff of every changed vault file as a string
+
+    rev_range is anything `git diff` accepts ("A..B", a single revision to
+    compare against the working tree, or None for index vs working tree).
+    Files that are vault encrypted on either side of the diff are included,
+    so a file that is currently opened by pilfer diffs as plaintext.
+    """
+    toplevel, git_dir = git.repository_paths()
+
+    args = ["diff", "--raw", "-z", "--no-abbrev", "--no-renames"]
+    if rev_range:
+        args.append(rev_range)
+    entries = parse_raw_diff(git.git_output(args + ["--"] + list(paths)))
+
+    # fetch both sides of every change; working tree files have a null SHA
+    contents = {}
+    sides = []
+    # blobs of changes that involve a vault, whose contents must be kept
+    needed = set()
+    with git.CatFileBatch() as cat_file:
+        for old_sha, new_sha, status, path in entries:
+            old_side = _fetch_blob(cat_file, contents, old_sha)
+            if new_sha == git.NULL_SHA and status != "D":
+                new_side = _read_working_tree(contents, os.path.join(toplevel, path))
+            else:
+                new_side = _fetch_blob(cat_file, contents, new_sha)
+
+            if _is_vault(contents, old_side) or _is_vault(contents, new_side):
+                sides.append((path, old_side, new_side))
+                needed.update(sha for sha in (old_side, new_side) if sha)
+                continue
+            # not a vault change: drop the contents now rather than holding
+            # every changed file of the range in memory
+            for sha in (old_side, new_side):
+                if sha and sha not in needed:
+                    contents.pop(sha, None)
+
+    vault = pipeline.vault_codec(vault_password)
+    cache = git.BlobCache.for_repository(git_dir, vault)
+    if use_cache:
+        cache.load()
+
+    plaintexts = {}
+    to_decrypt = []
+    for sha in {sha for _, old, new in sides for sha in (old, new) if sha}:
+        if not _is_vault(contents, sha):
+            plaintexts[sha] = contents[sha]
+        elif sha in cache:
+            plaintexts[sha] = cache.get(sha)
+        else:
+            to_decrypt.append((sha, contents[sha]))
+
+    def report_failure(args, e):
+        print(f"Failed to decrypt blob {args[0]}: {e}", file=sys.stderr)
+
+    if to_decrypt:
+        jobs = min(jobs or pipeline.default_jobs(), len(to_decrypt))
+        with pipeline.crypto_executor(vault_password, jobs) as crypto_pool:
+            decrypts = pipeline.stream_map(
+                pipeline.decrypt_in_worker, to_decrypt, crypto_pool
+            )
+            for (sha, _), plaintext in pipeline.succeeded(decrypts, report_failure):
+                plaintexts[sha] = plaintext
+                cache.put(sha, plaintext)
+
+    if use_cache:
+        cache.save()
+
+    output = []
+    for path, old_side, new_side in sorted(sides):
+        if (old_side and old_side not in plaintexts) or (
+            new_side and new_side not in plaintexts
+        ):
+            continue
+        output.append(
+            unified_diff(
+                path,
+                plaintexts[old_side] if old_side else None,
+                plaintexts[new_side] if new_side else None,
+            )
+        )
+    return "".join(output)
+
+
+def _fetch_blob(cat_file, contents, sha):
+    if sha == git.NULL_SHA:
+        return None
+    if sha not in contents:
+        found = cat_file.get(sha)
+        if found is None:
+            return None
+        contents[sha] = found[2]
+    return sha
+
+
+def _read_working_tree(contents, path):
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except (IOError, OSError):
+        return None
+    sha = git.blob_sha(data)
+    contents[sha] = data
+    return sha
+
+
+def _is_vault(contents, sha):
+    return sha is not None and contents[sha].startswith(pipeline.VAULT_HEADER)
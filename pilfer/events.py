@@ -0,0 +1,272 @@
+"""
+Progress reporting for long running commands.
+
+A Progress tracks the files flowing through one open, close or verify run and
+hands events to any number of reporters:
+
+    {"event": "start", "operation": "open", "elapsed": 0.0, "time": 1700000000.0}
+    {"event": "done", "path": "group_vars/all/vault.yml", "bytes": 1234,
+     "duration": 0.012, "elapsed": 0.4}
+    {"event": "failed", "path": "broken.yml", "error": "...", "duration": 0.003,
+     "elapsed": 0.5}
+    {"event": "scan", "files": 5000, "elapsed": 1.2}
+    {"event": "throughput", "files": 900, "failed": 0, "bytes": 1110000,
+     "files_per_s": 310.2, "bytes_per_s": 382000.0, "elapsed": 3.0}
+    {"event": "summary", "operation": "open", "files": 5000, "failed": 1,
+     "bytes": ..., "files_per_s": ..., "bytes_per_s": ..., "elapsed": 16.1}
+
+"scan" is sent once discovery has finished and gives the total number of
+files, so a wrapper can compute an ETA. "bytes" always counts vault
+(encrypted) data: read by open and verify, written by close.
+
+Under resource limits (see pilfer.governor) throughput and summary events
+also carry "throttled_io_s", the seconds spent waiting for the I/O rate
+limit, and "held_items", how often a stage held work back to stay under the
+in-flight data limit.
+
+Everything runs on the thread consuming the pipeline. Throughput events and
+progress bar redraws are rate limited, and the JSON-lines output is flushed
+at most once per interval, so the cost per file is one json.dumps and a
+buffered write.
+"""
+
+import json
+import os
+import sys
+import time
+
+from pilfer import governor
+
+# seconds between throughput events, and the longest events sit unflushed
+DEFAULT_INTERVAL = 1.0
+
+# seconds between progress bar redraws
+PROGRESS_BAR_INTERVAL = 0.1
+
+
+class Progress:
+    """Counts files, bytes and failures of one run and notifies reporters"""
+
+    def __init__(self, operation, reporters=(), interval=DEFAULT_INTERVAL):
+        self.operation = operation
+        self.reporters = list(reporters)
+        self.interval = interval
+        self.files = 0
+        self.failed_files = 0
+        self.bytes = 0
+        self.total = None
+        self.started = {}
+        self.start_time = time.monotonic()
+        self.next_throughput = self.start_time + interval
+        self.last_throughput = (self.start_time, 0, 0)
+        self.emit(
+            {"event": "start", "operation": operation, "time": time.time()},
+            self.start_time,
+        )
+
+    def emit(self, event, now=None):
+        if not self.reporters:
+            return
+        if now is None:
+            now = time.monotonic()
+        event["elapsed"] = round(now - self.start_time, 6)
+        for reporter in self.reporters:
+            reporter.event(event, self)
+
+    def track(self, items, key=None):
+        """Yield items, timing each path from here until done() or failed()
+
+        Wrap the iterable feeding the first pipeline stage; key extracts the
+        path from an item. Once items is exhausted the total is known and a
+        "scan" event is sent.
+        """
+        count = 0
+        for item in items:
+            count += 1
+            self.started[item if key is None else key(item)] = time.monotonic()
+            yield item
+        self.total = count
+        self.emit({"event": "scan", "files": count})
+
+    def done(self, path, size=0, **fields):
+        """Record a file that made it through every stage"""
+        now = time.monotonic()
+        self.files += 1
+        self.bytes += size
+        if self.reporters:
+            event = {
+                "event": "done",
+                "path": os.path.relpath(path),
+                "bytes": size,
+                "duration": round(now - self.started.pop(path, now), 6),
+            }
+            event.update(fields)
+            self.emit(event, now)
+            self.maybe_report_throughput(now)
+        else:
+            self.started.pop(path, None)
+
+    def failed(self, path, error):
+        """Record a file that failed in any stage"""
+        now = time.monotonic()
+        self.failed_files += 1
+        if self.reporters:
+            self.emit(
+                {
+                    "event": "failed",
+                    "path": os.path.relpath(path),
+                    "error": str(error),
+                    "duration": round(now - self.started.pop(path, now), 6),
+                },
+                now,
+            )
+            self.maybe_report_throughput(now)
+        else:
+            self.started.pop(path, None)
+
+    def maybe_report_throughput(self, now):
+        if now < self.next_throughput:
+            return
+        last_time, last_files, last_bytes = self.last_throughput
+        window = now - last_time
+        self.emit(
+            {
+                "event": "throughput",
+                "files": self.files,
+                "failed": self.failed_files,
+                "bytes": self.bytes,
+                "files_per_s": round((self.files - last_files) / window, 3),
+                "bytes_per_s": round((self.bytes - last_bytes) / window, 3),
+                **governor.current.stats(),
+            },
+            now,
+        )
+        self.last_throughput = (now, self.files, self.bytes)
+        self.next_throughput = now + self.interval
+
+    def finish(self):
+        """Send the summary event and close the reporters"""
+        now = time.monotonic()
+        elapsed = max(now - self.start_time, 1e-9)
+        self.emit(
+            {
+                "event": "summary",
+                "operation": self.operation,
+                "files": self.files,
+                "failed": self.failed_files,
+                "bytes": self.bytes,
+                "files_per_s": round(self.files / elapsed, 3),
+                "bytes_per_s": round(self.bytes / elapsed, 3),
+                **governor.current.stats(),
+            },
+            now,
+        )
+        for reporter in self.reporters:
+            reporter.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.finish()
+        return False
+
+
+class JsonLinesReporter:
+    """Writes every event as one line of JSON
+
+    If the consumer goes away (e.g. ``| head -3``) the reporter warns once on
+    stderr and stops writing, the run itself carries on.
+    """
+
+    def __init__(self, stream, interval=DEFAULT_INTERVAL):
+        self.stream = stream
+        self.interval = interval
+        self.next_flush = 0.0
+
+    def event(self, event, progress):
+        if self.stream is None:
+            return
+        try:
+            self.stream.write(json.dumps(event, separators=(",", ":")) + "\n")
+            # flushing per file would cost a syscall each; wrappers only need
+            # the stream to be current to within an interval
+            now = time.monotonic()
+            if event["event"] != "done" or now >= self.next_flush:
+                self.stream.flush()
+                self.next_flush = now + self.interval
+        except OSError as e:
+            self._stream_failed(e)
+
+    def close(self):
+        if self.stream is None:
+            return
+        try:
+            self.stream.flush()
+        except OSError as e:
+            self._stream_failed(e)
+
+    def _stream_failed(self, error):
+        print(
+            f"Warning: Event stream closed, no further events: {error}", file=sys.stderr
+        )
+        stream, self.stream = self.stream, None
+        try:
+            # point the descriptor at /dev/null so the data still buffered in
+            # the stream cannot fail again when it is flushed at exit
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, stream.fileno())
+            os.close(devnull)
+        except (AttributeError, OSError, ValueError):
+            pass
+
+
+class ProgressBar:
+    """A single redrawn status line for a terminal
+
+    Shows files/s and MB/s, plus a bar and ETA once the total is known.
+    """
+
+    WIDTH = 30
+
+    def __init__(self, stream=None, interval=PROGRESS_BAR_INTERVAL):
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.next_draw = 0.0
+        self.last_width = 0
+
+    def event(self, event, progress):
+        now = time.monotonic()
+        if event["event"] in ("done", "failed") and now < self.next_draw:
+            return
+        self.next_draw = now + self.interval
+        self.draw(progress, now)
+
+    def draw(self, progress, now):
+        elapsed = max(now - progress.start_time, 1e-9)
+        processed = progress.files + progress.failed_files
+        files_per_s = processed / elapsed
+        megabytes_per_s = progress.bytes / elapsed / 1e6
+
+        if progress.total:
+            filled = int(self.WIDTH * processed / progress.total)
+            remaining = (progress.total - processed) / files_per_s if processed else 0
+            line = (
+                f"{progress.operation} [{'#' * filled}{'.' * (self.WIDTH - filled)}] "
+                f"{processed}/{progress.total} files"
+            )
+            eta = f"  ETA {remaining:.0f}s"
+        else:
+            line = f"{progress.operation} {processed} files"
+            eta = ""
+        if progress.failed_files:
+            line += f" ({progress.failed_files} failed)"
+        line += f"  {files_per_s:.0f} files/s  {megabytes_per_s:.1f} MB/s" + eta
+
+        self.stream.write("\r" + line.ljust(self.last_width))
+        self.stream.flush()
+        self.last_width = len(line)
+
+    def close(self):
+        self.stream.write("\n")
+        self.stream.flush()
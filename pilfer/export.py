@@ -0,0 +1,149 @@
+"""
+Export the plaintext of every vault file as one tar or JSON-lines stream.
+
+For secret scanners and audit tools that want a single input: vaults are
+discovered and read on I/O threads and decrypted on the crypto worker pool,
+and each plaintext is written to the output stream as soon as it is ready,
+in completion order. The pipeline keeps a bounded number of files in flight,
+so memory use does not grow with the size of the project, and nothing in the
+project is written, stashed or re-hashed.
+
+JSON-lines records look like
+
+    {"path": "group_vars/all/vault.yml", "plaintext": "db_password: ...\\n"}
+
+with "plaintext_base64" instead of "plaintext" for data that is not UTF-8.
+
+With encrypt=True the whole archive is written as a single ansible vault
+file (readable with `ansible-vault view`). The vault format puts the HMAC of
+the ciphertext before it, so the archive is then assembled in memory and
+encrypted once at the end.
+"""
+
+import base64
+import io
+import json
+import os
+import stat
+import sys
+import tarfile
+
+from pilfer import events, governor, pipeline
+
+FORMATS = ("tar", "jsonl")
+
+
+class TarWriter:
+    """Appends files to an uncompressed tar stream"""
+
+    def __init__(self, stream):
+        self.tar = tarfile.open(fileobj=stream, mode="w|", format=tarfile.PAX_FORMAT)
+
+    def write(self, relative_path, plaintext, stat_result):
+        info = tarfile.TarInfo(relative_path)
+        info.size = len(plaintext)
+        info.mode = stat.S_IMODE(stat_result.st_mode)
+        info.mtime = int(stat_result.st_mtime)
+        self.tar.addfile(info, io.BytesIO(plaintext))
+
+    def close(self):
+        self.tar.close()
+
+
+class JsonLinesWriter:
+    """Writes one {"path", "plaintext"} JSON object per file"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, relative_path, plaintext, stat_result):
+        record = {"path": relative_path}
+        try:
+            record["plaintext"] = plaintext.decode("utf-8")
+        except UnicodeDecodeError:
+            record["plaintext_base64"] = base64.b64encode(plaintext).decode("ascii")
+        self.stream.write(json.dumps(record).encode("utf-8") + b"\n")
+
+    def close(self):
+        pass
+
+
+WRITERS = {"tar": TarWriter, "jsonl": JsonLinesWriter}
+
+
+def _read_vault(path):
+    """Return (ciphertext, stat) of a vault file"""
+    with open(path, "rb") as f:
+        stat_result = os.fstat(f.fileno())
+        encrypted_data = f.read()
+    governor.current.throttle_io(len(encrypted_data))
+    return encrypted_data, stat_result
+
+
+def export(
+    vault_password,
+    output,
+    output_format="tar",
+    walk_dir=".",
+    exclude_dirs=(),
+    encrypt=False,
+    jobs=None,
+    progress=None,
+):
+    """Write the plaintext of every vault below walk_dir to output (binary)
+
+    Returns the number of files exported. Files that fail to read or decrypt
+    are reported on stderr and left out.
+    """
+    walk_dir = os.path.abspath(walk_dir)
+    if progress is None:
+        progress = events.Progress("export")
+    buffer = io.BytesIO() if encrypt else None
+    writer = WRITERS[output_format](buffer if encrypt else output)
+    count = 0
+    # stat results of the files being decrypted, for the tar headers
+    stats = {}
+
+    def report_failure(args, e):
+        print(f"Failed to export {args[0]}: {e}", file=sys.stderr)
+        stats.pop(args[0], None)
+        progress.failed(args[0], e)
+
+    def read_vaults(reads):
+        for (path,), (encrypted_data, stat_result) in pipeline.succeeded(
+            reads, report_failure
+        ):
+            stats[path] = stat_result
+            yield path, encrypted_data
+
+    with pipeline.crypto_executor(
+        vault_password, jobs
+    ) as crypto_pool, pipeline.io_executor(jobs) as io_pool:
+        reads = pipeline.stream_map(
+            _read_vault,
+            (
+                (path,)
+                for path in progress.track(
+                    pipeline.threaded_iter(
+                        pipeline.iter_vaulted_files(walk_dir, exclude_dirs)
+                    )
+                )
+            ),
+            io_pool,
+        )
+        decrypts = pipeline.stream_map(
+            pipeline.decrypt_in_worker, read_vaults(reads), crypto_pool
+        )
+        # the only writer, so the output is written sequentially
+        for (path, encrypted_data), plaintext in pipeline.succeeded(
+            decrypts, report_failure
+        ):
+            writer.write(os.path.relpath(path, walk_dir), plaintext, stats.pop(path))
+            count += 1
+            progress.done(path, len(encrypted_data))
+
+    writer.close()
+    if encrypt:
+        output.write(pipeline.vault_codec(vault_password).encrypt(buffer.getvalue()))
+    output.flush()
+    return count
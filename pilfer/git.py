@@ -0,0 +1,182 @@
+"""
+Git plumbing helpers shared by pilfer's history-aware commands.
+
+Blob contents are streamed through a single long-running `git cat-file --batch`
+process instead of one git invocation per object, and decrypted vault blobs
+are remembered by blob SHA in an encrypted cache inside the git directory.
+Blob SHAs are content addresses, so a cached plaintext never goes stale.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import subprocess
+
+NULL_SHA = "0" * 40
+
+BLOB_CACHE_FILE_NAME = "blob-cache.vault"
+
+# bytes of base64 plaintext kept in the blob cache
+MAX_BLOB_CACHE_BYTES = 32 << 20
+# SHAs of blobs known not to be vaults kept in the blob cache
+MAX_NON_VAULT_BLOBS = 100000
+
+
+def git_output(args, cwd=None, stderr=None):
+    """Run git with args and return its stdout as bytes"""
+    return subprocess.run(
+        ["git"] + list(args), cwd=cwd, stdout=subprocess.PIPE, stderr=stderr, check=True
+    ).stdout
+
+
+def repository_paths(cwd=None, stderr=None):
+    """Return (work tree root, absolute git directory) for the repo at cwd"""
+    output = git_output(
+        ["rev-parse", "--show-toplevel", "--absolute-git-dir"], cwd, stderr
+    )
+    toplevel, git_dir = output.decode("utf-8").splitlines()
+    return toplevel, git_dir
+
+
+def blob_sha(data):
+    """The git blob SHA of data, as `git hash-object` would compute it"""
+    header = b"blob %d\0" % len(data)
+    return hashlib.sha1(header + data).hexdigest()
+
+
+class CatFileBatch:
+    """A `git cat-file --batch` process serving any number of object lookups"""
+
+    def __init__(self, cwd=None):
+        self.process = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
+            cwd=cwd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def get(self, object_name):
+        """Return (sha, type, content) for object_name, or None if it is missing"""
+        self.process.stdin.write(object_name.encode("utf-8") + b"\n")
+        self.process.stdin.flush()
+
+        header = self.process.stdout.readline()
+        if not header:
+            raise RuntimeError("git cat-file --batch exited unexpectedly")
+        fields = header.split()
+        if len(fields) != 3:
+            # "<name> missing" or "<name> ambiguous"
+            return None
+
+        sha, object_type, size = fields
+        content = self.process.stdout.read(int(size))
+        self.process.stdout.read(1)  # trailing newline
+        return sha.decode("ascii"), object_type.decode("ascii"), content
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+        self.process.stdout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+class BlobCache:
+    """Decrypted vault blobs keyed by blob SHA, persisted encrypted on disk
+
+    The whole cache is a single vault-encrypted file, so loading or saving
+    it costs one key derivation no matter how many blobs it holds. A cache
+    that cannot be decrypted (e.g. after a password change) starts empty.
+    Blobs known not to be vaults are remembered too, so history searches
+    don't read them again.
+
+    The cache holds at most max_bytes of (base64) plaintext: the least
+    recently used blobs are evicted first. Lookups only reorder entries in
+    memory; the order is persisted whenever the cache is saved anyway. At
+    most max_non_vault non-vault SHAs are kept, the oldest dropped first.
+    """
+
+    def __init__(
+        self,
+        path,
+        vault,
+        max_bytes=MAX_BLOB_CACHE_BYTES,
+        max_non_vault=MAX_NON_VAULT_BLOBS,
+    ):
+        self.path = path
+        self.vault = vault
+        self.max_bytes = max_bytes
+        self.max_non_vault = max_non_vault
+        # sha -> base64 plaintext, least recently used first
+        self.blobs = {}
+        self.size = 0
+        # sha -> None, oldest first
+        self.non_vault = {}
+        self.dirty = False
+
+    @classmethod
+    def for_repository(cls, git_dir, vault):
+        return cls(os.path.join(git_dir, "pilfer", BLOB_CACHE_FILE_NAME), vault)
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = json.loads(self.vault.decrypt(f.read()))
+            self.blobs = data["blobs"]
+            self.non_vault = dict.fromkeys(data.get("non_vault", ()))
+        except Exception:
+            self.blobs = {}
+            self.non_vault = {}
+        self.size = sum(len(encoded) for encoded in self.blobs.values())
+        return self
+
+    def __contains__(self, sha):
+        return sha in self.blobs
+
+    def get(self, sha):
+        plaintext = self.blobs.pop(sha, None)
+        if plaintext is None:
+            return None
+        # most recently used now
+        self.blobs[sha] = plaintext
+        return base64.b64decode(plaintext)
+
+    def put(self, sha, plaintext):
+        encoded = base64.b64encode(plaintext).decode("ascii")
+        self.size -= len(self.blobs.pop(sha, ""))
+        self.blobs[sha] = encoded
+        self.size += len(encoded)
+        while self.size > self.max_bytes and len(self.blobs) > 1:
+            oldest = next(iter(self.blobs))
+            self.size -= len(self.blobs.pop(oldest))
+        self.dirty = True
+
+    def mark_non_vault(self, sha):
+        self.non_vault[sha] = None
+        while len(self.non_vault) > self.max_non_vault:
+            del self.non_vault[next(iter(self.non_vault))]
+        self.dirty = True
+
+    def is_non_vault(self, sha):
+        return sha in self.non_vault
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        data = json.dumps(
+            {"version": 1, "blobs": self.blobs, "non_vault": list(self.non_vault)}
+        ).encode("utf-8")
+        temp_path = self.path + ".tmp"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(self.vault.encrypt(data))
+        os.replace(temp_path, self.path)
+        self.dirty = False
@@ -0,0 +1,189 @@
+"""
+Git long-running filter process for vault files.
+
+Implements git's `filter.<driver>.process` protocol (see gitattributes(5),
+"Long Running Filter Process") so that one pilfer process, holding the vault
+secret, serves every clean and smudge request of a git command instead of
+spawning `ansible-vault` (and running the KDF) once per file.
+
+Smudge decrypts vault blobs into plaintext working tree files. Clean
+re-encrypts plaintext, but hands back the original ciphertext whenever the
+plaintext hash is unchanged, exactly as recrypt_vault_files() does on close,
+so an untouched file never shows up as modified. Like close, it keeps the
+vault id label of the file's smudged or staged version.
+"""
+
+import hashlib
+import sys
+
+from pilfer import git, pipeline
+
+MAX_PACKET_DATA = 65516
+FLUSH = b"0000"
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def read_packet(stream):
+    """Read one pkt-line; returns None for a flush packet"""
+    header = stream.read(4)
+    if not header:
+        raise EOFError
+    if len(header) != 4:
+        raise ProtocolError("truncated packet header")
+    length = int(header, 16)
+    if length == 0:
+        return None
+    if length <= 4:
+        raise ProtocolError(f"invalid packet length {length}")
+    data = stream.read(length - 4)
+    if len(data) != length - 4:
+        raise ProtocolError("truncated packet")
+    return data
+
+
+def read_text_list(stream):
+    """Read text packets up to the next flush, without trailing newlines"""
+    lines = []
+    while True:
+        packet = read_packet(stream)
+        if packet is None:
+            return lines
+        lines.append(packet.decode("utf-8").rstrip("\n"))
+
+
+def read_content(stream):
+    """Read binary packets up to the next flush"""
+    chunks = []
+    while True:
+        packet = read_packet(stream)
+        if packet is None:
+            return b"".join(chunks)
+        chunks.append(packet)
+
+
+def write_packet(stream, data):
+    stream.write(b"%04x" % (len(data) + 4) + data)
+
+
+def write_text_list(stream, lines):
+    for line in lines:
+        write_packet(stream, line.encode("utf-8") + b"\n")
+    stream.write(FLUSH)
+
+
+def write_content(stream, data):
+    view = memoryview(data)
+    for offset in range(0, len(view), MAX_PACKET_DATA):
+        write_packet(stream, view[offset : offset + MAX_PACKET_DATA])
+    stream.write(FLUSH)
+
+
+class VaultFilter:
+    """One git filter session: the vault secret plus a ciphertext cache"""
+
+    def __init__(self, vault_password, cat_file=None):
+        self.vault = pipeline.vault_codec(vault_password)
+        self._cat_file = cat_file
+        # (pathname, plaintext sha256) -> ciphertext, for files seen during
+        # this session
+        self.ciphertexts = {}
+        # pathname -> vault id label of its last smudged or staged version
+        self.labels = {}
+
+    @property
+    def cat_file(self):
+        if self._cat_file is None:
+            self._cat_file = git.CatFileBatch()
+        return self._cat_file
+
+    def smudge(self, pathname, data):
+        """Decrypt a vault blob on its way into the working tree"""
+        if not data.startswith(pipeline.VAULT_HEADER):
+            return data
+        from pilfer import codec
+
+        plaintext = self.vault.decrypt(data)
+        self.ciphertexts[(pathname, hashlib.sha256(plaintext).hexdigest())] = data
+        try:
+            self.labels[pathname] = codec.parse_envelope(data)[1]
+        except codec.UnsupportedVaultFormat:
+            # decrypted by the fallback; re-encrypted as AES256 without a label
+            self.labels[pathname] = None
+        return plaintext
+
+    def clean(self, pathname, data):
+        """Encrypt working tree plaintext on its way into the index"""
+        if data.startswith(pipeline.VAULT_HEADER):
+            return data
+
+        key = (pathname, hashlib.sha256(data).hexdigest())
+        if key not in self.ciphertexts:
+            self._remember_index_version(pathname)
+        if key in self.ciphertexts:
+            # unchanged plaintext, keep the original ciphertext
+            return self.ciphertexts[key]
+
+        encrypted = self.vault.encrypt(data, vault_id=self.labels.get(pathname))
+        self.ciphertexts[key] = encrypted
+        return encrypted
+
+    def _remember_index_version(self, pathname):
+        """Cache the plaintext hash and label of the vault staged for pathname"""
+        found = self.cat_file.get(":" + pathname)
+        if found is None or not found[2].startswith(pipeline.VAULT_HEADER):
+            return
+        try:
+            self.smudge(pathname, found[2])
+        except Exception:
+            # staged with a different secret; it will simply be re-encrypted
+            pass
+
+    def close(self):
+        if self._cat_file is not None:
+            self._cat_file.close()
+
+
+def serve(vault_filter, stdin, stdout):
+    """Run the filter protocol until git closes the pipe"""
+    welcome = read_text_list(stdin)
+    if welcome[:1] != ["git-filter-client"] or "version=2" not in welcome[1:]:
+        raise ProtocolError(f"unexpected handshake {welcome!r}")
+    write_text_list(stdout, ["git-filter-server", "version=2"])
+
+    capabilities = read_text_list(stdin)
+    supported = [
+        capability
+        for capability in ("capability=clean", "capability=smudge")
+        if capability in capabilities
+    ]
+    write_text_list(stdout, supported)
+    stdout.flush()
+
+    handlers = {"clean": vault_filter.clean, "smudge": vault_filter.smudge}
+    while True:
+        try:
+            request = read_text_list(stdin)
+        except EOFError:
+            return
+        metadata = dict(line.split("=", 1) for line in request if "=" in line)
+        content = read_content(stdin)
+
+        command = metadata.get("command")
+        pathname = metadata.get("pathname", "")
+        try:
+            if command not in handlers:
+                raise ProtocolError(f"unsupported command {command}")
+            result = handlers[command](pathname, content)
+        except Exception as e:
+            # stdout carries the protocol, so problems are reported on stderr
+            print(f"pilfer git-filter: {command} {pathname}: {e}", file=sys.stderr)
+            write_text_list(stdout, ["status=error"])
+        else:
+            write_text_list(stdout, ["status=success"])
+            write_content(stdout, result)
+            # an empty list keeps the status sent before the content
+            write_text_list(stdout, [])
+        stdout.flush()
@@ -0,0 +1,232 @@
+"""
+Resource limits for runs on shared hosts (bastions, build agents).
+
+A Governor caps what one pilfer run may take from its neighbours:
+
+- max_workers: crypto worker processes and file I/O threads
+- max_in_flight_bytes: vault data each pipeline stage may hold at once
+- io_rate: bytes per second read and written, shared by all threads
+- nice / io_class: CPU and I/O scheduling priority (Linux ioprio_set)
+
+The active governor is the module level `current`, set up once by
+configure() before any worker process or thread is started, so workers
+inherit the priorities. The pipeline consults it for worker counts and
+in-flight data, and the file I/O helpers call throttle_io() for every read
+and write. Without limits every check is a single attribute test.
+
+The first time a limit slows a run down, a notice goes to stderr, and
+throughput and summary events carry the time spent waiting (see stats()),
+so operators can trade run time against the impact on other jobs.
+"""
+
+import ctypes
+import errno
+import os
+import platform
+import sys
+import threading
+import time
+
+# ioprio_set(2) syscall numbers; glibc has no wrapper
+_IOPRIO_SET_SYSCALLS = {
+    "x86_64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "arm64": 30,
+    "riscv64": 30,
+    "armv7l": 314,
+    "ppc64le": 273,
+    "s390x": 282,
+}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_SHIFT = 13
+
+IO_CLASSES = {"best-effort": 2, "idle": 3}
+
+_SIZE_SUFFIXES = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def parse_size(value):
+    """Parse a byte count such as 512K, 10M or 1G"""
+    text = value.strip().upper().rstrip("B")
+    suffix = text[-1:] if text[-1:] in _SIZE_SUFFIXES else ""
+    number = float(text[: len(text) - len(suffix)])
+    if number <= 0:
+        raise ValueError(f"{value} is not a positive size")
+    return int(number * _SIZE_SUFFIXES[suffix])
+
+
+def positive_int(value):
+    """Parse a worker count, which must be at least 1"""
+    number = int(value)
+    if number < 1:
+        raise ValueError(f"{value} is not a positive number")
+    return number
+
+
+def item_bytes(args):
+    """Data carried by a pipeline item: its bytes arguments, or else its file
+
+    Pipeline items are (path, data...) tuples; items of a read stage only
+    carry the path, and weigh what reading the file will bring in.
+    """
+    size = sum(len(arg) for arg in args if isinstance(arg, bytes))
+    if size or not args or not isinstance(args[0], str):
+        return size
+    try:
+        return os.path.getsize(args[0])
+    except OSError:
+        return 0
+
+
+def set_io_priority(io_class, level=4):
+    """Set the I/O scheduling class of this process (inherited by its children)"""
+    number = _IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if not sys.platform.startswith("linux") or number is None:
+        raise OSError(errno.ENOSYS, "ioprio_set is not available on this platform")
+    if io_class == IO_CLASSES["idle"]:
+        level = 0
+    libc = ctypes.CDLL(None, use_errno=True)
+    priority = (io_class << _IOPRIO_CLASS_SHIFT) | level
+    if libc.syscall(number, _IOPRIO_WHO_PROCESS, 0, priority) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+
+class TokenBucket:
+    """Bandwidth limit; callers reserve bytes and sleep off any deficit"""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        # allow up to one second worth of bytes in a burst
+        self.tokens = self.rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, nbytes):
+        """Take nbytes from the bucket, returning the seconds to wait for them"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= nbytes
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class Governor:
+    """Resource limits of a run; every limit is optional"""
+
+    def __init__(
+        self,
+        max_workers=None,
+        max_in_flight_bytes=None,
+        io_rate=None,
+        nice=None,
+        io_class=None,
+        stream=None,
+    ):
+        self.max_workers = max_workers
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.io_rate = io_rate
+        self.nice = nice
+        self.io_class = io_class
+        self.stream = stream
+        self.bucket = TokenBucket(io_rate) if io_rate else None
+        self.io_wait = 0.0
+        self.held_items = 0
+        self.noticed = set()
+        self.lock = threading.Lock()
+
+    @property
+    def limited(self):
+        return bool(self.max_workers or self.max_in_flight_bytes or self.bucket)
+
+    def notice(self, kind, message):
+        """Tell the operator, once per kind, that a limit is slowing the run"""
+        with self.lock:
+            if kind in self.noticed:
+                return
+            self.noticed.add(kind)
+        print(f"⏳ {message}", file=self.stream or sys.stderr)
+
+    def workers(self, requested, pool="crypto"):
+        """The number of workers a pool may start when requested were wanted"""
+        # every pool needs a worker, whatever a caller passed in
+        requested = max(1, requested)
+        if self.max_workers is None or requested <= self.max_workers:
+            return requested
+        self.notice(
+            pool,
+            f"Limiting {pool} workers to {self.max_workers} (wanted {requested})",
+        )
+        return self.max_workers
+
+    def throttle_io(self, nbytes):
+        """Account for nbytes read or written, sleeping if over the rate"""
+        if self.bucket is None or not nbytes:
+            return
+        wait = self.bucket.reserve(nbytes)
+        if wait > 0:
+            with self.lock:
+                self.io_wait += wait
+            self.notice(
+                "io",
+                f"I/O limit of {self.io_rate / 1e6:.1f} MB/s reached, throttling",
+            )
+            time.sleep(wait)
+
+    def admits(self, in_flight_bytes, size):
+        """Whether a stage holding in_flight_bytes may take an item of size
+
+        A stage with nothing in flight always may, so one item larger than
+        the limit still gets through.
+        """
+        if (
+            not self.max_in_flight_bytes
+            or not in_flight_bytes
+            or in_flight_bytes + size <= self.max_in_flight_bytes
+        ):
+            return True
+        with self.lock:
+            self.held_items += 1
+        self.notice(
+            "bytes",
+            f"In-flight data limit of {self.max_in_flight_bytes} bytes reached, "
+            "holding back reads",
+        )
+        return False
+
+    def apply_priorities(self):
+        """Lower the CPU and I/O priority of this process, warning on failure"""
+        if self.nice:
+            try:
+                os.nice(self.nice)
+            except OSError as e:
+                print(f"Warning: could not renice: {e}", file=sys.stderr)
+        if self.io_class is not None:
+            try:
+                set_io_priority(self.io_class)
+            except OSError as e:
+                print(f"Warning: could not set I/O priority: {e}", file=sys.stderr)
+
+    def stats(self):
+        """Throttling so far, for progress events; empty without limits"""
+        if not self.limited:
+            return {}
+        with self.lock:
+            return {
+                "throttled_io_s": round(self.io_wait, 3),
+                "held_items": self.held_items,
+            }
+
+
+current = Governor()
+
+
+def configure(**limits):
+    """Make a Governor with limits the active one and apply its priorities"""
+    global current
+    current = Governor(**limits)
+    current.apply_priorities()
+    return current
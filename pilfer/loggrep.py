@@ -0,0 +1,198 @@
+"""
+Search the plaintext of every vault blob in git history.
+
+One `git rev-list --objects` pass enumerates the blobs reachable from the
+requested revisions; git itself lists each object only once, so a vault that
+is unchanged across a thousand commits is searched once. Blob contents come
+through a single `git cat-file --batch` process, vault blobs are decrypted on
+the crypto worker pool. Once the search is done, one `git log --raw` pass
+over the same revisions maps the matching blobs back to the commits that
+added or removed them.
+
+Decrypted blobs and blobs that turned out not to be vaults are kept in the
+encrypted blob cache shared with `pilfer diff`, so repeating a search, or
+searching for something else, only decrypts blobs added since.
+"""
+
+import itertools
+import os
+import re
+import subprocess
+import sys
+
+from pilfer import git, pipeline
+
+
+def iter_blobs(rev_args, cwd=None):
+    """Yield (sha, path) for every blob reachable from rev_args"""
+    # --filter=object:type=blob (git 2.32+) keeps trees out of the listing;
+    # older git rejects it, and trees are then skipped by their type
+    for filter_args in (["--filter=object:type=blob"], []):
+        process = subprocess.Popen(
+            ["git", "rev-list", "--objects"] + filter_args + list(rev_args),
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL if filter_args else None,
+        )
+        listed = False
+        with process.stdout:
+            for line in process.stdout:
+                sha, separator, path = line.rstrip(b"\n").partition(b" ")
+                if not separator:
+                    # commits are listed without a path
+                    continue
+                listed = True
+                yield sha.decode("ascii"), os.fsdecode(path)
+        if process.wait() == 0:
+            return
+        if listed or not filter_args:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+
+
+def commits_for_blobs(shas, rev_args, cwd=None):
+    """{sha: commits in rev_args that added or removed the blob, newest first}
+
+    Like one `git log --find-object` per blob, but history is walked once
+    whatever the number of blobs.
+    """
+    commits = {sha: [] for sha in shas}
+    process = subprocess.Popen(
+        [
+            "git",
+            "log",
+            "--raw",
+            "--no-abbrev",
+            "--format=%x00%H%x00%ad%x00%s",
+            "--date=short",
+        ]
+        + list(rev_args),
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+    )
+    commit = None
+    with process.stdout:
+        for line in process.stdout:
+            if line.startswith(b"\0"):
+                sha, date, subject = (
+                    line[1:].rstrip(b"\n").decode("utf-8", errors="replace")
+                ).split("\0", 2)
+                commit = {"commit": sha, "date": date, "subject": subject}
+            elif line.startswith(b":"):
+                # ":<old mode> <new mode> <old sha> <new sha> <status>\t<path>"
+                old, new = line.split(b"\t", 1)[0].split()[2:4]
+                if old == new:
+                    # a mode change or rename does not add or remove the blob
+                    continue
+                for blob in (old, new):
+                    blob_commits = commits.get(blob.decode("ascii"))
+                    if blob_commits is None:
+                        continue
+                    # once per commit, even if it touches the blob at two paths
+                    if not blob_commits or blob_commits[-1] is not commit:
+                        blob_commits.append(commit)
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+    return commits
+
+
+def search_plaintext(regex, plaintext):
+    """Return [(line number, line)] of the lines of plaintext matching regex"""
+    return [
+        (number, line.decode("utf-8", errors="replace"))
+        for number, line in enumerate(plaintext.splitlines(), 1)
+        if regex.search(line)
+    ]
+
+
+def compile_pattern(pattern, ignore_case=False, fixed_strings=False):
+    pattern = pattern.encode("utf-8")
+    if fixed_strings:
+        pattern = re.escape(pattern)
+    return re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+
+
+def log_grep(
+    vault_password,
+    pattern,
+    rev_range=None,
+    jobs=None,
+    use_cache=True,
+    ignore_case=False,
+    fixed_strings=False,
+):
+    """Yield a result for every vault blob in history whose plaintext matches
+
+    Each result is a dict with the blob SHA, the path it was first found at,
+    the commits that introduced or removed it, and the matching lines.
+    rev_range is anything `git rev-list` accepts; by default every ref is
+    searched. Results come once every blob has been searched, as mapping
+    them to commits takes a pass over the whole history.
+    """
+    regex = compile_pattern(pattern, ignore_case, fixed_strings)
+    rev_args = rev_range.split() if rev_range else ["--all"]
+
+    _, git_dir = git.repository_paths()
+    cache = git.BlobCache.for_repository(git_dir, pipeline.vault_codec(vault_password))
+    if use_cache:
+        cache.load()
+
+    paths = {}
+    # sha -> result without its commits, in the order blobs were found
+    found = {}
+
+    def record(sha, plaintext):
+        matches = search_plaintext(regex, plaintext)
+        path = paths.pop(sha)
+        if matches:
+            found[sha] = {"blob": sha, "path": path, "commits": [], "matches": matches}
+
+    def uncached_vault_blobs(cat_file):
+        for sha, path in iter_blobs(rev_args):
+            if cache.is_non_vault(sha):
+                continue
+            paths[sha] = path
+            if sha in cache:
+                record(sha, cache.get(sha))
+                continue
+
+            blob = cat_file.get(sha)
+            if blob is None or blob[1] != "blob":
+                del paths[sha]
+                continue
+            if not blob[2].startswith(pipeline.VAULT_HEADER):
+                del paths[sha]
+                cache.mark_non_vault(sha)
+                continue
+            yield sha, blob[2]
+
+    def report_failure(args, e):
+        paths.pop(args[0], None)
+        print(f"Failed to decrypt blob {args[0]}: {e}", file=sys.stderr)
+
+    try:
+        with git.CatFileBatch() as cat_file:
+            pending = uncached_vault_blobs(cat_file)
+            # the worker pool is only started once a blob needs decrypting
+            first = next(pending, None)
+            if first is not None:
+                with pipeline.crypto_executor(vault_password, jobs) as crypto_pool:
+                    decrypts = pipeline.stream_map(
+                        pipeline.decrypt_in_worker,
+                        itertools.chain([first], pending),
+                        crypto_pool,
+                    )
+                    for (sha, _), plaintext in pipeline.succeeded(
+                        decrypts, report_failure
+                    ):
+                        cache.put(sha, plaintext)
+                        record(sha, plaintext)
+    finally:
+        if use_cache:
+            cache.save()
+
+    if not found:
+        return
+    commits = commits_for_blobs(found, rev_args)
+    for sha, result in found.items():
+        result["commits"] = commits[sha]
+        yield result
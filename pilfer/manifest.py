@@ -0,0 +1,247 @@
+"""
+The session manifest: which vault files pilfer opened, and what they looked like.
+
+The manifest is a JSON-lines file. The first line is a header, every other
+line describes one vault file:
+
+    {"pilfer_manifest": 1, "opened": 1700000000.0, "root": "/path/to/project"}
+    {"path": "...", "state": "decrypted", "size": 42, "mtime_ns": ...,
+     "vault_version": "1.1", "vault_id": null, "hash": "<sha256 of plaintext>"}
+
+Records are appended as files are opened and read back in bounded batches, so
+neither open nor close ever holds the whole list in memory. Before a file is
+swapped for its plaintext a pending record with its stash path is flushed,
+
+    {"path": "...", "state": "pending", "stash": ".vault/...", ...}
+
+so an interrupted open still leaves an accurate record of every file it may
+have decrypted: a pending record whose stash exists and that is not followed
+by a decrypted record is still open. The size and mtime of the plaintext let
+`pilfer status` classify files with nothing but stat calls.
+
+Manifests written by older versions (a JSON list of paths) are still read.
+"""
+
+import json
+import os
+import threading
+import time
+
+MANIFEST_VERSION = 1
+
+# bytes of manifest decoded at a time
+READ_BATCH_BYTES = 1 << 20
+
+PENDING = "pending"
+DECRYPTED = "decrypted"
+
+
+def parse_vault_header(data):
+    """Return (version, vault id) from the first line of vault encrypted data"""
+    header = data.split(b"\n", 1)[0].strip().decode("utf-8", errors="replace")
+    fields = header.split(";")
+    version = fields[1] if len(fields) > 1 else None
+    vault_id = fields[3] if len(fields) > 3 else None
+    return version, vault_id
+
+
+def decrypted_record(path, encrypted_data, plaintext_hash):
+    """Manifest record for a vault file that was just written out as plaintext"""
+    stat_result = os.stat(path)
+    version, vault_id = parse_vault_header(encrypted_data)
+    return {
+        "path": path,
+        "state": DECRYPTED,
+        "size": stat_result.st_size,
+        "mtime_ns": stat_result.st_mtime_ns,
+        "vault_version": version,
+        "vault_id": vault_id,
+        "hash": plaintext_hash,
+    }
+
+
+def pending_record(path, encrypted_data, plaintext_hash, stash):
+    """Manifest record for a vault file about to be swapped for its plaintext"""
+    version, vault_id = parse_vault_header(encrypted_data)
+    return {
+        "path": path,
+        "state": PENDING,
+        "stash": stash,
+        "vault_version": version,
+        "vault_id": vault_id,
+        "hash": plaintext_hash,
+    }
+
+
+class ManifestWriter:
+    """Appends records to a manifest, writing the header for a new one
+
+    write() may be called from several threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        exists = os.path.exists(path)
+        self.file = open(path, "a")
+        if not exists:
+            self.write(
+                {
+                    "pilfer_manifest": MANIFEST_VERSION,
+                    "opened": time.time(),
+                    "root": os.getcwd(),
+                }
+            )
+
+    def write(self, record):
+        # one line per record, flushed so an interrupted run leaves a usable manifest
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+def read_header(path):
+    with open(path, "r") as f:
+        first_line = f.readline()
+    if first_line.startswith("["):
+        return {}
+    return json.loads(first_line)
+
+
+def iter_records(path, state=None):
+    """Yield the file records of a manifest, optionally only those in state
+
+    A legacy JSON list manifest yields decrypted records without metadata.
+    """
+    with open(path, "r") as f:
+        first_line = f.readline()
+        if first_line.startswith("["):
+            f.seek(0)
+            for legacy_path in json.load(f):
+                record = {"path": legacy_path, "state": DECRYPTED, "hash": None}
+                if state in (None, DECRYPTED):
+                    yield record
+            return
+
+        # decode a bounded batch of lines per json.loads call; one call per
+        # line would dominate the cost of status on large manifests
+        while True:
+            lines = [line for line in f.readlines(READ_BATCH_BYTES) if line.strip()]
+            if not lines:
+                return
+            for record in json.loads("[" + ",".join(lines) + "]"):
+                if state is None or record.get("state") == state:
+                    yield record
+
+
+def iter_opened(path):
+    """Yield the records of every file the session at path left open
+
+    These are the decrypted records, then the pending records of files an
+    interrupted open stashed but never recorded as decrypted. Only pending
+    records still waiting for their decrypted record are held in memory.
+    """
+    interrupted = {}
+    for record in iter_records(path):
+        if record.get("state") == DECRYPTED:
+            interrupted.pop(record["path"], None)
+            yield record
+        elif record.get("stash") is not None:
+            interrupted[record["path"]] = record
+    for record in interrupted.values():
+        if os.path.lexists(record["stash"]):
+            yield record
+
+
+def retain(path, paths, new_path=None):
+    """Rewrite the manifest at path (to new_path) with the records of paths only
+
+    The header is kept; a legacy manifest is rewritten in the current format.
+    """
+    if new_path is None:
+        new_path = path
+    header = read_header(path) or {
+        "pilfer_manifest": MANIFEST_VERSION,
+        "root": os.getcwd(),
+    }
+    records = [record for record in iter_opened(path) if record["path"] in paths]
+    temp_path = new_path + ".tmp"
+    with open(temp_path, "w") as f:
+        for record in [header] + records:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+    os.replace(temp_path, new_path)
+    if new_path != path:
+        os.remove(path)
+
+
+def file_status(path, size, mtime_ns):
+    """Classify a decrypted file as 'unchanged', 'modified' or 'missing' from stat"""
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        return "missing"
+    if stat_result.st_size == size and stat_result.st_mtime_ns == mtime_ns:
+        return "unchanged"
+    return "modified"
+
+
+def iter_new_files(walk_dir, known_paths, since, exclude_dirs=()):
+    """Yield files below walk_dir modified after `since` and not in known_paths"""
+    since_ns = int(since * 1e9)
+    excluded = {os.path.abspath(path) for path in exclude_dirs}
+    pending = [os.path.abspath(walk_dir)]
+
+    while pending:
+        directory = pending.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name != ".git" and entry.path not in excluded:
+                        pending.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    if entry.path in known_paths or entry.path in excluded:
+                        continue
+                    if entry.stat(follow_symlinks=False).st_mtime_ns > since_ns:
+                        yield entry.path
+
+
+def status(path, exclude_dirs=(), include_new=True):
+    """Yield (status, path) for every file recorded in the manifest at path
+
+    Opened files are 'unchanged', 'modified' or 'missing', or 'unknown' when
+    their open was interrupted or they were opened by an older pilfer. With
+    include_new, files created or changed since the session was opened that
+    pilfer does not know about are reported as 'new'.
+    """
+    known_paths = set()
+    for record in iter_opened(path):
+        known_paths.add(record["path"])
+        if record.get("size") is None:
+            yield "unknown", record["path"]
+        else:
+            yield file_status(
+                record["path"], record["size"], record["mtime_ns"]
+            ), record["path"]
+
+    header = read_header(path)
+    if include_new and "opened" in header:
+        excluded = list(exclude_dirs) + [os.path.abspath(path)]
+        for new_path in iter_new_files(
+            header.get("root", os.getcwd()), known_paths, header["opened"], excluded
+        ):
+            yield "new", new_path
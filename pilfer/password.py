@@ -0,0 +1,209 @@
+"""
+Vault password resolution.
+
+As with Ansible, a vault password source is either a plain text file or an
+executable that prints the password on stdout. Executables whose name ends
+in "-client" (e.g. vault-keyring-client.py) are vault id client scripts and
+are called with `--vault-id <id>`.
+
+Password clients can be slow (gpg-agent, a secrets manager round trip), so a
+resolved secret is remembered for the rest of the process and, for
+executable sources, stored in the Linux kernel keyring with a timeout. The
+keyring entry never touches disk and lets the `open` ... `close` session, and
+any command run in between, reuse the secret without invoking the client
+again. `close` removes the entry when the session ends.
+"""
+
+import ctypes
+import ctypes.util
+import hashlib
+import os
+import subprocess
+
+# seconds a secret from a password client stays in the kernel keyring
+DEFAULT_SECRET_TTL = 3600
+
+secret_ttl = DEFAULT_SECRET_TTL
+
+# (source, vault id) -> password bytes, for the lifetime of this process
+_resolved = {}
+
+_KEY_SPEC_USER_KEYRING = -4
+
+# possessor: all; user (same uid): view/read/search/link/setattr
+_KEY_PERMISSIONS = 0x3F000000 | 0x003B0000
+
+
+def parse_vault_id(value):
+    """Split an ansible style "id@source" vault id into (id, source)"""
+    if "@" in value:
+        vault_id, source = value.split("@", 1)
+        return vault_id or None, source
+    return None, value
+
+
+def is_executable(path):
+    return os.path.isfile(path) and os.access(path, os.X_OK)
+
+
+def script_is_client(path):
+    """True for vault id client scripts such as vault-keyring-client.py"""
+    name = os.path.splitext(os.path.basename(path))[0]
+    return name.endswith("-client")
+
+
+def run_password_script(path, vault_id=None):
+    """Run an executable password source and return the password it prints"""
+    command = [os.path.abspath(path)]
+    if script_is_client(path):
+        command += ["--vault-id", vault_id or "default"]
+
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(
+            f"Vault password script {path} returned non-zero ({result.returncode}): "
+            f"{result.stderr.decode('utf-8', errors='replace').strip()}"
+        )
+    return result.stdout.strip()
+
+
+def resolve_vault_password(source, vault_id=None):
+    """Return the password (bytes) for a password file or executable"""
+    source = os.path.abspath(os.path.expanduser(source))
+    cache_key = (source, vault_id)
+    if cache_key in _resolved:
+        return _resolved[cache_key]
+
+    if is_executable(source):
+        description = _keyring_description(source, vault_id)
+        password = KernelKeyring.get(description)
+        if password is None:
+            password = run_password_script(source, vault_id)
+            if secret_ttl > 0:
+                KernelKeyring.put(description, password, secret_ttl)
+    else:
+        with open(source, "r") as vault_password_file:
+            password = vault_password_file.read().strip().encode("utf-8")
+
+    if not password:
+        raise ValueError(f"Vault password from {source} is empty")
+
+    _resolved[cache_key] = password
+    return password
+
+
+def forget_vault_password(source, vault_id=None):
+    """Drop any cached copy of the password, ending the session"""
+    source = os.path.abspath(os.path.expanduser(source))
+    _resolved.pop((source, vault_id), None)
+    KernelKeyring.forget(_keyring_description(source, vault_id))
+
+
+def _keyring_description(source, vault_id):
+    digest = hashlib.sha256(f"{source}\0{vault_id or ''}".encode("utf-8"))
+    return "pilfer:" + digest.hexdigest()[:32]
+
+
+class KernelKeyring:
+    """Minimal libkeyutils binding for "user" keys in the user keyring
+
+    Every method is a no-op (or returns None) when libkeyutils or the
+    keyctl syscalls are unavailable, e.g. on macOS or inside containers
+    with a restrictive seccomp profile.
+    """
+
+    _lib = None
+    _loaded = False
+
+    @classmethod
+    def library(cls):
+        if not cls._loaded:
+            cls._loaded = True
+            name = ctypes.util.find_library("keyutils")
+            if name:
+                try:
+                    cls._lib = cls._bind(ctypes.CDLL(name, use_errno=True))
+                except (OSError, AttributeError):
+                    cls._lib = None
+        return cls._lib
+
+    @staticmethod
+    def _bind(lib):
+        lib.add_key.restype = ctypes.c_int32
+        lib.add_key.argtypes = [
+            ctypes.c_char_p,
+            ctypes.c_char_p,
+            ctypes.c_void_p,
+            ctypes.c_size_t,
+            ctypes.c_int32,
+        ]
+        lib.keyctl_search.restype = ctypes.c_long
+        lib.keyctl_search.argtypes = [
+            ctypes.c_int32,
+            ctypes.c_char_p,
+            ctypes.c_char_p,
+            ctypes.c_int32,
+        ]
+        lib.keyctl_read.restype = ctypes.c_long
+        lib.keyctl_read.argtypes = [ctypes.c_int32, ctypes.c_char_p, ctypes.c_size_t]
+        lib.keyctl_set_timeout.restype = ctypes.c_long
+        lib.keyctl_set_timeout.argtypes = [ctypes.c_int32, ctypes.c_uint]
+        lib.keyctl_setperm.restype = ctypes.c_long
+        lib.keyctl_setperm.argtypes = [ctypes.c_int32, ctypes.c_uint32]
+        lib.keyctl_revoke.restype = ctypes.c_long
+        lib.keyctl_revoke.argtypes = [ctypes.c_int32]
+        lib.keyctl_unlink.restype = ctypes.c_long
+        lib.keyctl_unlink.argtypes = [ctypes.c_int32, ctypes.c_int32]
+        return lib
+
+    @classmethod
+    def _search(cls, lib, description):
+        key = lib.keyctl_search(
+            _KEY_SPEC_USER_KEYRING, b"user", description.encode("ascii"), 0
+        )
+        return key if key > 0 else None
+
+    @classmethod
+    def get(cls, description):
+        lib = cls.library()
+        if lib is None:
+            return None
+        key = cls._search(lib, description)
+        if key is None:
+            return None
+
+        size = lib.keyctl_read(key, None, 0)
+        if size <= 0:
+            return None
+        buffer = ctypes.create_string_buffer(size)
+        if lib.keyctl_read(key, buffer, size) != size:
+            return None
+        return buffer.raw
+
+    @classmethod
+    def put(cls, description, secret, ttl):
+        lib = cls.library()
+        if lib is None:
+            return False
+        key = lib.add_key(
+            b"user",
+            description.encode("ascii"),
+            secret,
+            len(secret),
+            _KEY_SPEC_USER_KEYRING,
+        )
+        if key <= 0:
+            return False
+        lib.keyctl_setperm(key, _KEY_PERMISSIONS)
+        lib.keyctl_set_timeout(key, ttl)
+        return True
+
+    @classmethod
+    def forget(cls, description):
+        lib = cls.library()
+        if lib is None:
+            return
+        key = cls._search(lib, description)
+        if key is not None:
+            lib.keyctl_revoke(key)
+            lib.keyctl_unlink(key, _KEY_SPEC_USER_KEYRING)
@@ -0,0 +1,310 @@
+"""
+Streaming building blocks for pilfer's open/close pipeline.
+
+Vault discovery, file I/O and the CPU-bound vault crypto run as overlapping
+stages connected by bounded queues: I/O stages run on threads, crypto stages
+on worker processes. Decryption of the first vault therefore starts while the
+directory walk is still in progress, and memory use stays bounded no matter
+how many vault files a project contains.
+"""
+
+import os
+import queue
+import threading
+from concurrent import futures
+
+from pilfer import governor
+
+VAULT_HEADER = b"$ANSIBLE_VAULT;"
+
+# directories that never contain vault files worth opening; .pilfer holds
+# the variable index outside of git repositories, itself a vault file
+ALWAYS_PRUNED_DIRECTORIES = (".git", ".pilfer")
+
+# upper bound on items queued between two stages
+DEFAULT_QUEUE_SIZE = 64
+
+# file I/O threads; reads and writes mostly wait on the disk, not the CPU
+DEFAULT_IO_WORKERS = 8
+
+_SENTINEL = object()
+
+# per-process VaultCodec, set up once by init_vault_worker()
+_worker_vault = None
+
+# salt shared by every encryption in a session salt close, see crypto_executor()
+_worker_session_salt = None
+
+
+def default_jobs():
+    """Number of crypto worker processes to use when none was requested"""
+    return os.cpu_count() or 1
+
+
+def is_vault_file(path):
+    """Return True if the file at path starts with the ansible vault header"""
+    with open(path, "rb") as open_file:
+        header = open_file.read(len(VAULT_HEADER))
+    governor.current.throttle_io(len(header))
+    return header == VAULT_HEADER
+
+
+def iter_vaulted_files(walk_dir, exclude_dirs=()):
+    """Yield the absolute path of every vault encrypted file below walk_dir
+
+    Directories listed in exclude_dirs (and .git) are not descended into.
+    """
+    walk_dir = os.path.abspath(walk_dir)
+    excluded = {os.path.abspath(path) for path in exclude_dirs}
+
+    for dirpath, dirnames, filenames in os.walk(walk_dir):
+        dirnames[:] = [
+            name
+            for name in dirnames
+            if name not in ALWAYS_PRUNED_DIRECTORIES
+            and os.path.join(dirpath, name) not in excluded
+        ]
+
+        for name in filenames:
+            filePath = os.path.join(dirpath, name)
+            try:
+                if is_vault_file(filePath):
+                    yield filePath
+            except (IOError, OSError, PermissionError):
+                # Skip files we can't read
+                continue
+
+
+def threaded_iter(iterable, maxsize=DEFAULT_QUEUE_SIZE):
+    """Consume iterable on a background thread, yielding its items
+
+    At most maxsize items are buffered, so a fast producer (such as the
+    directory walk) runs ahead of its consumers without unbounded growth.
+    Exceptions raised by the producer are re-raised in the consumer.
+    """
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((_SENTINEL, None))
+        except BaseException as e:
+            put((_SENTINEL, e))
+
+    producer = threading.Thread(target=produce, name="pilfer-producer", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is _SENTINEL:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def stream_map(fn, items, executor, max_in_flight=DEFAULT_QUEUE_SIZE):
+    """Run fn(*args) on executor for each args tuple in items
+
+    Yields (args, future) pairs in completion order. No more than
+    max_in_flight calls are outstanding at once, which is what bounds the
+    queue between this stage and the one feeding it. With an in-flight
+    bytes limit (see pilfer.governor) the data held by outstanding calls is
+    bounded as well.
+    """
+    limits = governor.current
+    pending = {}
+    items = iter(items)
+    exhausted = False
+    # (args, size) of an item waiting for in-flight data to drain
+    held = None
+    in_flight_bytes = 0
+
+    while True:
+        while not exhausted and len(pending) < max_in_flight:
+            if held is None:
+                try:
+                    args = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                size = governor.item_bytes(args) if limits.max_in_flight_bytes else 0
+            else:
+                (args, size), held = held, None
+            if not limits.admits(in_flight_bytes, size):
+                held = args, size
+                break
+            in_flight_bytes += size
+            pending[executor.submit(fn, *args)] = args, size
+
+        if not pending:
+            return
+
+        done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+        for future in done:
+            args, size = pending.pop(future)
+            in_flight_bytes -= size
+            yield args, future
+
+
+def succeeded(results, on_error):
+    """Yield (args, result) for successful stream_map() results
+
+    on_error(args, exception) is called for every failed call instead.
+    """
+    for args, future in results:
+        error = future.exception()
+        if error is not None:
+            on_error(args, error)
+            continue
+        yield args, future.result()
+
+
+class InlineExecutor:
+    """Executor that runs every call immediately in the calling thread"""
+
+    def __init__(self, initializer=None, initargs=()):
+        if initializer is not None:
+            initializer(*initargs)
+
+    def submit(self, fn, *args, **kwargs):
+        future = futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        return False
+
+
+def _noop():
+    return None
+
+
+def io_executor(jobs):
+    """Thread pool for the file I/O stages"""
+    if jobs is not None and jobs <= 1:
+        return InlineExecutor()
+    return futures.ThreadPoolExecutor(
+        max_workers=governor.current.workers(DEFAULT_IO_WORKERS, "I/O"),
+        thread_name_prefix="pilfer-io",
+    )
+
+
+def crypto_executor(vault_password, jobs=None, session_salt=None):
+    """Process pool whose workers each hold a VaultCodec for vault_password
+
+    jobs=1 runs the crypto inline in the calling process instead. With a
+    session_salt, encrypt_in_worker() uses it for every file, so each worker
+    derives the key once instead of once per file.
+    """
+    jobs = governor.current.workers(default_jobs() if jobs is None else jobs)
+    if jobs <= 1:
+        return InlineExecutor(init_vault_worker, (vault_password, session_salt))
+
+    executor = futures.ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=init_vault_worker,
+        initargs=(vault_password, session_salt),
+    )
+    # Start the workers now, before the I/O threads exist, so that forking
+    # never happens in a process that is already multi-threaded.
+    executor.submit(_noop).result()
+    return executor
+
+
+def vault_lib(vault_password):
+    """A VaultLib using vault_password (bytes) for every vault id"""
+    # imported here so commands that never decrypt (status) start quickly
+    from ansible.constants import DEFAULT_VAULT_ID_MATCH
+    from ansible.parsing.vault import VaultLib, VaultSecret
+
+    return VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(vault_password))])
+
+
+def vault_codec(vault_password):
+    """A VaultCodec for vault_password that falls back to VaultLib"""
+    from pilfer import codec
+
+    return codec.VaultCodec(vault_password, fallback=vault_lib)
+
+
+def init_vault_worker(vault_password, session_salt=None):
+    """Build the codec used by decrypt_in_worker()/encrypt_in_worker()"""
+    global _worker_vault, _worker_session_salt
+    _worker_vault = vault_codec(vault_password)
+    _worker_session_salt = session_salt
+
+
+def decrypt_in_worker(path, encrypted_data):
+    """Decrypt encrypted_data in a crypto worker; path is only used for context"""
+    return _worker_vault.decrypt(encrypted_data)
+
+
+def verify_in_worker(path, encrypted_data):
+    """Decrypt encrypted_data in a crypto worker, returning only the plaintext size"""
+    return len(_worker_vault.decrypt(encrypted_data))
+
+
+def encrypt_in_worker(path, plaintext_data, vault_id=None):
+    """Encrypt plaintext_data in a crypto worker; None means nothing to encrypt
+
+    A vault_id label gives the file a 1.2 header carrying it.
+    """
+    if plaintext_data is None:
+        return None
+    return _worker_vault.encrypt(
+        plaintext_data, vault_id=vault_id, salt=_worker_session_salt
+    )
+
+
+def semantic_encrypt_in_worker(
+    path, plaintext_data, original_encrypted_data, vault_id=None
+):
+    """Like encrypt_in_worker(), but None also when the YAML/JSON data is unchanged
+
+    The original plaintext is decrypted from original_encrypted_data and
+    compared with pilfer.semantic.same_content().
+    """
+    if plaintext_data is None:
+        return None
+    from pilfer import semantic
+
+    if semantic.same_content(
+        _worker_vault.decrypt(original_encrypted_data), plaintext_data
+    ):
+        return None
+    return encrypt_in_worker(path, plaintext_data, vault_id)
+
+
+def index_in_worker(path, encrypted_data, hash_key=None):
+    """Decrypt a vault and return its key paths and value digests
+
+    See pilfer.varindex.extract(); the plaintext never leaves the worker.
+    """
+    from pilfer import varindex
+
+    return varindex.extract(_worker_vault.decrypt(encrypted_data), hash_key)
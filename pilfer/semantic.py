@@ -0,0 +1,89 @@
+"""
+Semantic comparison of YAML/JSON vault plaintext for `pilfer close --semantic`.
+
+Two plaintexts are the same when they parse to the same data: comments,
+quoting style, indentation, key order and trailing whitespace do not matter,
+while every value and its type does (1, 1.0, "1" and true all differ).
+Only documents whose top level is a mapping or a list are compared this way.
+Anything else (certificates, keys, plain text that YAML would read as one
+folded string) and anything that fails to parse counts as changed.
+"""
+
+import json
+
+import yaml
+
+
+class NotStructured(ValueError):
+    """The plaintext is not a YAML/JSON mapping or list"""
+
+
+class ParseError(NotStructured):
+    """The plaintext is not valid YAML/JSON"""
+
+
+class TaggedLoader(yaml.SafeLoader):
+    """SafeLoader that reads Ansible tags (!vault, !unsafe, ...) as the
+    mapping, list or string they are attached to"""
+
+
+def _construct_untagged(loader, tag_suffix, node):
+    if isinstance(node, yaml.MappingNode):
+        return loader.construct_mapping(node, deep=True)
+    if isinstance(node, yaml.SequenceNode):
+        return loader.construct_sequence(node, deep=True)
+    return loader.construct_scalar(node)
+
+
+TaggedLoader.add_multi_constructor("!", _construct_untagged)
+
+
+def parse_structured(data, loader=yaml.SafeLoader):
+    """Parse YAML (or JSON) bytes into a list of documents"""
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError as e:
+        raise NotStructured(str(e)) from e
+
+    try:
+        documents = [json.loads(text)]
+    except ValueError:
+        try:
+            documents = list(yaml.load_all(text, Loader=loader))
+        except yaml.YAMLError as e:
+            raise ParseError(str(e)) from e
+
+    for document in documents:
+        if document is not None and not isinstance(document, (dict, list)):
+            raise NotStructured("top level is a %s" % type(document).__name__)
+    return documents
+
+
+def normalise(data):
+    """Hashable, order-insensitive form of parsed data that keeps value types"""
+    if isinstance(data, dict):
+        return (
+            "map",
+            frozenset(
+                (normalise(key), normalise(value)) for key, value in data.items()
+            ),
+        )
+    if isinstance(data, (list, tuple)):
+        return ("seq", tuple(normalise(value) for value in data))
+    if isinstance(data, (set, frozenset)):
+        # YAML !!set
+        return ("set", frozenset(normalise(value) for value in data))
+    return (type(data).__name__, data)
+
+
+def same_content(old, new):
+    """True if the old and new plaintext bytes hold the same YAML/JSON data
+
+    Any failure to parse or compare counts as changed.
+    """
+    if old == new:
+        return True
+    try:
+        return normalise(parse_structured(old)) == normalise(parse_structured(new))
+    except Exception:
+        return False
@@ -0,0 +1,211 @@
+"""
+Read-only shadow trees: decrypted copies of a project's vaults kept outside it.
+
+`pilfer open --shadow DIR` mirrors every vault file below the current
+directory to the same relative path under DIR, decrypted, and leaves the
+project itself untouched: nothing to re-encrypt, nothing that can be
+committed by accident. `pilfer close --shadow DIR` just deletes DIR.
+
+DIR holds an index of the ciphertext each shadow file was built from (stat
+data plus sha256). Rebuilding skips vaults whose stat data is unchanged
+without reading them, and vaults whose content hash is unchanged without
+decrypting them, so a refresh only decrypts vaults that really changed.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+from pilfer import events, governor, pipeline
+
+INDEX_FILE_NAME = ".pilfer-shadow-index.json"
+INDEX_VERSION = 1
+
+
+class UnsafeShadowDirectory(ValueError):
+    """The directory must not be used as a shadow tree"""
+
+
+class NotAShadowTree(FileNotFoundError):
+    """The directory to remove is not a shadow tree"""
+
+
+def index_path(shadow_dir):
+    return os.path.join(shadow_dir, INDEX_FILE_NAME)
+
+
+def load_index(shadow_dir):
+    """Return {relative path: entry} for the shadow tree at shadow_dir"""
+    try:
+        with open(index_path(shadow_dir), "r") as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    if data.get("version") != INDEX_VERSION:
+        return {}
+    return data["files"]
+
+
+def save_index(shadow_dir, files):
+    temp_path = index_path(shadow_dir) + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump({"version": INDEX_VERSION, "files": files}, f)
+    os.replace(temp_path, index_path(shadow_dir))
+
+
+def stat_key(stat_result):
+    """The stat fields that change whenever a file's content may have changed"""
+    return [
+        stat_result.st_size,
+        stat_result.st_mtime_ns,
+        stat_result.st_ctime_ns,
+        stat_result.st_ino,
+    ]
+
+
+def is_inside(path, directory):
+    path, directory = os.path.realpath(path), os.path.realpath(directory)
+    return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
+
+
+def _check(path, entry, shadow_file):
+    """Return (index entry, ciphertext), ciphertext None when nothing changed"""
+    stat_result = os.stat(path)
+    key = stat_key(stat_result)
+    shadow_exists = os.path.exists(shadow_file)
+    if entry and shadow_exists and entry["stat"] == key:
+        return entry, None
+
+    with open(path, "rb") as f:
+        encrypted_data = f.read()
+    governor.current.throttle_io(len(encrypted_data))
+    sha256 = hashlib.sha256(encrypted_data).hexdigest()
+    new_entry = {"stat": key, "sha256": sha256}
+    if entry and shadow_exists and entry["sha256"] == sha256:
+        # touched or re-linked, but the same ciphertext
+        return new_entry, None
+    return new_entry, encrypted_data
+
+
+def _write_shadow_file(shadow_file, plaintext):
+    os.makedirs(os.path.dirname(shadow_file), mode=0o700, exist_ok=True)
+    governor.current.throttle_io(len(plaintext))
+    fd = os.open(shadow_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(plaintext)
+
+
+def build(
+    shadow_dir,
+    vault_password,
+    walk_dir=".",
+    exclude_dirs=(),
+    jobs=None,
+    progress=None,
+):
+    """Create or refresh the shadow tree at shadow_dir for the vaults in walk_dir
+
+    Returns counts of decrypted, unchanged, removed and failed files.
+    """
+    walk_dir = os.path.abspath(walk_dir)
+    if is_inside(shadow_dir, walk_dir):
+        raise UnsafeShadowDirectory(
+            f"The shadow directory {shadow_dir} must be outside {walk_dir}, "
+            "or plaintext would end up in the project"
+        )
+    if (
+        os.path.isdir(shadow_dir)
+        and os.listdir(shadow_dir)
+        and not os.path.isfile(index_path(shadow_dir))
+    ):
+        raise UnsafeShadowDirectory(
+            f"{shadow_dir} is not empty and not a pilfer shadow tree"
+        )
+    if progress is None:
+        progress = events.Progress("shadow")
+
+    os.makedirs(shadow_dir, mode=0o700, exist_ok=True)
+    index = load_index(shadow_dir)
+    new_index = {}
+    # entries of vaults still being decrypted, indexed once their file is written
+    pending = {}
+    counts = {"decrypted": 0, "unchanged": 0, "removed": 0, "failed": 0}
+
+    def shadow_file(path):
+        return os.path.join(shadow_dir, os.path.relpath(path, walk_dir))
+
+    def write(path, plaintext):
+        _write_shadow_file(shadow_file(path), plaintext)
+
+    def report_failure(args, e):
+        print(f"Failed to decrypt {args[0]}: {e}", file=sys.stderr)
+        pending.pop(args[0], None)
+        counts["failed"] += 1
+        progress.failed(args[0], e)
+
+    def changed_vaults(checks):
+        for (path, _, _), (entry, encrypted_data) in checks:
+            if encrypted_data is None:
+                new_index[os.path.relpath(path, walk_dir)] = entry
+                counts["unchanged"] += 1
+                progress.done(path, 0)
+                continue
+            pending[path] = entry
+            yield path, encrypted_data
+
+    # the worker processes are forked before the I/O and walker threads exist
+    with pipeline.crypto_executor(
+        vault_password, jobs
+    ) as crypto_pool, pipeline.io_executor(jobs) as io_pool:
+        checks = pipeline.stream_map(
+            _check,
+            (
+                (path, index.get(os.path.relpath(path, walk_dir)), shadow_file(path))
+                for path in progress.track(
+                    pipeline.threaded_iter(
+                        pipeline.iter_vaulted_files(walk_dir, exclude_dirs)
+                    )
+                )
+            ),
+            io_pool,
+        )
+        decrypts = pipeline.stream_map(
+            pipeline.decrypt_in_worker,
+            changed_vaults(pipeline.succeeded(checks, report_failure)),
+            crypto_pool,
+        )
+        writes = pipeline.stream_map(
+            write,
+            (
+                (path, plaintext)
+                for (path, _), plaintext in pipeline.succeeded(decrypts, report_failure)
+            ),
+            io_pool,
+        )
+        for (path, plaintext), _ in pipeline.succeeded(writes, report_failure):
+            new_index[os.path.relpath(path, walk_dir)] = pending.pop(path)
+            counts["decrypted"] += 1
+            progress.done(path, len(plaintext))
+
+    # vaults deleted (or failing to decrypt) since the last build leave no
+    # stale plaintext behind
+    for relative_path in set(index) - set(new_index):
+        try:
+            os.remove(os.path.join(shadow_dir, relative_path))
+            counts["removed"] += 1
+        except FileNotFoundError:
+            pass
+
+    save_index(shadow_dir, new_index)
+    return counts
+
+
+def remove(shadow_dir):
+    """Delete a shadow tree, refusing directories that are not one"""
+    if not os.path.isfile(index_path(shadow_dir)):
+        raise NotAShadowTree(
+            f"{shadow_dir} is not a pilfer shadow tree (no {INDEX_FILE_NAME})"
+        )
+    shutil.rmtree(shadow_dir)
@@ -0,0 +1,313 @@
+"""
+An encrypted index of the variable names defined in a project's vaults.
+
+`pilfer index` decrypts the vaults, parses their YAML/JSON and records every
+key path (top-level `db_password`, nested `db.users[].password`) of every
+vault file. `pilfer find-var NAME` then answers "which vault defines NAME?"
+from the index alone, without reading any vault.
+
+The index is a single vault-encrypted JSON file, in the git directory when
+there is one (so it can never be committed), else in `.pilfer/` below the
+indexed directory. It keeps the stat data and ciphertext sha256 of every
+vault it indexed, so a rebuild only reads vaults whose stat data changed and
+only decrypts vaults whose ciphertext changed. The inverted map from key
+path to files is built in memory when the index is loaded.
+
+With values=True, every scalar value is also stored as an HMAC keyed with
+the vault password, so `find-var --value` can find which file holds a known
+(e.g. leaked) value without the index ever containing it.
+"""
+
+import fnmatch
+import hashlib
+import hmac
+import json
+import os
+import subprocess
+import sys
+
+from pilfer import events, git, governor, pipeline, shadow
+
+INDEX_FILE_NAME = "var-index.vault"
+INDEX_VERSION = 1
+
+# where the index goes outside of git repositories; one of
+# pipeline.ALWAYS_PRUNED_DIRECTORIES, so no command walks into it
+LOCAL_INDEX_DIRECTORY = ".pilfer"
+
+# hex digits of the HMAC kept per value
+VALUE_DIGEST_LENGTH = 32
+
+_WILDCARDS = "*?["
+
+
+def index_path(walk_dir):
+    """Path of the index for the vaults below walk_dir"""
+    try:
+        # outside of a repository is no error here
+        _, git_dir = git.repository_paths(walk_dir, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return os.path.join(walk_dir, LOCAL_INDEX_DIRECTORY, INDEX_FILE_NAME)
+    return os.path.join(git_dir, "pilfer", INDEX_FILE_NAME)
+
+
+def value_key(vault_password):
+    """HMAC key for value digests, derived from (and unique to) the password"""
+    return hashlib.sha256(b"pilfer value index\0" + vault_password).digest()
+
+
+def value_digest(key, value):
+    """Digest of a scalar value; strings as they are, other scalars as JSON"""
+    if not isinstance(value, str):
+        value = json.dumps(value, default=str)
+    digest = hmac.new(key, value.encode("utf-8"), hashlib.sha256).hexdigest()
+    return digest[:VALUE_DIGEST_LENGTH]
+
+
+def iter_key_paths(data, prefix=""):
+    """Yield (key path, value) for every key in nested mappings and lists"""
+    if isinstance(data, dict):
+        for key, value in data.items():
+            path = f"{prefix}.{key}" if prefix else str(key)
+            yield path, value
+            yield from iter_key_paths(value, path)
+    elif isinstance(data, list):
+        for item in data:
+            yield from iter_key_paths(item, prefix + "[]")
+
+
+def extract(plaintext, hash_key=None):
+    """Return (sorted key paths, {key path: [value digests]}) of a plaintext
+
+    Plaintext that is not a YAML/JSON mapping or list has no keys; invalid
+    YAML raises semantic.ParseError. Ansible tags are ignored, so the keys
+    of `!vault` and `!unsafe` values are indexed. Without hash_key no value
+    digests are computed.
+    """
+    from pilfer import semantic
+
+    try:
+        documents = semantic.parse_structured(plaintext, semantic.TaggedLoader)
+    except semantic.ParseError:
+        raise
+    except semantic.NotStructured:
+        return [], {}
+
+    keys = set()
+    values = {}
+    for document in documents:
+        for path, value in iter_key_paths(document):
+            keys.add(path)
+            if hash_key is not None and not isinstance(value, (dict, list)):
+                digests = values.setdefault(path, [])
+                digest = value_digest(hash_key, value)
+                if digest not in digests:
+                    digests.append(digest)
+    return sorted(keys), values
+
+
+def matches(name, key_path):
+    """Whether NAME names key_path
+
+    A plain name matches the whole path or its last key (`password` finds
+    `db.password`); a name with wildcards is matched against the whole path.
+    """
+    if any(character in name for character in _WILDCARDS):
+        return fnmatch.fnmatchcase(key_path, name)
+    return key_path == name or key_path.endswith("." + name)
+
+
+class VarIndex:
+    """The variable index of one directory, persisted encrypted at path"""
+
+    def __init__(self, path, vault, root, values=False):
+        self.path = path
+        self.vault = vault
+        self.root = root
+        self.values = values
+        # relative path -> {"stat", "sha256", "keys", "values"}
+        self.files = {}
+
+    def load(self):
+        """Read the index; a missing or unreadable one, or one built with
+        other settings, starts empty"""
+        try:
+            with open(self.path, "rb") as f:
+                data = json.loads(self.vault.decrypt(f.read()))
+        except Exception:
+            return self
+        if (
+            data.get("version") == INDEX_VERSION
+            and data.get("root") == self.root
+            and data.get("values") == self.values
+        ):
+            self.files = data["files"]
+        return self
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        data = json.dumps(
+            {
+                "version": INDEX_VERSION,
+                "root": self.root,
+                "values": self.values,
+                "files": self.files,
+            },
+            separators=(",", ":"),
+        ).encode("utf-8")
+        temp_path = self.path + ".tmp"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(self.vault.encrypt(data))
+        os.replace(temp_path, self.path)
+
+    def inverted(self):
+        """{key path: [relative paths of the files defining it]}"""
+        postings = {}
+        for relative_path, entry in sorted(self.files.items()):
+            for key_path in entry["keys"]:
+                postings.setdefault(key_path, []).append(relative_path)
+        return postings
+
+    def find(self, name, value=None, hash_key=None):
+        """Yield {"path", "key"} for every file defining a key matching name
+
+        With value (and the hash_key of the password), only keys holding that
+        value are returned.
+        """
+        digest = None
+        if value is not None:
+            if not self.values:
+                raise ValueError("values are not indexed, run pilfer index --values")
+            digest = value_digest(hash_key, value)
+        for key_path, relative_paths in sorted(self.inverted().items()):
+            if not matches(name, key_path):
+                continue
+            for relative_path in relative_paths:
+                if digest is not None:
+                    digests = self.files[relative_path]["values"].get(key_path, ())
+                    if digest not in digests:
+                        continue
+                yield {"path": relative_path, "key": key_path}
+
+
+def _check(path, entry):
+    """Return (stat key, sha256, ciphertext), ciphertext None when unchanged"""
+    key = shadow.stat_key(os.stat(path))
+    if entry and entry["stat"] == key:
+        return key, entry["sha256"], None
+    with open(path, "rb") as f:
+        encrypted_data = f.read()
+    governor.current.throttle_io(len(encrypted_data))
+    sha256 = hashlib.sha256(encrypted_data).hexdigest()
+    if entry and entry["sha256"] == sha256:
+        return key, sha256, None
+    return key, sha256, encrypted_data
+
+
+def build(
+    vault_password,
+    walk_dir=".",
+    exclude_dirs=(),
+    values=False,
+    jobs=None,
+    progress=None,
+):
+    """Create or refresh the index of the vaults below walk_dir
+
+    Returns the VarIndex and counts of indexed, unchanged, removed and failed
+    files.
+    """
+    walk_dir = os.path.abspath(walk_dir)
+    if progress is None:
+        progress = events.Progress("index")
+    hash_key = value_key(vault_password) if values else None
+    index = VarIndex(
+        index_path(walk_dir), pipeline.vault_codec(vault_password), walk_dir, values
+    ).load()
+    old_files, index.files = index.files, {}
+    counts = {"indexed": 0, "unchanged": 0, "removed": 0, "failed": 0}
+
+    def report_failure(args, e):
+        print(f"Failed to index {args[0]}: {e}", file=sys.stderr)
+        counts["failed"] += 1
+        progress.failed(args[0], e)
+
+    def changed_vaults(checks):
+        for (path, entry), (key, sha256, encrypted_data) in checks:
+            relative_path = os.path.relpath(path, walk_dir)
+            if encrypted_data is None:
+                index.files[relative_path] = dict(entry, stat=key, sha256=sha256)
+                counts["unchanged"] += 1
+                progress.done(path, 0)
+                continue
+            index.files[relative_path] = {"stat": key, "sha256": sha256}
+            yield path, encrypted_data, hash_key
+
+    # the worker processes are forked before the I/O and walker threads exist
+    with pipeline.crypto_executor(
+        vault_password, jobs
+    ) as crypto_pool, pipeline.io_executor(jobs) as io_pool:
+        checks = pipeline.stream_map(
+            _check,
+            (
+                (path, old_files.get(os.path.relpath(path, walk_dir)))
+                for path in progress.track(
+                    pipeline.threaded_iter(
+                        pipeline.iter_vaulted_files(walk_dir, exclude_dirs)
+                    )
+                )
+            ),
+            io_pool,
+        )
+        extracts = pipeline.stream_map(
+            pipeline.index_in_worker,
+            changed_vaults(pipeline.succeeded(checks, report_failure)),
+            crypto_pool,
+        )
+        for (path, encrypted_data, _), result in pipeline.succeeded(
+            extracts, report_failure
+        ):
+            keys, value_digests = result
+            index.files[os.path.relpath(path, walk_dir)].update(
+                keys=keys, values=value_digests
+            )
+            counts["indexed"] += 1
+            progress.done(path, len(encrypted_data))
+
+    # files that failed have no keys to record
+    for relative_path in [
+        relative_path
+        for relative_path, entry in index.files.items()
+        if "keys" not in entry
+    ]:
+        del index.files[relative_path]
+    counts["removed"] = len(set(old_files) - set(index.files))
+
+    index.save()
+    return index, counts
+
+
+def load(vault_password, walk_dir="."):
+    """The index of walk_dir for lookups, as it was last built
+
+    Raises FileNotFoundError without an index and ValueError for an index of
+    another directory.
+    """
+    walk_dir = os.path.abspath(walk_dir)
+    path = index_path(walk_dir)
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"No variable index for {walk_dir}, run pilfer index")
+    vault = pipeline.vault_codec(vault_password)
+    with open(path, "rb") as f:
+        data = json.loads(vault.decrypt(f.read()))
+    if data.get("version") != INDEX_VERSION:
+        raise ValueError("The variable index is from another version, run pilfer index")
+    if data.get("root") != walk_dir:
+        raise ValueError(
+            f"The variable index covers {data.get('root')}, not {walk_dir}; "
+            "run find-var there or pilfer index here"
+        )
+    index = VarIndex(path, vault, walk_dir, data["values"])
+    index.files = data["files"]
+    return index
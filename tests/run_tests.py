@@ -48,6 +48,21 @@ def main():
             "test_pilfer_unified",
             ["TestPilferCLI", "TestPilferStandalone", "TestCompatibility"],
         ),
+        ("test_pipeline", ["TestPipelineHelpers", "TestParallelOpenClose"]),
+        ("test_verify", ["TestVerify"]),
+        ("test_diff", ["TestGitHelpers", "TestVaultDiff"]),
+        ("test_gitfilter", ["TestFilterProtocol", "TestGitIntegration"]),
+        ("test_password", ["TestPasswordSources", "TestKeyringSession"]),
+        ("test_manifest", ["TestManifest"]),
+        ("test_events", ["TestEvents"]),
+        ("test_codec", ["TestVaultCodec"]),
+        ("test_semantic", ["TestSemanticComparison", "TestSemanticClose"]),
+        ("test_loggrep", ["TestLogGrep"]),
+        ("test_shadow", ["TestShadow"]),
+        ("test_staged", ["TestCheckStaged"]),
+        ("test_governor", ["TestGovernor"]),
+        ("test_varindex", ["TestVarIndex"]),
+        ("test_export", ["TestExport"]),
     ]
 
     results = []
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Conformance tests for pilfer's vault codec against Ansible's VaultLib
+"""
+
+import binascii
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ansible.constants import DEFAULT_VAULT_ID_MATCH  # noqa: E402
+from ansible.parsing import vault as ansible_vault  # noqa: E402
+
+from pilfer import codec, pipeline  # noqa: E402
+
+PLAINTEXTS = [
+    b"",
+    b"a",
+    b"sixteen bytes!!\n",
+    b"secret: value\r\nother: 'x'\r\n",
+    "unicode: café ✓\n".encode("utf-8"),
+    os.urandom(5000),
+]
+
+
+class TestVaultCodec(unittest.TestCase):
+    """Test that the codec reads and writes exactly what VaultLib does"""
+
+    def setUp(self):
+        self.vault = ansible_vault.VaultLib(
+            [(DEFAULT_VAULT_ID_MATCH, ansible_vault.VaultSecret(b"test_password"))]
+        )
+        self.codec = codec.VaultCodec(b"test_password")
+
+    def test_decrypts_vaultlib_output(self):
+        """Test decrypting 1.1 and labelled 1.2 vaults written by VaultLib"""
+        for plaintext in PLAINTEXTS:
+            self.assertEqual(
+                self.codec.decrypt(self.vault.encrypt(plaintext)), plaintext
+            )
+            self.assertEqual(
+                self.codec.decrypt(self.vault.encrypt(plaintext, vault_id="prod")),
+                plaintext,
+            )
+
+    def test_vaultlib_decrypts_codec_output(self):
+        """Test that VaultLib reads what the codec writes, with and without ids"""
+        for plaintext in PLAINTEXTS:
+            self.assertEqual(
+                self.vault.decrypt(self.codec.encrypt(plaintext)), plaintext
+            )
+
+        labelled = self.codec.encrypt(b"x: 1\n", vault_id="prod")
+        self.assertTrue(labelled.startswith(b"$ANSIBLE_VAULT;1.2;AES256;prod\n"))
+        self.assertEqual(self.vault.decrypt(labelled), b"x: 1\n")
+
+    def test_identical_bytes_for_a_fixed_salt(self):
+        """Test byte-for-byte agreement with Ansible, including 80 column wrapping"""
+        salt = b"s" * codec.SALT_LENGTH
+        for plaintext in PLAINTEXTS:
+            expected = ansible_vault.format_vaulttext_envelope(
+                ansible_vault.VaultAES256.encrypt(
+                    plaintext, ansible_vault.VaultSecret(b"test_password"), salt=salt
+                ),
+                "AES256",
+            )
+            self.assertEqual(self.codec.encrypt(plaintext, salt=salt), expected)
+
+    def test_wrong_password_and_tampering(self):
+        """Test that a wrong password or modified ciphertext fails the HMAC check"""
+        encrypted = self.vault.encrypt(b"secret: value\n")
+        with self.assertRaises(codec.VaultIntegrityError):
+            codec.VaultCodec(b"wrong").decrypt(encrypted)
+
+        _, _, payload = codec.parse_envelope(encrypted)
+        salt, mac, ciphertext = binascii.unhexlify(payload).split(b"\n")
+        ciphertext = ciphertext[:-1] + (b"0" if ciphertext[-1:] != b"0" else b"1")
+        tampered = codec.format_envelope(
+            binascii.hexlify(b"\n".join([salt, mac, ciphertext]))
+        )
+        with self.assertRaises(codec.VaultIntegrityError):
+            self.codec.decrypt(tampered)
+
+        with self.assertRaises(ValueError):
+            self.codec.decrypt(b"$ANSIBLE_VAULT;1.1;AES256\nnot-hex\n")
+
+    def test_unsupported_format_falls_back(self):
+        """Test that other formats are refused, or handed to the fallback"""
+        old_format = b"$ANSIBLE_VAULT;1.0;AES\n00\n"
+        with self.assertRaises(codec.UnsupportedVaultFormat):
+            self.codec.decrypt(old_format)
+
+        calls = []
+
+        class Fallback:
+            def decrypt(self, data):
+                calls.append(data)
+                return b"from fallback"
+
+        with_fallback = codec.VaultCodec(
+            b"test_password", fallback=lambda _: Fallback()
+        )
+        self.assertEqual(with_fallback.decrypt(old_format), b"from fallback")
+        self.assertEqual(calls, [old_format])
+
+        # the worker codec is backed by VaultLib
+        self.assertIsInstance(
+            pipeline.vault_codec(b"test_password")._fallback_factory(b"test_password"),
+            ansible_vault.VaultLib,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
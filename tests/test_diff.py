@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Tests for pilfer diff and the git blob helpers it is built on
+"""
+
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ansible.constants import DEFAULT_VAULT_ID_MATCH  # noqa: E402
+from ansible.parsing.vault import VaultLib, VaultSecret  # noqa: E402
+
+from pilfer import cli as pilfer_cli  # noqa: E402
+from pilfer import diff, git  # noqa: E402
+
+VAULT_PASSWORD = b"test_password"
+
+
+class GitRepoTestCase(unittest.TestCase):
+    """Base class creating a throwaway git repository as the working directory"""
+
+    def setUp(self):
+        if shutil.which("git") is None:
+            self.skipTest("git is not installed")
+
+        self.test_dir = tempfile.mkdtemp()
+        self.original_cwd = os.getcwd()
+        os.chdir(self.test_dir)
+
+        self.git("init", "-q")
+        self.git("config", "user.email", "pilfer@example.com")
+        self.git("config", "user.name", "pilfer")
+
+        self.vault = VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(VAULT_PASSWORD))])
+
+    def tearDown(self):
+        os.chdir(self.original_cwd)
+        shutil.rmtree(self.test_dir)
+
+    def git(self, *args):
+        return subprocess.run(
+            ["git"] + list(args), check=True, stdout=subprocess.PIPE
+        ).stdout
+
+    def write_vault(self, path, plaintext):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(self.vault.encrypt(plaintext))
+
+    def commit(self, message):
+        self.git("add", "-A")
+        self.git("commit", "-q", "-m", message)
+
+    def run_cli(self, *argv):
+        """Run pilfer's main() with argv, returning (exit code, stderr)"""
+        stderr = io.StringIO()
+        with mock.patch.object(sys, "argv", ["pilfer"] + list(argv)), mock.patch(
+            "sys.stderr", stderr
+        ):
+            return pilfer_cli.main(), stderr.getvalue()
+
+
+class TestGitHelpers(GitRepoTestCase):
+    """Test the cat-file batch reader and blob cache"""
+
+    def test_cat_file_batch_and_blob_sha(self):
+        """Test that blobs are read through one process and SHAs match git"""
+        with open("file.txt", "wb") as f:
+            f.write(b"hello\n")
+        self.commit("one")
+        sha = self.git("rev-parse", "HEAD:file.txt").decode("ascii").strip()
+
+        self.assertEqual(git.blob_sha(b"hello\n"), sha)
+        with git.CatFileBatch() as cat_file:
+            self.assertEqual(cat_file.get(sha), (sha, "blob", b"hello\n"))
+            self.assertIsNone(cat_file.get("HEAD:missing.txt"))
+            self.assertEqual(cat_file.get("HEAD:file.txt")[2], b"hello\n")
+
+    def test_blob_cache_round_trip(self):
+        """Test that the cache is stored encrypted and reloads"""
+        _, git_dir = git.repository_paths()
+        cache = git.BlobCache.for_repository(git_dir, self.vault)
+        cache.put("a" * 40, b"secret: value\n")
+        cache.save()
+
+        with open(cache.path, "rb") as f:
+            stored = f.read()
+        self.assertTrue(stored.startswith(b"$ANSIBLE_VAULT;"))
+        self.assertNotIn(b"secret", stored)
+
+        reloaded = git.BlobCache.for_repository(git_dir, self.vault).load()
+        self.assertEqual(reloaded.get("a" * 40), b"secret: value\n")
+
+        other_vault = VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(b"other"))])
+        self.assertNotIn(
+            "a" * 40, git.BlobCache.for_repository(git_dir, other_vault).load()
+        )
+
+    def test_blob_cache_evicts_least_recently_used(self):
+        """Test that the cache stays under its size limit, dropping old blobs"""
+        cache = git.BlobCache("unused", self.vault, max_bytes=130)
+        for sha in ("a", "b", "c"):
+            cache.put(sha * 40, b"x" * 30)
+        cache.get("a" * 40)
+        cache.put("d" * 40, b"x" * 30)
+
+        self.assertEqual(sorted(sha[0] for sha in cache.blobs), ["a", "c", "d"])
+        self.assertEqual(cache.size, 120)
+
+    def test_blob_cache_bounds_non_vault_blobs(self):
+        """Test that only the newest non-vault SHAs are remembered"""
+        cache = git.BlobCache("unused", self.vault, max_non_vault=2)
+        for sha in ("a", "b", "c"):
+            cache.mark_non_vault(sha * 40)
+        self.assertFalse(cache.is_non_vault("a" * 40))
+        self.assertTrue(cache.is_non_vault("b" * 40))
+        self.assertTrue(cache.is_non_vault("c" * 40))
+
+
+class TestVaultDiff(GitRepoTestCase):
+    """Test plaintext diffs between revisions and the working tree"""
+
+    def setUp(self):
+        super().setUp()
+        self.write_vault("group_vars/all.yml", b"a: 1\nb: 2\n")
+        with open("README", "w") as f:
+            f.write("plain\n")
+        self.commit("first")
+
+        self.write_vault("group_vars/all.yml", b"a: 1\nb: 3\n")
+        self.write_vault("group_vars/new.yml", b"new: 1\n")
+        with open("README", "w") as f:
+            f.write("changed\n")
+        self.commit("second")
+
+    def test_diff_between_revisions(self):
+        """Test that only vault files are diffed, as plaintext"""
+        output = diff.vault_diff(VAULT_PASSWORD, "HEAD~1..HEAD", jobs=2)
+
+        self.assertIn("diff --git a/group_vars/all.yml b/group_vars/all.yml", output)
+        self.assertIn("-b: 2\n+b: 3\n", output)
+        self.assertIn("--- /dev/null\n+++ b/group_vars/new.yml", output)
+        self.assertIn("+new: 1\n", output)
+        self.assertNotIn("README", output)
+
+    def test_diff_limited_to_paths(self):
+        """Test that paths restrict the diff"""
+        output = diff.vault_diff(
+            VAULT_PASSWORD, "HEAD~1..HEAD", ["group_vars/new.yml"], jobs=1
+        )
+
+        self.assertNotIn("all.yml", output)
+        self.assertIn("new.yml", output)
+
+    def test_diff_against_opened_working_tree(self):
+        """Test diffing a revision against files opened by pilfer"""
+        with open("vault_pass", "wb") as f:
+            f.write(VAULT_PASSWORD)
+        pilfer_cli.write_vaulted_file_list()
+        pilfer_cli.decrypt_vault_files("vault_pass", jobs=1)
+
+        with open("group_vars/all.yml", "ab") as f:
+            f.write(b"c: 4\n")
+
+        output = diff.vault_diff(VAULT_PASSWORD, "HEAD", ["group_vars"], jobs=1)
+        self.assertIn(" b: 3\n+c: 4\n", output)
+        self.assertNotIn("new.yml", output)
+
+        pilfer_cli.recrypt_vault_files("vault_pass", jobs=1)
+
+    def test_repeated_diff_uses_cache(self):
+        """Test that a second diff of the same history decrypts nothing"""
+        first = diff.vault_diff(VAULT_PASSWORD, "HEAD~1..HEAD", jobs=1)
+
+        with mock.patch.object(
+            diff.pipeline, "crypto_executor", side_effect=AssertionError("decrypted")
+        ):
+            second = diff.vault_diff(VAULT_PASSWORD, "HEAD~1..HEAD", jobs=1)
+
+        self.assertEqual(first, second)
+
+    def test_git_errors_are_reported_briefly(self):
+        """Test that a bad revision exits 2 without a traceback"""
+        with open("vault_pass", "wb") as f:
+            f.write(VAULT_PASSWORD)
+        code, stderr = self.run_cli("diff", "-p", "vault_pass", "nosuchrev")
+        self.assertEqual(code, 2)
+        self.assertIn("pilfer diff: git exited", stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
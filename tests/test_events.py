@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Tests for progress events and the --events option
+"""
+
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ansible.constants import DEFAULT_VAULT_ID_MATCH  # noqa: E402
+from ansible.parsing.vault import VaultLib, VaultSecret  # noqa: E402
+
+from pilfer import events  # noqa: E402
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+class TestEvents(unittest.TestCase):
+    """Test the Progress tracker and the JSON-lines event stream"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.original_cwd = os.getcwd()
+        os.chdir(self.test_dir)
+
+        with open("vault_pass", "w") as f:
+            f.write("test_password")
+        vault = VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(b"test_password"))])
+        for i in range(4):
+            with open(f"vault{i}.yml", "wb") as f:
+                f.write(vault.encrypt(f"secret: {i}\n".encode("utf-8")))
+        with open("broken.yml", "wb") as f:
+            f.write(b"$ANSIBLE_VAULT;1.1;AES256\nnot-hex\n")
+
+    def tearDown(self):
+        os.chdir(self.original_cwd)
+        shutil.rmtree(self.test_dir)
+
+    def test_progress_events(self):
+        """Test start, scan, done, failed, throughput and summary events"""
+        stream = io.StringIO()
+        progress = events.Progress(
+            "open", [events.JsonLinesReporter(stream)], interval=0
+        )
+        with progress:
+            for path in progress.track(["a.yml", "b.yml"]):
+                if path == "a.yml":
+                    progress.done(path, 10)
+                else:
+                    progress.failed(path, ValueError("bad"))
+
+        emitted = [json.loads(line) for line in stream.getvalue().splitlines()]
+        kinds = [event["event"] for event in emitted]
+        self.assertEqual(kinds[0], "start")
+        self.assertEqual(kinds[-1], "summary")
+        for kind in ("scan", "done", "failed", "throughput"):
+            self.assertIn(kind, kinds)
+        done = emitted[kinds.index("done")]
+        self.assertEqual((done["path"], done["bytes"]), ("a.yml", 10))
+        self.assertGreaterEqual(done["duration"], 0)
+        self.assertEqual(emitted[kinds.index("failed")]["error"], "bad")
+        self.assertEqual(emitted[kinds.index("scan")]["files"], 2)
+        summary = emitted[-1]
+        self.assertEqual((summary["files"], summary["failed"]), (1, 1))
+
+    def test_closed_event_stream(self):
+        """Test that a reader going away stops the events with one warning"""
+
+        class ClosedPipe(io.StringIO):
+            def write(self, text):
+                raise BrokenPipeError(32, "Broken pipe")
+
+        stderr = io.StringIO()
+        with mock.patch("sys.stderr", stderr):
+            progress = events.Progress(
+                "open", [events.JsonLinesReporter(ClosedPipe())], interval=0
+            )
+            with progress:
+                for path in progress.track(["a.yml", "b.yml"]):
+                    progress.done(path, 10)
+
+        self.assertEqual(progress.files, 2)
+        self.assertEqual(stderr.getvalue().count("Event stream closed"), 1)
+
+    def test_cli_event_stream_on_stdout(self):
+        """Test that --events jsonl keeps stdout pure JSON and still reports failures"""
+        env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+        for action in ("open", "close"):
+            result = subprocess.run(
+                [sys.executable, "-m", "pilfer.cli", action]
+                + ["-p", "vault_pass", "--events", "jsonl"],
+                capture_output=True,
+                text=True,
+                env=env,
+            )
+            self.assertEqual(result.returncode, 0, result.stderr)
+
+            emitted = [json.loads(line) for line in result.stdout.splitlines()]
+            self.assertEqual(emitted[-1]["event"], "summary")
+            self.assertEqual(emitted[-1]["operation"], action)
+            self.assertEqual(emitted[-1]["files"], 4)
+            if action == "open":
+                self.assertEqual(emitted[-1]["failed"], 1)
+                self.assertIn("Failed to decrypt", result.stderr)
+            else:
+                self.assertIn("re-encrypted", result.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Tests for pilfer export
+"""
+
+import base64
+import io
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ansible.constants import DEFAULT_VAULT_ID_MATCH  # noqa: E402
+from ansible.parsing.vault import VaultLib, VaultSecret  # noqa: E402
+
+from pilfer import export  # noqa: E402
+
+VAULT_PASSWORD = b"test_password"
+
+PLAINTEXTS = {
+    "group_vars/all.yml": b"db_password: hunter2\n",
+    "roles/web/files/key.bin": b"\x00\xff binary",
+}
+
+
+class TestExport(unittest.TestCase):
+    """Test exporting vault plaintext without touching the project"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.vault = VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(VAULT_PASSWORD))])
+        for relative_path, plaintext in PLAINTEXTS.items():
+            path = os.path.join(self.test_dir, relative_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(self.vault.encrypt(plaintext))
+            os.chmod(path, 0o640)
+        with open(os.path.join(self.test_dir, "plain.yml"), "wb") as f:
+            f.write(b"not: secret\n")
+        self.before = self.snapshot()
+
+    def tearDown(self):
+        self.assertEqual(self.snapshot(), self.before)
+        shutil.rmtree(self.test_dir)
+
+    def snapshot(self):
+        files = {}
+        for root, dirs, names in os.walk(self.test_dir):
+            for name in dirs + names:
+                path = os.path.join(root, name)
+                stat_result = os.lstat(path)
+                files[path] = (stat_result.st_mtime_ns, stat_result.st_size)
+        return files
+
+    def export(self, output_format, jobs=1, encrypt=False):
+        output = io.BytesIO()
+        count = export.export(
+            VAULT_PASSWORD,
+            output,
+            output_format,
+            walk_dir=self.test_dir,
+            encrypt=encrypt,
+            jobs=jobs,
+        )
+        self.assertEqual(count, len(PLAINTEXTS))
+        return output.getvalue()
+
+    def test_tar(self):
+        """Test that the tar holds every vault's plaintext with its mode"""
+        data = self.export("tar", jobs=2)
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            members = {member.name: member for member in tar.getmembers()}
+            self.assertEqual(sorted(members), sorted(PLAINTEXTS))
+            for name, plaintext in PLAINTEXTS.items():
+                self.assertEqual(tar.extractfile(name).read(), plaintext)
+                self.assertEqual(members[name].mode, 0o640)
+
+    def test_jsonl(self):
+        """Test one record per vault, base64 for plaintext that is not UTF-8"""
+        records = {}
+        for line in self.export("jsonl").splitlines():
+            record = json.loads(line)
+            records[record.pop("path")] = record
+        self.assertEqual(
+            records,
+            {
+                "group_vars/all.yml": {"plaintext": "db_password: hunter2\n"},
+                "roles/web/files/key.bin": {
+                    "plaintext_base64": base64.b64encode(b"\x00\xff binary").decode()
+                },
+            },
+        )
+
+    def test_encrypted_archive(self):
+        """Test that --encrypt writes one vault that ansible can decrypt"""
+        data = self.export("jsonl", encrypt=True)
+        self.assertTrue(data.startswith(b"$ANSIBLE_VAULT;1.1;AES256\n"))
+        self.assertNotIn(b"hunter2", data)
+        self.assertIn(b"hunter2", self.vault.decrypt(data))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Tests for the pilfer git-filter long-running filter process
+"""
+
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ansible.constants import DEFAULT_VAULT_ID_MATCH  # noqa: E402
+from ansible.parsing.vault import VaultLib, VaultSecret  # noqa: E402
+
+from pilfer import gitfilter  # noqa: E402
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+VAULT_PASSWORD = b"test_password"
+
+
+def git_request(stream, command, pathname, content):
+    gitfilter.write_text_list(stream, [f"command={command}", f"pathname={pathname}"])
+    gitfilter.write_content(stream, content)
+
+
+class TestFilterProtocol(unittest.TestCase):
+    """Test the protocol and filter logic against an in-memory git client"""
+
+    def setUp(self):
+        self.vault = VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(VAULT_PASSWORD))])
+
+    def run_session(self, requests, vault_filter):
+        stdin = io.BytesIO()
+        gitfilter.write_text_list(stdin, ["git-filter-client", "version=2"])
+        gitfilter.write_text_list(stdin, ["capability=clean", "capability=smudge"])
+        for command, pathname, content in requests:
+            git_request(stdin, command, pathname, content)
+        stdin.seek(0)
+
+        stdout = io.BytesIO()
+        gitfilter.serve(vault_filter, stdin, stdout)
+        stdout.seek(0)
+
+        self.assertEqual(
+            gitfilter.read_text_list(stdout), ["git-filter-server", "version=2"]
+        )
+        self.assertEqual(
+            gitfilter.read_text_list(stdout), ["capability=clean", "capability=smudge"]
+        )
+        responses = []
+        for _ in requests:
+            status = gitfilter.read_text_list(stdout)
+            if status == ["status=success"]:
+                content = gitfilter.read_content(stdout)
+                self.assertEqual(gitfilter.read_text_list(stdout), [])
+                responses.append(content)
+            else:
+                responses.append(status)
+        return responses
+
+    def test_smudge_then_clean_reuses_ciphertext(self):
+        """Test that unchanged plaintext cleans back to the original ciphertext"""
+        ciphertext = self.vault.encrypt(b"secret: value\n")
+        vault_filter = gitfilter.VaultFilter(VAULT_PASSWORD, cat_file=_NoIndex())
+
+        smudged, cleaned, changed = self.run_session(
+            [
+                ("smudge", "vault.yml", ciphertext),
+                ("clean", "vault.yml", b"secret: value\n"),
+                ("clean", "vault.yml", b"secret: other\n"),
+            ],
+            vault_filter,
+        )
+
+        self.assertEqual(smudged, b"secret: value\n")
+        self.assertEqual(cleaned, ciphertext)
+        self.assertNotEqual(changed, ciphertext)
+        self.assertEqual(self.vault.decrypt(changed), b"secret: other\n")
+
+    def test_clean_keeps_the_label_per_file(self):
+        """Test that edits keep the vault id label and files never share ciphertexts"""
+        from pilfer import codec
+
+        labelled = codec.VaultCodec(VAULT_PASSWORD).encrypt(b"a: 1\n", vault_id="prod")
+        vault_filter = gitfilter.VaultFilter(VAULT_PASSWORD, cat_file=_NoIndex())
+
+        _, edited, other = self.run_session(
+            [
+                ("smudge", "id.yml", labelled),
+                ("clean", "id.yml", b"a: 2\n"),
+                ("clean", "copy.yml", b"a: 1\n"),
+            ],
+            vault_filter,
+        )
+
+        self.assertTrue(edited.startswith(b"$ANSIBLE_VAULT;1.2;AES256;prod\n"))
+        self.assertEqual(self.vault.decrypt(edited), b"a: 2\n")
+        self.assertNotEqual(other, labelled)
+        self.assertTrue(other.startswith(b"$ANSIBLE_VAULT;1.1;AES256\n"))
+
+    def test_large_content_and_errors(self):
+        """Test multi-packet content and per-file error status"""
+        plaintext = b"x" * (gitfilter.MAX_PACKET_DATA * 3 + 7)
+        vault_filter = gitfilter.VaultFilter(VAULT_PASSWORD, cat_file=_NoIndex())
+
+        cleaned, failed = self.run_session(
+            [
+                ("clean", "big.yml", plaintext),
+                ("smudge", "bad.yml", b"$ANSIBLE_VAULT;1.1;AES256\nzz\n"),
+            ],
+            vault_filter,
+        )
+
+        self.assertEqual(self.vault.decrypt(cleaned), plaintext)
+        self.assertEqual(failed, ["status=error"])
+
+
+class _NoIndex:
+    def get(self, object_name):
+        return None
+
+    def close(self):
+        pass
+
+
+class TestGitIntegration(unittest.TestCase):
+    """Test the filter driven by a real git process"""
+
+    def setUp(self):
+        if shutil.which("git") is None:
+            self.skipTest("git is not installed")
+
+        self.test_dir = tempfile.mkdtemp()
+        self.original_cwd = os.getcwd()
+        os.chdir(self.test_dir)
+
+        # keep the password outside the repository under test
+        fd, self.password_file = tempfile.mkstemp()
+        with os.fdopen(fd, "wb") as f:
+            f.write(VAULT_PASSWORD)
+
+        self.env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+        self.git("init", "-q")
+        self.git("config", "user.email", "pilfer@example.com")
+        self.git("config", "user.name", "pilfer")
+        self.git(
+            "config",
+            "filter.vault.process",
+            f"'{sys.executable}' -m pilfer.cli git-filter -p '{self.password_file}'",
+        )
+        self.git("config", "filter.vault.required", "true")
+        with open(".gitattributes", "w") as f:
+            f.write("*.vault.yml filter=vault\n")
+
+    def tearDown(self):
+        os.chdir(self.original_cwd)
+        shutil.rmtree(self.test_dir)
+        os.remove(self.password_file)
+
+    def git(self, *args):
+        return subprocess.run(
+            ["git"] + list(args), check=True, stdout=subprocess.PIPE, env=self.env
+        ).stdout
+
+    def test_round_trip_without_spurious_changes(self):
+        """Test that git stores ciphertext, checks out plaintext and sees no churn"""
+        with open("secrets.vault.yml", "wb") as f:
+            f.write(b"password: hunter2\n")
+        self.git("add", "-A")
+        self.git("commit", "-q", "-m", "add secrets")
+
+        stored = self.git("cat-file", "-p", "HEAD:secrets.vault.yml")
+        self.assertTrue(stored.startswith(b"$ANSIBLE_VAULT;"))
+
+        os.remove("secrets.vault.yml")
+        self.git("checkout", "--", "secrets.vault.yml")
+        with open("secrets.vault.yml", "rb") as f:
+            self.assertEqual(f.read(), b"password: hunter2\n")
+
+        # make the file stat-dirty so git has to run clean again
+        future = time.time() + 5
+        os.utime("secrets.vault.yml", (future, future))
+        self.git("add", "secrets.vault.yml")
+        self.assertEqual(self.git("status", "--porcelain"), b"")
+
+        with open("secrets.vault.yml", "wb") as f:
+            f.write(b"password: correct horse\n")
+        self.assertIn(b"secrets.vault.yml", self.git("status", "--porcelain"))
+
+
+if __name__ == "__main__":
+    unittest.main()
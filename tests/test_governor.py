@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Tests for the resource governor
+"""
+
+import io
+import os
+import sys
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pilfer import governor, pipeline  # noqa: E402
+
+
+class TestGovernor(unittest.TestCase):
+    """Test worker, in-flight data and bandwidth limits"""
+
+    def setUp(self):
+        self.stream = io.StringIO()
+
+    def tearDown(self):
+        governor.current = governor.Governor()
+
+    def configure(self, **limits):
+        return governor.configure(stream=self.stream, **limits)
+
+    def test_parse_size(self):
+        """Test byte counts with and without suffixes"""
+        self.assertEqual(governor.parse_size("512"), 512)
+        self.assertEqual(governor.parse_size("64k"), 64 << 10)
+        self.assertEqual(governor.parse_size("1.5MB"), 3 << 19)
+        self.assertEqual(governor.parse_size("2G"), 2 << 30)
+        for invalid in ("", "0", "-1M", "lots"):
+            with self.assertRaises(ValueError):
+                governor.parse_size(invalid)
+
+    def test_worker_counts_are_positive(self):
+        """Test that worker counts below 1 are rejected, or raised to 1"""
+        self.assertEqual(governor.positive_int("3"), 3)
+        for invalid in ("0", "-2", "many"):
+            with self.assertRaises(ValueError):
+                governor.positive_int(invalid)
+        self.assertEqual(self.configure().workers(0), 1)
+
+    def test_workers_are_capped_and_reported(self):
+        """Test that pools are capped at max_workers with one notice per pool"""
+        limits = self.configure(max_workers=2)
+        self.assertEqual(limits.workers(8), 2)
+        self.assertEqual(limits.workers(8), 2)
+        self.assertEqual(limits.workers(1), 1)
+        self.assertEqual(self.stream.getvalue().count("Limiting crypto workers"), 1)
+
+    def test_stream_map_bounds_in_flight_bytes(self):
+        """Test that a stage never holds more data than the limit, bar one item"""
+        self.configure(max_in_flight_bytes=300)
+        lock = threading.Lock()
+        state = {"bytes": 0, "peak": 0}
+        release = threading.Event()
+
+        def work(path, data):
+            with lock:
+                state["bytes"] += len(data)
+                state["peak"] = max(state["peak"], state["bytes"])
+            release.wait(5)
+            with lock:
+                state["bytes"] -= len(data)
+            return len(data)
+
+        items = [(str(i), b"x" * 100) for i in range(20)] + [("big", b"x" * 1000)]
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            threading.Timer(0.1, release.set).start()
+            results = [
+                future.result()
+                for _, future in pipeline.stream_map(work, items, executor)
+            ]
+
+        self.assertEqual(sorted(results), [100] * 20 + [1000])
+        self.assertLessEqual(state["peak"], 1000)
+        self.assertGreater(governor.current.stats()["held_items"], 0)
+        self.assertIn("In-flight data limit", self.stream.getvalue())
+
+    def test_io_rate_limit_sleeps_off_the_deficit(self):
+        """Test that I/O beyond the rate sleeps and is counted in stats"""
+        limits = self.configure(io_rate=1000)
+        with mock.patch.object(governor.time, "sleep") as sleep:
+            limits.throttle_io(1000)
+            sleep.assert_not_called()
+            limits.throttle_io(500)
+        self.assertAlmostEqual(sleep.call_args[0][0], 0.5, places=1)
+        self.assertAlmostEqual(limits.stats()["throttled_io_s"], 0.5, places=1)
+        self.assertIn("I/O limit", self.stream.getvalue())
+
+    def test_no_limits_no_stats(self):
+        """Test that an unlimited governor changes nothing and reports nothing"""
+        limits = self.configure()
+        self.assertEqual(limits.workers(64), 64)
+        self.assertTrue(limits.admits(1 << 40, 1 << 40))
+        self.assertEqual(limits.stats(), {})
+        self.assertEqual(self.stream.getvalue(), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
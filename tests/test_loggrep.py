@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Tests for pilfer log-grep
+"""
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pilfer import git, loggrep  # noqa: E402
+from tests.test_diff import VAULT_PASSWORD, GitRepoTestCase  # noqa: E402
+
+
+class TestLogGrep(GitRepoTestCase):
+    """Test searching vault plaintext across history"""
+
+    def setUp(self):
+        super().setUp()
+        self.write_vault("group_vars/all.yml", b"db_host: old.example.com\n")
+        with open("README", "w") as f:
+            f.write("see example.com\n")
+        self.commit("first")
+        self.first = self.git("rev-parse", "HEAD").decode("ascii").strip()
+
+        self.write_vault("group_vars/all.yml", b"db_host: new.example.com\n")
+        self.commit("second")
+        self.second = self.git("rev-parse", "HEAD").decode("ascii").strip()
+
+    def test_finds_secret_and_commits(self):
+        """Test that a value is found in history and mapped to its commits"""
+        results = list(loggrep.log_grep(VAULT_PASSWORD, r"old\.example", jobs=2))
+
+        self.assertEqual(len(results), 1)
+        result = results[0]
+        self.assertEqual(result["path"], "group_vars/all.yml")
+        self.assertEqual(result["matches"], [(1, "db_host: old.example.com")])
+        # added by the first commit, replaced by the second
+        self.assertEqual(
+            [commit["commit"] for commit in result["commits"]],
+            [self.second, self.first],
+        )
+
+    def test_only_vaults_are_searched(self):
+        """Test that plain files are skipped and every vault version is searched"""
+        results = list(
+            loggrep.log_grep(
+                VAULT_PASSWORD,
+                "EXAMPLE.COM",
+                jobs=1,
+                ignore_case=True,
+                fixed_strings=True,
+            )
+        )
+        self.assertEqual(
+            sorted(line for result in results for _, line in result["matches"]),
+            ["db_host: new.example.com", "db_host: old.example.com"],
+        )
+
+    def test_repeated_search_uses_cache(self):
+        """Test that a second search decrypts and reads nothing it has seen"""
+        list(loggrep.log_grep(VAULT_PASSWORD, "nothing", jobs=1))
+
+        with mock.patch.object(
+            loggrep.pipeline, "crypto_executor", side_effect=AssertionError("decrypted")
+        ), mock.patch.object(
+            git.CatFileBatch, "get", side_effect=AssertionError("read a blob")
+        ):
+            results = list(loggrep.log_grep(VAULT_PASSWORD, "new", jobs=1))
+
+        self.assertEqual([result["path"] for result in results], ["group_vars/all.yml"])
+
+    def test_git_errors_are_reported_briefly(self):
+        """Test that a bad revision exits 2 without a traceback"""
+        with open("vault_pass", "wb") as f:
+            f.write(VAULT_PASSWORD)
+        code, stderr = self.run_cli(
+            "log-grep", "-p", "vault_pass", "example", "nosuchrev"
+        )
+        self.assertEqual(code, 2)
+        self.assertIn("pilfer log-grep: git exited", stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
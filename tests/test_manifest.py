@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Tests for the JSON-lines session manifest and pilfer status
+"""
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ansible.constants import DEFAULT_VAULT_ID_MATCH  # noqa: E402
+from ansible.parsing.vault import VaultLib, VaultSecret  # noqa: E402
+
+from pilfer import cli as pilfer_cli  # noqa: E402
+from pilfer import manifest  # noqa: E402
+
+
+class TestManifest(unittest.TestCase):
+    """Test manifest records, status classification and legacy manifests"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.original_cwd = os.getcwd()
+        os.chdir(self.test_dir)
+
+        with open("vault_pass", "w") as f:
+            f.write("test_password")
+
+        self.vault = VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(b"test_password"))])
+        for name in ("one.yml", "two.yml", "three.yml"):
+            with open(name, "wb") as f:
+                f.write(self.vault.encrypt(b"secret: " + name.encode("utf-8") + b"\n"))
+        with open("labelled.yml", "wb") as f:
+            f.write(self.vault.encrypt(b"labelled: true\n", vault_id="prod"))
+
+    def tearDown(self):
+        os.chdir(self.original_cwd)
+        shutil.rmtree(self.test_dir)
+
+    def open_session(self, jobs=1):
+        pilfer_cli.decrypt_vault_files(
+            "vault_pass", pilfer_cli.discover_vault_files(), jobs=jobs
+        )
+
+    def records(self):
+        return {
+            os.path.basename(record["path"]): record
+            for record in manifest.iter_records(
+                pilfer_cli.temp_vault_file_list_path, manifest.DECRYPTED
+            )
+        }
+
+    def test_records_carry_metadata(self):
+        """Test that each decrypted file is recorded with stat, vault and hash data"""
+        self.open_session()
+
+        with open(pilfer_cli.temp_vault_file_list_path) as f:
+            header = json.loads(f.readline())
+        self.assertEqual(header["pilfer_manifest"], manifest.MANIFEST_VERSION)
+
+        records = self.records()
+        self.assertEqual(
+            sorted(records), ["labelled.yml", "one.yml", "three.yml", "two.yml"]
+        )
+        one = records["one.yml"]
+        self.assertEqual(one["hash"], hashlib.sha256(b"secret: one.yml\n").hexdigest())
+        self.assertEqual(one["size"], os.stat("one.yml").st_size)
+        self.assertEqual(one["mtime_ns"], os.stat("one.yml").st_mtime_ns)
+        self.assertEqual(one["vault_version"], "1.1")
+        self.assertIsNone(one["vault_id"])
+        self.assertEqual(records["labelled.yml"]["vault_version"], "1.2")
+        self.assertEqual(records["labelled.yml"]["vault_id"], "prod")
+
+        self.assertEqual(pilfer_cli.recrypt_vault_files("vault_pass", jobs=1), 0)
+
+    def test_close_keeps_vault_id_label(self):
+        """Test that a modified 1.2 vault is re-encrypted with its label"""
+        self.open_session()
+        with open("labelled.yml", "ab") as f:
+            f.write(b"more: stuff\n")
+
+        self.assertEqual(pilfer_cli.recrypt_vault_files("vault_pass", jobs=1), 1)
+        with open("labelled.yml", "rb") as f:
+            encrypted = f.read()
+        self.assertTrue(encrypted.startswith(b"$ANSIBLE_VAULT;1.2;AES256;prod\n"))
+        self.assertEqual(
+            self.vault.decrypt(encrypted), b"labelled: true\nmore: stuff\n"
+        )
+
+    def test_reopen_resumes_without_duplicates(self):
+        """Test that a second open only picks up files that are still encrypted"""
+        self.open_session()
+        with open("late.yml", "wb") as f:
+            f.write(self.vault.encrypt(b"late: true\n"))
+        self.open_session()
+
+        paths = [
+            record["path"]
+            for record in manifest.iter_records(
+                pilfer_cli.temp_vault_file_list_path, manifest.DECRYPTED
+            )
+        ]
+        self.assertEqual(len(paths), len(set(paths)))
+        self.assertIn(os.path.abspath("late.yml"), paths)
+        self.assertEqual(pilfer_cli.recrypt_vault_files("vault_pass", jobs=1), 0)
+
+    def test_interrupted_open_leaves_nothing_untracked(self):
+        """Test that close restores every file an interrupted open swapped"""
+        os.mkdir("many")
+        for i in range(200):
+            with open(os.path.join("many", f"{i}.yml"), "wb") as f:
+                f.write(self.vault.encrypt(b"number: %d\n" % i))
+        originals = {}
+        for path in pilfer_cli.discover_vault_files():
+            with open(path, "rb") as f:
+                originals[path] = f.read()
+
+        write = manifest.ManifestWriter.write
+        decrypted = []
+
+        def interrupt_third_decrypted(manifest_writer, record):
+            if record.get("state") == manifest.DECRYPTED:
+                decrypted.append(record["path"])
+                if len(decrypted) == 3:
+                    raise KeyboardInterrupt
+            write(manifest_writer, record)
+
+        with mock.patch.object(
+            manifest.ManifestWriter, "write", interrupt_third_decrypted
+        ):
+            with self.assertRaises(KeyboardInterrupt):
+                self.open_session(jobs=2)
+
+        plaintext = set()
+        for path, encrypted in originals.items():
+            with open(path, "rb") as f:
+                if not f.read().startswith(b"$ANSIBLE_VAULT;"):
+                    plaintext.add(path)
+        self.assertIn(decrypted[2], plaintext)
+        opened = {
+            path
+            for _, path in manifest.status(
+                pilfer_cli.temp_vault_file_list_path, include_new=False
+            )
+        }
+        self.assertLessEqual(plaintext, opened)
+
+        self.assertEqual(pilfer_cli.recrypt_vault_files("vault_pass", jobs=2), 0)
+        for path, encrypted in originals.items():
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), encrypted, path)
+        self.assertFalse(os.path.exists(pilfer_cli.temp_vault_file_list_path))
+        self.assertFalse(
+            os.path.exists(pilfer_cli.temp_hidden_encrypted_copies_directory_path)
+        )
+
+    def test_failed_close_keeps_failed_files_open(self):
+        """Test that close keeps the records of files it could not re-encrypt"""
+        self.open_session()
+        # unreadable as a file
+        os.remove("one.yml")
+        os.mkdir("one.yml")
+
+        with mock.patch.object(
+            sys, "argv", ["pilfer", "close", "-p", "vault_pass", "-j", "1"]
+        ), mock.patch("sys.stderr", io.StringIO()) as stderr:
+            self.assertEqual(pilfer_cli.main(), 1)
+        self.assertIn("still open", stderr.getvalue())
+        self.assertEqual(list(self.records()), ["one.yml"])
+        with open("two.yml", "rb") as f:
+            self.assertTrue(f.read().startswith(b"$ANSIBLE_VAULT;"))
+
+        os.rmdir("one.yml")
+        with open("one.yml", "wb") as f:
+            f.write(b"secret: edited\n")
+        self.assertEqual(pilfer_cli.recrypt_vault_files("vault_pass", jobs=1), 1)
+        self.assertFalse(os.path.exists(pilfer_cli.temp_vault_file_list_path))
+
+    def close_cli(self):
+        with mock.patch.object(
+            sys, "argv", ["pilfer", "close", "-p", "vault_pass", "-j", "1"]
+        ), mock.patch("sys.stdout", io.StringIO()) as stdout:
+            return pilfer_cli.main(), stdout.getvalue()
+
+    def assert_closed(self):
+        self.assertFalse(os.path.exists(pilfer_cli.temp_vault_file_list_path))
+        self.assertFalse(
+            os.path.exists(pilfer_cli.temp_hidden_encrypted_copies_directory_path)
+        )
+
+    def test_close_after_a_killed_close(self):
+        """Test that files an earlier close restored are dropped, not failed"""
+        self.open_session()
+        # restored by a close that was killed before removing the manifest
+        one = os.path.abspath("one.yml")
+        os.replace(pilfer_cli.stash_path(one, "encrypted"), one)
+        # and one written back but whose stash was never removed
+        two = os.path.abspath("two.yml")
+        with open(two, "wb") as f:
+            f.write(self.vault.encrypt(b"secret: rewritten\n"))
+
+        code, stdout = self.close_cli()
+        self.assertEqual(code, 0)
+        self.assertIn("one.yml is encrypted already", stdout)
+        self.assertIn("two.yml is encrypted already", stdout)
+        self.assert_closed()
+        with open(two, "rb") as f:
+            self.assertEqual(self.vault.decrypt(f.read()), b"secret: rewritten\n")
+
+    def test_close_drops_deleted_and_symlinked_files(self):
+        """Test that vaults deleted during the session are reported and dropped"""
+        os.symlink("one.yml", "link.yml")
+        self.open_session()
+        self.assertNotIn("link.yml", self.records())
+        os.remove("two.yml")
+
+        code, stdout = self.close_cli()
+        self.assertEqual(code, 0)
+        self.assertIn("two.yml was deleted", stdout)
+        self.assert_closed()
+        self.assertFalse(os.path.exists("two.yml"))
+        self.assertTrue(os.path.islink("link.yml"))
+
+    def test_status(self):
+        """Test stat-only classification of modified, missing and new files"""
+        self.open_session()
+        time.sleep(0.01)
+
+        with open("one.yml", "ab") as f:
+            f.write(b"more: stuff\n")
+        os.remove("two.yml")
+        with open("brand_new.yml", "w") as f:
+            f.write("new: file\n")
+
+        statuses = {
+            os.path.basename(path): file_status
+            for file_status, path in manifest.status(
+                pilfer_cli.temp_vault_file_list_path,
+                exclude_dirs=[pilfer_cli.temp_hidden_encrypted_copies_directory_path],
+            )
+        }
+        self.assertEqual(
+            statuses,
+            {
+                "one.yml": "modified",
+                "two.yml": "missing",
+                "three.yml": "unchanged",
+                "labelled.yml": "unchanged",
+                "brand_new.yml": "new",
+            },
+        )
+
+    def test_legacy_manifest_still_closes(self):
+        """Test closing a session opened by an older pilfer (JSON list + hash files)"""
+        path = os.path.abspath("one.yml")
+        with open(path, "rb") as f:
+            encrypted = f.read()
+        stash = pilfer_cli.temp_hidden_encrypted_copies_directory_path + path
+        os.makedirs(stash)
+        with open(os.path.join(stash, "encrypted"), "wb") as f:
+            f.write(encrypted)
+        with open(os.path.join(stash, "hash"), "w") as f:
+            f.write(hashlib.sha256(b"secret: one.yml\n").hexdigest())
+        with open(path, "wb") as f:
+            f.write(b"secret: one.yml\n")
+        with open(pilfer_cli.legacy_vault_file_list_path, "w") as f:
+            json.dump([path], f, indent=2)
+
+        self.assertEqual(pilfer_cli.recrypt_vault_files("vault_pass", jobs=1), 0)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), encrypted)
+        self.assertFalse(os.path.exists(pilfer_cli.legacy_vault_file_list_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
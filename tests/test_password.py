@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Tests for vault password files, password scripts and secret caching
+"""
+
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ansible.constants import DEFAULT_VAULT_ID_MATCH  # noqa: E402
+from ansible.parsing.vault import VaultLib, VaultSecret  # noqa: E402
+
+from pilfer import cli as pilfer_cli  # noqa: E402
+from pilfer import password  # noqa: E402
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+PASSWORD_SCRIPT = """#!/bin/sh
+echo run >> "{counter}"
+if [ "$1" = "--vault-id" ]; then echo "$2" >> "{counter}.ids"; fi
+echo test_password
+"""
+
+
+class TestPasswordSources(unittest.TestCase):
+    """Test plain files, executables and vault id client scripts"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.original_cwd = os.getcwd()
+        os.chdir(self.test_dir)
+        self.counter = os.path.join(self.test_dir, "invocations")
+        self.original_ttl = password.secret_ttl
+        password.secret_ttl = 0
+
+        vault = VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(b"test_password"))])
+        with open("vault.yml", "wb") as f:
+            f.write(vault.encrypt(b"secret: value\n"))
+
+    def tearDown(self):
+        password.secret_ttl = self.original_ttl
+        password._resolved.clear()
+        os.chdir(self.original_cwd)
+        shutil.rmtree(self.test_dir)
+
+    def write_script(self, name, body=None):
+        path = os.path.join(self.test_dir, name)
+        with open(path, "w") as f:
+            f.write(body or PASSWORD_SCRIPT.format(counter=self.counter))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+        return path
+
+    def invocations(self):
+        if not os.path.exists(self.counter):
+            return 0
+        with open(self.counter) as f:
+            return len(f.readlines())
+
+    def test_plain_password_file(self):
+        """Test that a plain password file is read and stripped"""
+        with open("vault_pass", "w") as f:
+            f.write("test_password\n")
+        self.assertEqual(
+            password.resolve_vault_password("vault_pass"), b"test_password"
+        )
+
+    def test_executable_runs_once_per_process(self):
+        """Test that open and close share one password script invocation"""
+        script = self.write_script("vault-pass.sh")
+
+        pilfer_cli.write_vaulted_file_list()
+        pilfer_cli.decrypt_vault_files(script, jobs=1)
+        with open("vault.yml", "rb") as f:
+            self.assertEqual(f.read(), b"secret: value\n")
+        self.assertEqual(pilfer_cli.recrypt_vault_files(script, jobs=1), 0)
+
+        self.assertEqual(self.invocations(), 1)
+
+    def test_client_script_receives_vault_id(self):
+        """Test that *-client scripts are called with --vault-id"""
+        script = self.write_script("vault-keyring-client.sh")
+
+        secret = pilfer_cli.read_vault_password(vault_id=f"prod@{script}")
+
+        self.assertEqual(secret, b"test_password")
+        with open(self.counter + ".ids") as f:
+            self.assertEqual(f.read(), "prod\n")
+
+    def test_failing_script_raises(self):
+        """Test that a non-zero exit from a password script is an error"""
+        script = self.write_script("broken.sh", "#!/bin/sh\necho nope >&2\nexit 3\n")
+
+        with self.assertRaises(RuntimeError) as context:
+            password.resolve_vault_password(script)
+        self.assertIn("nope", str(context.exception))
+
+
+class TestKeyringSession(unittest.TestCase):
+    """Test that the secret is cached in the kernel keyring between commands"""
+
+    def setUp(self):
+        if password.KernelKeyring.library() is None:
+            self.skipTest("libkeyutils is not available")
+        if not password.KernelKeyring.put("pilfer:test-probe", b"x", 5):
+            self.skipTest("the kernel keyring is not usable here")
+        password.KernelKeyring.forget("pilfer:test-probe")
+
+        self.test_dir = tempfile.mkdtemp()
+        self.original_cwd = os.getcwd()
+        os.chdir(self.test_dir)
+        self.counter = os.path.join(self.test_dir, "invocations")
+        self.script = os.path.join(self.test_dir, "vault-pass.sh")
+        with open(self.script, "w") as f:
+            f.write(PASSWORD_SCRIPT.format(counter=self.counter))
+        os.chmod(self.script, 0o700)
+
+        vault = VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(b"test_password"))])
+        with open("vault.yml", "wb") as f:
+            f.write(vault.encrypt(b"secret: value\n"))
+
+    def tearDown(self):
+        password.forget_vault_password(self.script)
+        os.chdir(self.original_cwd)
+        shutil.rmtree(self.test_dir)
+
+    def run_pilfer(self, *args):
+        env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+        cmd = [sys.executable, "-m", "pilfer.cli"] + list(args) + ["-p", self.script]
+        result = subprocess.run(cmd, capture_output=True, text=True, env=env)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    def invocations(self):
+        with open(self.counter) as f:
+            return len(f.readlines())
+
+    def test_session_invokes_client_once(self):
+        """Test one client invocation per session, and a fresh one afterwards"""
+        self.run_pilfer("open")
+        self.run_pilfer("close")
+        self.assertEqual(self.invocations(), 1)
+
+        # close ended the session, so the next command asks the client again
+        self.run_pilfer("verify")
+        self.assertEqual(self.invocations(), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
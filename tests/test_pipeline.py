@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Tests for the streaming open/close pipeline
+"""
+
+import binascii
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ansible.constants import DEFAULT_VAULT_ID_MATCH  # noqa: E402
+from ansible.parsing.vault import VaultLib, VaultSecret  # noqa: E402
+
+from pilfer import cli as pilfer_cli  # noqa: E402
+from pilfer import codec, pipeline  # noqa: E402
+
+
+class TestPipelineHelpers(unittest.TestCase):
+    """Test the generic pipeline building blocks"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_discovery_prunes_git_and_excluded_dirs(self):
+        """Test that .git and excluded directories are not searched"""
+        for directory in ("roles", ".git", ".vault"):
+            os.makedirs(os.path.join(self.test_dir, directory))
+            with open(os.path.join(self.test_dir, directory, "vault.yml"), "wb") as f:
+                f.write(b"$ANSIBLE_VAULT;1.1;AES256\n00\n")
+        with open(os.path.join(self.test_dir, "plain.yml"), "wb") as f:
+            f.write(b"not: encrypted\n")
+
+        found = list(
+            pipeline.iter_vaulted_files(
+                self.test_dir, exclude_dirs=[os.path.join(self.test_dir, ".vault")]
+            )
+        )
+        self.assertEqual(found, [os.path.join(self.test_dir, "roles", "vault.yml")])
+
+    def test_stream_map_bounds_in_flight_calls(self):
+        """Test that stream_map never has more than max_in_flight calls outstanding"""
+        lock = threading.Lock()
+        state = {"running": 0, "peak": 0}
+
+        def work(value):
+            with lock:
+                state["running"] += 1
+                state["peak"] = max(state["peak"], state["running"])
+            with lock:
+                state["running"] -= 1
+            return value * 2
+
+        with ThreadPoolExecutor(8) as executor:
+            results = pipeline.stream_map(
+                work, ((i,) for i in range(100)), executor, max_in_flight=3
+            )
+            doubled = sorted(future.result() for _, future in results)
+
+        self.assertEqual(doubled, [i * 2 for i in range(100)])
+        self.assertLessEqual(state["peak"], 3)
+
+    def test_threaded_iter_reraises_producer_errors(self):
+        """Test that errors in the producer thread reach the consumer"""
+
+        def broken():
+            yield 1
+            raise ValueError("walk failed")
+
+        with self.assertRaises(ValueError):
+            list(pipeline.threaded_iter(broken()))
+
+
+class TestParallelOpenClose(unittest.TestCase):
+    """Test open/close with the worker pools enabled and disabled"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.original_cwd = os.getcwd()
+        os.chdir(self.test_dir)
+
+        with open("vault_pass", "w") as f:
+            f.write("test_password")
+
+        vault = VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(b"test_password"))])
+        self.plaintexts = {}
+        for i in range(12):
+            path = os.path.join("group_vars", f"host{i}", "vault.yml")
+            os.makedirs(os.path.dirname(path))
+            self.plaintexts[path] = f"secret_{i}: value{i}\n".encode("utf-8")
+            with open(path, "wb") as f:
+                f.write(vault.encrypt(self.plaintexts[path]))
+
+        self.originals = {}
+        for path in self.plaintexts:
+            with open(path, "rb") as f:
+                self.originals[path] = f.read()
+
+    def tearDown(self):
+        os.chdir(self.original_cwd)
+        shutil.rmtree(self.test_dir)
+
+    def open_and_close(self, jobs):
+        pilfer_cli.decrypt_vault_files(
+            "vault_pass", pilfer_cli.discover_vault_files(), jobs=jobs
+        )
+
+        for path, plaintext in self.plaintexts.items():
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), plaintext)
+
+        with open(os.path.join("group_vars", "host3", "vault.yml"), "wb") as f:
+            f.write(b"secret_3: changed\n")
+
+        modified_count = pilfer_cli.recrypt_vault_files("vault_pass", jobs=jobs)
+        self.assertEqual(modified_count, 1)
+        self.assertFalse(os.path.exists(pilfer_cli.temp_vault_file_list_path))
+        self.assertFalse(
+            os.path.exists(pilfer_cli.temp_hidden_encrypted_copies_directory_path)
+        )
+
+        for path, original in self.originals.items():
+            with open(path, "rb") as f:
+                data = f.read()
+            if path.endswith(os.path.join("host3", "vault.yml")):
+                self.assertNotEqual(data, original)
+            else:
+                self.assertEqual(data, original)
+
+    def test_serial(self):
+        """Test the inline (jobs=1) pipeline"""
+        self.open_and_close(jobs=1)
+
+    def test_parallel(self):
+        """Test the threaded and multi-process pipeline"""
+        self.open_and_close(jobs=3)
+
+    def test_close_preserves_metadata(self):
+        """Test that unchanged vaults come back stat-identical and modes survive"""
+        for index, path in enumerate(sorted(self.plaintexts)):
+            os.chmod(path, 0o600 if index % 2 else 0o640)
+            os.utime(path, ns=(1000000000 * index, 1000000000 * index))
+        before = {path: os.stat(path) for path in self.plaintexts}
+        changed = os.path.join("group_vars", "host3", "vault.yml")
+
+        pilfer_cli.decrypt_vault_files(
+            "vault_pass", pilfer_cli.discover_vault_files(), jobs=2
+        )
+        for path in self.plaintexts:
+            self.assertEqual(os.stat(path).st_mode, before[path].st_mode)
+        with open(changed, "wb") as f:
+            f.write(b"secret_3: changed\n")
+        self.assertEqual(pilfer_cli.recrypt_vault_files("vault_pass", jobs=2), 1)
+
+        for path, original in before.items():
+            after = os.stat(path)
+            self.assertEqual(after.st_mode, original.st_mode)
+            if path == changed:
+                continue
+            self.assertEqual(after.st_ino, original.st_ino)
+            self.assertEqual(after.st_mtime_ns, original.st_mtime_ns)
+            self.assertEqual(after.st_size, original.st_size)
+
+    def test_session_salt(self):
+        """Test that a session salt close shares one salt between modified files"""
+        pilfer_cli.decrypt_vault_files(
+            "vault_pass", pilfer_cli.discover_vault_files(), jobs=2
+        )
+        changed = sorted(self.plaintexts)[:3]
+        for path in changed:
+            with open(path, "wb") as f:
+                f.write(b"changed: " + path.encode("utf-8") + b"\n")
+
+        modified_count = pilfer_cli.recrypt_vault_files(
+            "vault_pass", jobs=2, session_salt=True
+        )
+        self.assertEqual(modified_count, 3)
+
+        vault = VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(b"test_password"))])
+        salts = set()
+        for path in self.plaintexts:
+            with open(path, "rb") as f:
+                data = f.read()
+            if path in changed:
+                self.assertEqual(
+                    vault.decrypt(data), b"changed: " + path.encode("utf-8") + b"\n"
+                )
+                _, _, payload = codec.parse_envelope(data)
+                salts.add(binascii.unhexlify(payload).split(b"\n")[0])
+            else:
+                self.assertEqual(data, self.originals[path])
+        self.assertEqual(len(salts), 1)
+
+    def test_failed_file_does_not_stop_others(self):
+        """Test that a vault that cannot be decrypted is reported and skipped"""
+        with open("broken.yml", "wb") as f:
+            f.write(b"$ANSIBLE_VAULT;1.1;AES256\nnot-hex\n")
+
+        pilfer_cli.decrypt_vault_files(
+            "vault_pass", pilfer_cli.discover_vault_files(), jobs=2
+        )
+
+        with open("broken.yml", "rb") as f:
+            self.assertTrue(f.read().startswith(b"$ANSIBLE_VAULT;"))
+        for path, plaintext in self.plaintexts.items():
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), plaintext)
+
+
+if __name__ == "__main__":
+    unittest.main()
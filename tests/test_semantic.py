@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Tests for semantic change detection on close
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ansible.constants import DEFAULT_VAULT_ID_MATCH  # noqa: E402
+from ansible.parsing.vault import VaultLib, VaultSecret  # noqa: E402
+
+from pilfer import cli as pilfer_cli  # noqa: E402
+from pilfer import semantic  # noqa: E402
+
+ORIGINAL = b"""---
+# database settings
+db:
+  user: admin
+  port: 5432
+  hosts: [a, b]
+"""
+
+
+class TestSemanticComparison(unittest.TestCase):
+    """Test which edits count as semantically unchanged"""
+
+    def test_formatting_only_edits_are_the_same(self):
+        """Test that comments, whitespace, style and key order are ignored"""
+        reformatted = (
+            b"db:   \n  port: 5432\n  hosts:\n    - a\n    - 'b'\n  user: admin\n\n\n"
+        )
+        self.assertTrue(semantic.same_content(ORIGINAL, reformatted))
+        self.assertTrue(
+            semantic.same_content(
+                b'{"a": [1, 2], "b": null}', b'{\n  "b": null,\n  "a": [1, 2]\n}\n'
+            )
+        )
+
+    def test_value_and_type_changes_differ(self):
+        """Test that changed values, and equal values of another type, differ"""
+        self.assertFalse(
+            semantic.same_content(ORIGINAL, ORIGINAL.replace(b"5432", b"5433"))
+        )
+        self.assertFalse(
+            semantic.same_content(ORIGINAL, ORIGINAL.replace(b"5432", b"5432.0"))
+        )
+        self.assertFalse(
+            semantic.same_content(ORIGINAL, ORIGINAL.replace(b"5432", b"'5432'"))
+        )
+        self.assertFalse(semantic.same_content(b"a: 1\n", b"a: true\n"))
+
+    def test_sets(self):
+        """Test that YAML sets compare by members, and odd data never raises"""
+        self.assertTrue(
+            semantic.same_content(
+                b"s: !!set {a: null, b: null}\n", b"s: !!set {b, a}\n"
+            )
+        )
+        self.assertFalse(
+            semantic.same_content(b"s: !!set {a, b}\n", b"s: !!set {a, c}\n")
+        )
+        self.assertFalse(semantic.same_content(b"a: 1\n", b"a: 2001-02-30\n"))
+
+    def test_unstructured_content_compares_bytes(self):
+        """Test that scalars (e.g. certificates) and invalid YAML are never merged"""
+        pem = b"-----BEGIN CERTIFICATE-----\nMIIB\nAAAA\n-----END CERTIFICATE-----\n"
+        self.assertFalse(semantic.same_content(pem, pem.replace(b"\nAAAA", b" AAAA")))
+        self.assertFalse(semantic.same_content(b"a: [1\n", b"a: [1 \n"))
+        self.assertTrue(semantic.same_content(b"a: [1\n", b"a: [1\n"))
+
+
+class TestSemanticClose(unittest.TestCase):
+    """Test pilfer close --semantic end to end"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.original_cwd = os.getcwd()
+        os.chdir(self.test_dir)
+
+        with open("vault_pass", "w") as f:
+            f.write("test_password")
+        self.vault = VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(b"test_password"))])
+        self.originals = {}
+        for name in ("reformatted.yml", "changed.yml", "untouched.yml"):
+            self.originals[name] = self.vault.encrypt(ORIGINAL)
+            with open(name, "wb") as f:
+                f.write(self.originals[name])
+
+    def tearDown(self):
+        os.chdir(self.original_cwd)
+        shutil.rmtree(self.test_dir)
+
+    def open_and_edit(self):
+        pilfer_cli.decrypt_vault_files(
+            "vault_pass", pilfer_cli.discover_vault_files(), jobs=1
+        )
+        with open("reformatted.yml", "wb") as f:
+            f.write(ORIGINAL.replace(b"# database settings\n", b"") + b"\n")
+        with open("changed.yml", "wb") as f:
+            f.write(ORIGINAL.replace(b"admin", b"root"))
+
+    def test_semantic_close_keeps_original_ciphertext(self):
+        """Test that only the file whose data changed gets new ciphertext"""
+        self.open_and_edit()
+        self.assertEqual(pilfer_cli.recrypt_vault_files("vault_pass", semantic=True), 1)
+
+        for name in ("reformatted.yml", "untouched.yml"):
+            with open(name, "rb") as f:
+                self.assertEqual(f.read(), self.originals[name])
+        with open("changed.yml", "rb") as f:
+            self.assertEqual(
+                self.vault.decrypt(f.read()), ORIGINAL.replace(b"admin", b"root")
+            )
+
+    def test_default_close_compares_bytes(self):
+        """Test that without --semantic a formatting edit is re-encrypted"""
+        self.open_and_edit()
+        self.assertEqual(pilfer_cli.recrypt_vault_files("vault_pass", jobs=1), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
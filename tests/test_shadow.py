@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Tests for read-only shadow trees
+"""
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ansible.constants import DEFAULT_VAULT_ID_MATCH  # noqa: E402
+from ansible.parsing.vault import VaultLib, VaultSecret  # noqa: E402
+
+from pilfer import cli as pilfer_cli  # noqa: E402
+from pilfer import pipeline, shadow  # noqa: E402
+
+VAULT_PASSWORD = "test_password"
+
+
+class TestShadow(unittest.TestCase):
+    """Test building, refreshing and removing a shadow tree"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.project = os.path.join(self.test_dir, "project")
+        self.shadow_dir = os.path.join(self.test_dir, "shadow")
+        self.vault = VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(b"test_password"))])
+        self.write_vault("group_vars/all.yml", b"secret: one\n")
+        self.write_vault("host_vars/web.yml", b"secret: two\n")
+        with open(os.path.join(self.project, "plain.yml"), "wb") as f:
+            f.write(b"not: secret\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write_vault(self, relative_path, plaintext):
+        path = os.path.join(self.project, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(self.vault.encrypt(plaintext))
+
+    def read_shadow(self, relative_path):
+        with open(os.path.join(self.shadow_dir, relative_path), "rb") as f:
+            return f.read()
+
+    def build(self):
+        return shadow.build(self.shadow_dir, VAULT_PASSWORD, self.project, jobs=1)
+
+    def project_snapshot(self):
+        snapshot = {}
+        for root, _, files in os.walk(self.project):
+            for name in files:
+                path = os.path.join(root, name)
+                with open(path, "rb") as f:
+                    snapshot[path] = (f.read(), os.stat(path).st_mtime_ns)
+        return snapshot
+
+    def test_build_leaves_project_untouched(self):
+        """Test that vaults are mirrored decrypted and the project is unchanged"""
+        before = self.project_snapshot()
+        counts = self.build()
+
+        self.assertEqual(counts["decrypted"], 2)
+        self.assertEqual(self.read_shadow("group_vars/all.yml"), b"secret: one\n")
+        self.assertEqual(self.read_shadow("host_vars/web.yml"), b"secret: two\n")
+        self.assertFalse(os.path.exists(os.path.join(self.shadow_dir, "plain.yml")))
+        mode = os.stat(os.path.join(self.shadow_dir, "group_vars/all.yml")).st_mode
+        self.assertEqual(mode & 0o777, 0o600)
+        self.assertEqual(self.project_snapshot(), before)
+
+    def test_refresh_only_decrypts_changed_vaults(self):
+        """Test that a rebuild decrypts changed vaults and drops deleted ones"""
+        self.build()
+        with mock.patch.object(
+            pipeline, "decrypt_in_worker", side_effect=AssertionError("decrypted")
+        ):
+            counts = self.build()
+        self.assertEqual(counts["unchanged"], 2)
+
+        self.write_vault("group_vars/all.yml", b"secret: three\n")
+        os.remove(os.path.join(self.project, "host_vars/web.yml"))
+        counts = self.build()
+
+        self.assertEqual(
+            counts, {"decrypted": 1, "unchanged": 0, "removed": 1, "failed": 0}
+        )
+        self.assertEqual(self.read_shadow("group_vars/all.yml"), b"secret: three\n")
+        self.assertFalse(
+            os.path.exists(os.path.join(self.shadow_dir, "host_vars/web.yml"))
+        )
+
+    def test_workers_start_before_threads(self):
+        """Test that the crypto pool is created while the process has one thread"""
+        crypto_executor = pipeline.crypto_executor
+        active_threads = []
+
+        def record_threads(*args, **kwargs):
+            active_threads.append(threading.active_count())
+            return crypto_executor(*args, **kwargs)
+
+        with mock.patch.object(pipeline, "crypto_executor", record_threads):
+            shadow.build(self.shadow_dir, VAULT_PASSWORD, self.project, jobs=2)
+        self.assertEqual(active_threads, [threading.active_count()])
+
+    def test_refuses_unsafe_directories(self):
+        """Test that shadow dirs inside the project or holding other files are refused"""
+        with self.assertRaises(ValueError):
+            shadow.build(
+                os.path.join(self.project, "shadow"), VAULT_PASSWORD, self.project
+            )
+        os.makedirs(self.shadow_dir)
+        with open(os.path.join(self.shadow_dir, "unrelated"), "w") as f:
+            f.write("keep me")
+        with self.assertRaises(ValueError):
+            self.build()
+        with self.assertRaises(FileNotFoundError):
+            shadow.remove(self.shadow_dir)
+        self.assertTrue(os.path.exists(os.path.join(self.shadow_dir, "unrelated")))
+
+    def test_cli_refusals_are_reported_briefly(self):
+        """Test that refused shadow directories exit 2 without a traceback"""
+        password_file = os.path.join(self.test_dir, "vault_pass")
+        with open(password_file, "w") as f:
+            f.write(VAULT_PASSWORD)
+        os.makedirs(self.shadow_dir)
+        with open(os.path.join(self.shadow_dir, "unrelated"), "w") as f:
+            f.write("keep me")
+
+        original_cwd = os.getcwd()
+        os.chdir(self.project)
+        self.addCleanup(os.chdir, original_cwd)
+        for argv, message in (
+            (["open", "--shadow", "sh", "-p", password_file], "must be outside"),
+            (["close", "--shadow", self.shadow_dir], "not a pilfer shadow tree"),
+        ):
+            stderr = io.StringIO()
+            with mock.patch.object(sys, "argv", ["pilfer"] + argv), mock.patch(
+                "sys.stderr", stderr
+            ):
+                self.assertEqual(pilfer_cli.main(), 2)
+            self.assertIn(message, stderr.getvalue())
+        self.assertFalse(os.path.exists(os.path.join(self.project, "sh")))
+
+    def test_remove(self):
+        """Test that closing a shadow tree deletes it"""
+        self.build()
+        shadow.remove(self.shadow_dir)
+        self.assertFalse(os.path.exists(self.shadow_dir))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Tests for pilfer check-staged
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pilfer import cli as pilfer_cli  # noqa: E402
+from pilfer import git, staged  # noqa: E402
+from tests.test_diff import VAULT_PASSWORD, GitRepoTestCase  # noqa: E402
+
+
+class TestCheckStaged(GitRepoTestCase):
+    """Test the staged plaintext check against an open session"""
+
+    def setUp(self):
+        super().setUp()
+        self.write_vault("group_vars/all.yml", b"password: one\n")
+        self.write_vault("group_vars/other.yml", b"password: two\n")
+        with open("vault_pass", "wb") as f:
+            f.write(VAULT_PASSWORD)
+        self.commit("vaults")
+
+        pilfer_cli.decrypt_vault_files(
+            "vault_pass", pilfer_cli.discover_vault_files(), jobs=1
+        )
+        self.manifest_path = pilfer_cli.opened_vault_file_list_path()
+
+    def test_staged_plaintext_is_reported(self):
+        """Test that only opened files staged without a vault header are reported"""
+        with open("README", "w") as f:
+            f.write("plain files are not pilfer's business\n")
+        self.git("add", "README", "group_vars/all.yml")
+
+        self.assertEqual(
+            staged.plaintext_staged(self.manifest_path), ["group_vars/all.yml"]
+        )
+
+    def test_staged_vaults_and_unstaged_plaintext_pass(self):
+        """Test that staged ciphertext passes while plaintext is only on disk"""
+        self.write_vault("group_vars/new.yml", b"password: three\n")
+        with open("group_vars/other.yml", "ab") as f:
+            f.write(b"edited: true\n")
+        self.git("add", "group_vars/new.yml")
+
+        with mock.patch.object(
+            git.CatFileBatch, "__init__", side_effect=AssertionError("read blobs")
+        ):
+            self.assertEqual(staged.plaintext_staged(self.manifest_path), [])
+
+    def test_works_from_a_subdirectory(self):
+        """Test that staged paths are matched against the manifest root"""
+        self.git("add", "group_vars/other.yml")
+        os.chdir("group_vars")
+        try:
+            leaked = staged.plaintext_staged(os.path.join("..", self.manifest_path))
+        finally:
+            os.chdir("..")
+        self.assertEqual(leaked, ["group_vars/other.yml"])
+
+    def test_vaults_in_head_need_no_manifest(self):
+        """Test that a vault in HEAD staged as plaintext fails without a session"""
+        pilfer_cli.recrypt_vault_files("vault_pass", jobs=1)
+        self.assertIsNone(pilfer_cli.opened_vault_file_list_path())
+        with open("group_vars/other.yml", "wb") as f:
+            f.write(b"password: two\n")
+        self.write_vault("group_vars/all.yml", b"password: changed\n")
+        self.git("add", "group_vars")
+
+        self.assertEqual(staged.plaintext_staged(), ["group_vars/other.yml"])
+        code, stderr = self.run_cli("check-staged")
+        self.assertEqual(code, 1)
+        self.assertIn("group_vars/other.yml", stderr)
+
+    def test_git_errors_are_reported_briefly(self):
+        """Test that running outside a repository exits 2 without a traceback"""
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside)
+        os.chdir(outside)
+        code, stderr = self.run_cli("check-staged")
+        self.assertEqual(code, 2)
+        self.assertIn("pilfer check-staged: git exited", stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
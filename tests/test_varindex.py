@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Tests for the encrypted variable index behind pilfer index and find-var
+"""
+
+import os
+import shutil
+import sys
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pilfer import pipeline, varindex  # noqa: E402
+from tests.test_diff import VAULT_PASSWORD, GitRepoTestCase  # noqa: E402
+
+PROD = b"""db_password: hunter2
+db:
+  users:
+    - name: app
+      password: s3cret
+"""
+
+
+class TestVarIndex(GitRepoTestCase):
+    """Test building, refreshing and querying the variable index"""
+
+    def setUp(self):
+        super().setUp()
+        self.write_vault("group_vars/prod/vault.yml", PROD)
+        self.write_vault("group_vars/dev/vault.yml", b"db_password: dev\nport: 5432\n")
+        self.write_vault("files/cert.pem", b"-----BEGIN CERTIFICATE-----\nMIIB\n")
+
+    def find(self, name, value=None):
+        index = varindex.load(VAULT_PASSWORD)
+        return [
+            (result["path"], result["key"])
+            for result in index.find(name, value, varindex.value_key(VAULT_PASSWORD))
+        ]
+
+    def test_key_paths(self):
+        """Test that nested keys are dotted and list items marked with []"""
+        keys, values = varindex.extract(PROD, varindex.value_key(VAULT_PASSWORD))
+        self.assertEqual(
+            keys,
+            [
+                "db",
+                "db.users",
+                "db.users[].name",
+                "db.users[].password",
+                "db_password",
+            ],
+        )
+        self.assertEqual(
+            sorted(values), ["db.users[].name", "db.users[].password", "db_password"]
+        )
+        self.assertEqual(varindex.extract(b"just text\n"), ([], {}))
+
+    def test_ansible_tags_and_invalid_yaml(self):
+        """Test that tagged values are indexed and invalid YAML fails the file"""
+        self.write_vault(
+            "group_vars/tagged/vault.yml",
+            b"api_key: !vault |\n  $ANSIBLE_VAULT;1.1;AES256\n  6162\n"
+            b"template: !unsafe '{{ raw }}'\nusers: !custom [{name: app}]\n",
+        )
+        self.write_vault("group_vars/broken/vault.yml", b"db: [unclosed\n")
+        index, counts = varindex.build(VAULT_PASSWORD, jobs=1)
+
+        self.assertEqual(counts["failed"], 1)
+        self.assertNotIn("group_vars/broken/vault.yml", index.files)
+        self.assertEqual(
+            index.files["group_vars/tagged/vault.yml"]["keys"],
+            ["api_key", "template", "users", "users[].name"],
+        )
+
+    def test_find_var(self):
+        """Test lookups by name, last key, glob and value"""
+        _, counts = varindex.build(VAULT_PASSWORD, values=True, jobs=1)
+        self.assertEqual(counts["indexed"], 3)
+
+        self.assertEqual(
+            self.find("db_password"),
+            [
+                ("group_vars/dev/vault.yml", "db_password"),
+                ("group_vars/prod/vault.yml", "db_password"),
+            ],
+        )
+        self.assertEqual(
+            self.find("password"),
+            [("group_vars/prod/vault.yml", "db.users[].password")],
+        )
+        self.assertEqual(
+            [key for _, key in self.find("db.*")],
+            ["db.users", "db.users[].name", "db.users[].password"],
+        )
+        self.assertEqual(
+            self.find("db_password", "hunter2"),
+            [("group_vars/prod/vault.yml", "db_password")],
+        )
+        self.assertEqual(
+            self.find("port", "5432"), [("group_vars/dev/vault.yml", "port")]
+        )
+
+        # the index lives in the git directory, and holds no plaintext
+        path = varindex.index_path(os.getcwd())
+        self.assertIn(os.sep + ".git" + os.sep, path)
+        with open(path, "rb") as f:
+            stored = f.read()
+        self.assertTrue(stored.startswith(pipeline.VAULT_HEADER))
+        self.assertNotIn(b"db_password", stored)
+
+    def test_refresh_only_decrypts_changed_vaults(self):
+        """Test that a rebuild decrypts changed vaults and drops deleted ones"""
+        varindex.build(VAULT_PASSWORD, jobs=1)
+        with mock.patch.object(
+            pipeline, "index_in_worker", side_effect=AssertionError("decrypted")
+        ):
+            _, counts = varindex.build(VAULT_PASSWORD, jobs=1)
+        self.assertEqual(counts["unchanged"], 3)
+
+        self.write_vault("group_vars/dev/vault.yml", b"api_key: x\n")
+        os.remove("files/cert.pem")
+        _, counts = varindex.build(VAULT_PASSWORD, jobs=1)
+
+        self.assertEqual(
+            counts, {"indexed": 1, "unchanged": 1, "removed": 1, "failed": 0}
+        )
+        self.assertEqual(
+            self.find("db_password"), [("group_vars/prod/vault.yml", "db_password")]
+        )
+        self.assertEqual(
+            self.find("api_key"), [("group_vars/dev/vault.yml", "api_key")]
+        )
+        with self.assertRaises(ValueError):
+            # values were not indexed
+            self.find("api_key", "x")
+
+    def test_workers_start_before_threads(self):
+        """Test that the crypto pool is created while the process has one thread"""
+        crypto_executor = pipeline.crypto_executor
+        active_threads = []
+
+        def record_threads(*args, **kwargs):
+            active_threads.append(threading.active_count())
+            return crypto_executor(*args, **kwargs)
+
+        with mock.patch.object(pipeline, "crypto_executor", record_threads):
+            varindex.build(VAULT_PASSWORD, jobs=2)
+        self.assertEqual(active_threads, [threading.active_count()])
+
+    def test_local_index_is_never_walked(self):
+        """Test that an index in .pilfer/ is not taken for a project vault"""
+        shutil.rmtree(".git")
+        varindex.build(VAULT_PASSWORD, jobs=1)
+        path = varindex.index_path(os.getcwd())
+        self.assertEqual(
+            path, os.path.join(os.getcwd(), ".pilfer", varindex.INDEX_FILE_NAME)
+        )
+        self.assertTrue(os.path.isfile(path))
+        self.assertNotIn(path, list(pipeline.iter_vaulted_files(os.getcwd())))
+
+        _, counts = varindex.build(VAULT_PASSWORD, jobs=1)
+        self.assertEqual(counts["unchanged"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
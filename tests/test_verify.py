@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Tests for pilfer verify - the write-free integrity and password check
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ansible.constants import DEFAULT_VAULT_ID_MATCH  # noqa: E402
+from ansible.parsing.vault import VaultLib, VaultSecret  # noqa: E402
+
+from pilfer import cli as pilfer_cli  # noqa: E402
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+class TestVerify(unittest.TestCase):
+    """Test verification of vault files without modifying them"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.original_cwd = os.getcwd()
+        os.chdir(self.test_dir)
+
+        with open("vault_pass", "w") as f:
+            f.write("test_password")
+        with open("wrong_pass", "w") as f:
+            f.write("wrong_password")
+
+        vault = VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(b"test_password"))])
+        os.makedirs("group_vars")
+        for name in ("all.yml", "prod.yml"):
+            with open(os.path.join("group_vars", name), "wb") as f:
+                f.write(vault.encrypt(b"secret: value\n"))
+
+        self.snapshot = self.take_snapshot()
+
+    def tearDown(self):
+        os.chdir(self.original_cwd)
+        shutil.rmtree(self.test_dir)
+
+    def take_snapshot(self):
+        snapshot = {}
+        for dirpath, _, filenames in os.walk("."):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                with open(path, "rb") as f:
+                    snapshot[path] = (f.read(), os.stat(path).st_mtime_ns)
+        return snapshot
+
+    def run_verify(self, *args):
+        env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+        cmd = [sys.executable, "-m", "pilfer.cli", "verify"] + list(args)
+        return subprocess.run(cmd, capture_output=True, text=True, env=env)
+
+    def test_all_files_verify(self):
+        """Test that correctly encrypted files verify and nothing is written"""
+        results = pilfer_cli.verify_vault_files("vault_pass", jobs=2)
+
+        self.assertEqual(
+            [result["path"] for result in results],
+            [
+                os.path.join("group_vars", "all.yml"),
+                os.path.join("group_vars", "prod.yml"),
+            ],
+        )
+        self.assertTrue(all(result["status"] == "ok" for result in results))
+        self.assertEqual(self.take_snapshot(), self.snapshot)
+
+    def test_wrong_password_fails(self):
+        """Test that every file fails with the wrong password"""
+        results = pilfer_cli.verify_vault_files("wrong_pass", jobs=1)
+
+        self.assertEqual(len(results), 2)
+        self.assertTrue(all(result["status"] == "failed" for result in results))
+
+    def test_tampered_file_reports_failure_and_exit_status(self):
+        """Test that a corrupted HMAC is reported per file with a non-zero exit"""
+        path = os.path.join("group_vars", "prod.yml")
+        with open(path, "rb") as f:
+            lines = f.read().split(b"\n")
+        # flip one hex digit of the ciphertext body
+        lines[3] = lines[3][:-1] + (b"0" if lines[3][-1:] != b"0" else b"1")
+        with open(path, "wb") as f:
+            f.write(b"\n".join(lines))
+
+        result = self.run_verify("-p", "vault_pass", "--format", "json")
+        self.assertEqual(result.returncode, 1, result.stderr)
+
+        report = json.loads(result.stdout)
+        self.assertEqual(report["verified"], 1)
+        self.assertEqual(report["failed"], 1)
+        failed = [entry for entry in report["files"] if entry["status"] == "failed"]
+        self.assertEqual(failed[0]["path"], path)
+
+    def test_exit_status_zero_when_all_verify(self):
+        """Test the text report and exit status for a clean tree"""
+        result = self.run_verify("-p", "vault_pass")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("All 2 vault files verified", result.stdout)
+
+
+if __name__ == "__main__":
+    unittest.main()